@@ -5,23 +5,14 @@ import logging
 from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.openai_utils import GPTClient
 from section_composer import SectionComposer, setup_logging
+from rate_limiter import PRIORITY_HIGH
 
 class AbstractComposer(SectionComposer):
-    def __init__(self, research_field: str, structure_iterations: int = 2):
-        super().__init__(research_field, "abstract", structure_iterations)
-
-    def read_section_content(self, target_paper: str, section_name: str) -> str:
-        """Read content from an existing section file"""
-        normalized_title = self.normalize_title(target_paper)
-        section_path = f"{self.research_field}/target_sections/{normalized_title}/{section_name}.tex"
-        try:
-            with open(section_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            logging.warning(f"Section file {section_path} not found")
-            return ""
+    INPUT_SECTIONS = ['introduction', 'methodology', 'experiments']
+
+    def __init__(self, research_field: str, structure_iterations: int = 2, **kwargs):
+        super().__init__(research_field, "abstract", structure_iterations, **kwargs)
 
     async def generate_or_revise_structure(self, content, current_structure, iteration):
         prompt = f"""Based on the given content, generate or revise the abstract structure, using latex format.
@@ -62,7 +53,7 @@ Output only the LaTeX structure with comments as specified above."""
         return await self.gpt_client.chat(prompt=prompt)
 
     async def detailize_subsection(self, structure, current_text, content):
-        writing_template = self.get_random_template()
+        writing_template = await self.select_template(f"{structure}\n{content}")
         prompt = f"""Write a comprehensive abstract based on the provided structure and content.
 
 CURRENT ABSTRACT VERSION (if any):
@@ -140,19 +131,20 @@ CHECKLIST FOR REVISION:
 
 Output the revised abstract section incorporating all these improvements. Reply with LaTeX text only."""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_HIGH)
 
     async def compose_section(self, target_paper: str) -> str:
         checkpoint_dir = self.get_checkpoint_path(target_paper)
         os.makedirs(checkpoint_dir, exist_ok=True)
 
         # Read existing sections
-        introduction = self.read_section_content(target_paper, "introduction")
-        methodology = self.read_section_content(target_paper, "methodology")
-        experiments = self.read_section_content(target_paper, "experiments")
+        introduction = await self.read_section_content(target_paper, "introduction")
+        methodology = await self.read_section_content(target_paper, "methodology")
+        experiments = await self.read_section_content(target_paper, "experiments")
         content_bundle = introduction + '\n\n' + methodology + '\n\n' + experiments
 
         # Step 1: Iterative structure generation
+        self.set_trace_stage("structure")
         structure = ""
         structure_checkpoint = self.load_checkpoint(target_paper, "structure")
         
@@ -161,6 +153,7 @@ Output the revised abstract section incorporating all these improvements. Reply
             logging.info("Loaded structure from checkpoint")
         else:
             for iteration in range(self.structure_iterations):
+                self.set_trace_stage("structure", iteration + 1)
                 logging.info(f"Structure iteration {iteration + 1}/{self.structure_iterations}")
                 structure = await self.generate_or_revise_structure(
                     content_bundle, structure, iteration + 1)
@@ -171,25 +164,20 @@ Output the revised abstract section incorporating all these improvements. Reply
             })
 
         # Step 2: Write complete abstract
+        self.set_trace_stage("detailize")
         final_abstract = await self.detailize_subsection(structure, "", content_bundle)
         self.write_temp_log(final_abstract, "initial_abstract")
 
         
         # Save final output
-        output_dir = f"{self.research_field}/target_sections/{self.normalize_title(target_paper)}"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "abstract.tex")
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(final_abstract)
-        logging.info(f"Saved final abstract to {output_path}")
+        self.save_section_output(target_paper, final_abstract)
 
         return final_abstract
 
-async def abstract_composing(research_field: str, instance_id: str):
+async def abstract_composing(research_field: str, instance_id: str, **composer_options):
     setup_logging(research_field)
     
-    composer = AbstractComposer(research_field=research_field, structure_iterations=2)
+    composer = AbstractComposer(research_field=research_field, structure_iterations=2, **composer_options)
     # target_paper = 'Heterogeneous Graph Contrastive Learning for Recommendation'
     
     try:
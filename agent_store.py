@@ -0,0 +1,38 @@
+import os
+import json
+from typing import Any, Dict, Tuple
+
+class AgentArtifact:
+    """An agent output file, parsed and serialized once"""
+
+    def __init__(self, path: str, data: Any):
+        self.path = path
+        self.data = data
+        # Compact serialization used in prompts
+        self.text = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+class AgentArtifactStore:
+    """Memoized reader for `cache_*/agents/*.json` files.
+
+    Every file is read and serialized at most once per process unless it changes on disk (its
+    modification time or size differ from the memoized copy), so composers can look agent files
+    up inside their structure and subsection loops at no cost."""
+
+    def __init__(self):
+        self.artifacts: Dict[str, Tuple[Tuple[int, int], AgentArtifact]] = {}
+
+    def load(self, agent_dir: str, agent_file: str) -> AgentArtifact:
+        path = os.path.abspath(os.path.join(agent_dir, agent_file))
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        memoized = self.artifacts.get(path)
+        if memoized and memoized[0] == signature:
+            return memoized[1]
+
+        with open(path, 'r', encoding='utf-8') as f:
+            artifact = AgentArtifact(path, json.load(f))
+        self.artifacts[path] = (signature, artifact)
+        return artifact
+
+    def clear(self):
+        self.artifacts.clear()
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from llm_backend import LLMBackend, LocalBackend
+from llm_cache import SAMPLING_PARAMS, ResponseCache, get_response_cache
+
+'''
+# Batch Execution
+
+For overnight runs where latency does not matter, the `batch` backend sends calls through a
+batch API (about half the price of synchronous calls) instead of one request per call:
+
+- Calls issued at about the same time (within `collect_window` seconds of each other) are
+  collected into one JSONL batch job. With sections and subsections composed concurrently, these
+  are all calls that are ready at the current dependency level, e.g. the first detailize step of
+  every subsection of every section (and of every instance when several papers share a process).
+- With `wait=True` the pipeline polls the job and continues in-process once results arrive.
+- With `wait=False` (detached) calls fail with BatchPending right after the job is submitted. The
+  job is recorded in `pending.json`; the next run ingests its results into the LLM response cache
+  and resumes from the checkpoints, so every rerun advances the pipeline by one level.
+
+Servers: `local` (LocalBatchServer, a stand-in that answers jobs with the local backend's
+synthesized output through JSONL files) and `openai` (the OpenAI Batch API).
+'''
+
+class BatchPending(RuntimeError):
+    """Raised for calls whose batch job was submitted but is not complete yet"""
+
+    def __init__(self, batch_id: str):
+        super().__init__(f"Waiting for batch job {batch_id}; rerun once it has completed")
+        self.batch_id = batch_id
+
+def parse_batch_output(lines) -> Dict[str, str]:
+    """Responses by custom_id from batch output lines (OpenAI batch output format)"""
+    results = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get('response') or {}
+        if record.get('error') or response.get('status_code') != 200:
+            logging.error(f"Batch request {record.get('custom_id')} failed: {record.get('error') or response}")
+            continue
+        results[record['custom_id']] = response['body']['choices'][0]['message']['content']
+    return results
+
+class LocalBatchServer:
+    """Batch server stand-in working on JSONL files under root_dir; jobs complete
+    completion_delay seconds after submission"""
+
+    def __init__(self, root_dir: str, completion_delay: float = 0.0):
+        self.root_dir = root_dir
+        self.completion_delay = completion_delay
+
+    def job_dir(self, batch_id: str) -> str:
+        return os.path.join(self.root_dir, batch_id)
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        os.makedirs(self.job_dir(batch_id))
+        with open(input_path, 'r', encoding='utf-8') as f:
+            requests = f.read()
+        with open(os.path.join(self.job_dir(batch_id), 'input.jsonl'), 'w', encoding='utf-8') as f:
+            f.write(requests)
+        with open(os.path.join(self.job_dir(batch_id), 'status.json'), 'w', encoding='utf-8') as f:
+            json.dump({'submitted': time.time()}, f)
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        with open(os.path.join(self.job_dir(batch_id), 'status.json'), 'r', encoding='utf-8') as f:
+            submitted = json.load(f)['submitted']
+        if time.time() - submitted < self.completion_delay:
+            return 'in_progress'
+        output_path = os.path.join(self.job_dir(batch_id), 'output.jsonl')
+        if not os.path.exists(output_path):
+            self.process(batch_id, output_path)
+        return 'completed'
+
+    def process(self, batch_id: str, output_path: str):
+        with open(os.path.join(self.job_dir(batch_id), 'input.jsonl'), 'r', encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        backends: Dict[str, LocalBackend] = {}
+        with open(f"{output_path}.tmp", 'w', encoding='utf-8') as f:
+            for request in requests:
+                body = request['body']
+                backend = backends.setdefault(body['model'], LocalBackend(body['model']))
+                content = backend.synthesize(body['messages'][-1]['content'])
+                f.write(json.dumps({
+                    'custom_id': request['custom_id'],
+                    'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}},
+                    'error': None,
+                }) + '\n')
+        os.replace(f"{output_path}.tmp", output_path)
+
+    def results(self, batch_id: str) -> Dict[str, str]:
+        with open(os.path.join(self.job_dir(batch_id), 'output.jsonl'), 'r', encoding='utf-8') as f:
+            return parse_batch_output(f)
+
+class OpenAIBatchServer:
+    """OpenAI Batch API (needs an openai package with batch support)"""
+
+    def __init__(self):
+        # Imported here so the pipeline can run offline without the OpenAI client installed
+        from openai import OpenAI
+        self.client = OpenAI()
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                           completion_window='24h')
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> Dict[str, str]:
+        batch = self.client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return {}
+        return parse_batch_output(self.client.files.content(batch.output_file_id).text.splitlines())
+
+# Job states after which a job produces no more results
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+class BatchCollector:
+    """Collects concurrent calls into batch jobs and hands out their results.
+
+    Jobs are recorded in `{batch_dir}/pending.json` with, per request, the response cache entry
+    its result is stored under, so results of jobs submitted by an earlier run are ingested into
+    the response cache when the next run starts."""
+
+    def __init__(self, server, batch_dir: str, collect_window: float = 2.0, poll_interval: float = 30.0,
+                 wait: bool = True):
+        self.server = server
+        self.batch_dir = batch_dir
+        self.collect_window = collect_window
+        self.poll_interval = poll_interval
+        self.wait = wait
+        os.makedirs(batch_dir, exist_ok=True)
+        self.pending_path = os.path.join(batch_dir, 'pending.json')
+        # batch_id -> {'requests': {key: {'model', 'params', 'cache_dir'}}}
+        self.jobs: Dict[str, Dict] = {}
+        if os.path.exists(self.pending_path):
+            with open(self.pending_path, 'r', encoding='utf-8') as f:
+                self.jobs = json.load(f)
+        self.resume_task: Optional[asyncio.Future] = None
+        # Calls waiting to be submitted: key -> (request body, cache entry, future)
+        self.queue: Dict[str, Tuple[Dict, Dict, asyncio.Future]] = {}
+        self.flush_handle = None
+        # Futures of submitted calls by batch_id, and tasks completing them
+        self.waiting: Dict[str, Dict[str, List[asyncio.Future]]] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.results: Dict[str, str] = {}
+        self.submitted = 0
+
+    def save_jobs(self):
+        temp_path = f"{self.pending_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.jobs, f)
+        os.replace(temp_path, self.pending_path)
+
+    async def resume(self):
+        """Ingest the results of jobs left by earlier runs"""
+        for batch_id in list(self.jobs):
+            status = await asyncio.to_thread(self.server.status, batch_id)
+            if status in FINAL_STATUSES:
+                await self.ingest(batch_id, status)
+
+    async def ingest(self, batch_id: str, status: str):
+        results = await asyncio.to_thread(self.server.results, batch_id) if status == 'completed' else {}
+        requests = self.jobs.pop(batch_id)['requests']
+        self.save_jobs()
+        for key, entry in requests.items():
+            if key in results:
+                get_response_cache(entry['cache_dir']).put(key, results[key], entry['model'], entry['params'])
+                self.results[key] = results[key]
+        logging.info(f"Batch job {batch_id} {status}: ingested {len(results)} of {len(requests)} responses")
+
+    def job_of(self, key: str) -> Optional[str]:
+        for batch_id, job in self.jobs.items():
+            if key in job['requests']:
+                return batch_id
+        return None
+
+    async def request(self, key: str, body: Dict, entry: Dict) -> str:
+        if self.resume_task is None:
+            self.resume_task = asyncio.ensure_future(self.resume())
+        if not self.resume_task.done():
+            # Shielded: a call cancelled while waiting must not abort the resume for the others
+            await asyncio.shield(self.resume_task)
+        if key in self.results:
+            return self.results[key]
+
+        future = asyncio.get_running_loop().create_future()
+        batch_id = self.job_of(key)
+        if batch_id:
+            # Already submitted, by this run or an earlier one
+            if not self.wait:
+                raise BatchPending(batch_id)
+            self.waiting.setdefault(batch_id, {}).setdefault(key, []).append(future)
+            if batch_id not in self.tasks:
+                self.tasks[batch_id] = asyncio.ensure_future(self.complete(batch_id))
+        elif key in self.queue:
+            return await asyncio.shield(self.queue[key][2])
+        else:
+            self.queue[key] = (body, entry, future)
+            # Submit once no new call has arrived for collect_window seconds
+            if self.flush_handle:
+                self.flush_handle.cancel()
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.collect_window, lambda: asyncio.ensure_future(self.flush()))
+        return await future
+
+    async def flush(self):
+        queue, self.queue, self.flush_handle = self.queue, {}, None
+        if not queue:
+            return
+        input_path = os.path.join(self.batch_dir, f"batch_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.jsonl")
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for key, (body, _, _) in queue.items():
+                f.write(json.dumps({'custom_id': key, 'method': 'POST', 'url': '/v1/chat/completions',
+                                    'body': body}, ensure_ascii=False) + '\n')
+        try:
+            batch_id = await asyncio.to_thread(self.server.submit, input_path)
+        except Exception as e:
+            for _, _, future in queue.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.jobs[batch_id] = {'input': input_path, 'requests': {key: entry for key, (_, entry, _) in queue.items()}}
+        self.save_jobs()
+        self.submitted += 1
+        logging.info(f"Submitted batch job {batch_id} with {len(queue)} requests")
+
+        if not self.wait:
+            for _, _, future in queue.values():
+                if not future.done():
+                    future.set_exception(BatchPending(batch_id))
+            return
+        waiting = self.waiting.setdefault(batch_id, {})
+        for key, (_, _, future) in queue.items():
+            waiting.setdefault(key, []).append(future)
+        self.tasks[batch_id] = asyncio.ensure_future(self.complete(batch_id))
+
+    async def complete(self, batch_id: str):
+        """Poll a job until it is done and resolve the calls waiting for it"""
+        try:
+            while True:
+                status = await asyncio.to_thread(self.server.status, batch_id)
+                if status in FINAL_STATUSES:
+                    break
+                await asyncio.sleep(self.poll_interval)
+            await self.ingest(batch_id, status)
+        except Exception as e:
+            error = e
+        else:
+            error = None
+        finally:
+            self.tasks.pop(batch_id, None)
+        for key, futures in self.waiting.pop(batch_id, {}).items():
+            for future in futures:
+                if future.done():
+                    continue
+                if key in self.results:
+                    future.set_result(self.results[key])
+                else:
+                    future.set_exception(error or RuntimeError(f"Batch job {batch_id} ({status}) returned no response"))
+
+    def stats(self) -> Dict:
+        return {'jobs_submitted': self.submitted, 'jobs_pending': len(self.jobs), 'responses': len(self.results)}
+
+_collectors: Dict[Tuple[str, str], BatchCollector] = {}
+
+def get_batch_collector(server: str, batch_dir: str, completion_delay: float = 0.0, **options) -> BatchCollector:
+    """Return the process-wide collector for (server, batch_dir), so that calls of all composers
+    and instances end up in the same jobs"""
+    batch_dir = os.path.abspath(batch_dir)
+    if (server, batch_dir) not in _collectors:
+        if server == 'local':
+            batch_server = LocalBatchServer(os.path.join(batch_dir, 'local_server'), completion_delay)
+        elif server == 'openai':
+            batch_server = OpenAIBatchServer()
+        else:
+            raise ValueError(f"Unknown batch server {server!r}, expected 'local' or 'openai'")
+        _collectors[(server, batch_dir)] = BatchCollector(batch_server, batch_dir, **options)
+    return _collectors[(server, batch_dir)]
+
+def batch_stats() -> Dict:
+    return {batch_dir: collector.stats() for (_, batch_dir), collector in _collectors.items()}
+
+class BatchBackend(LLMBackend):
+    name = "batch"
+    # Batch jobs have their own quota, so calls do not go through the rate limiter
+    rate_limited = False
+
+    def __init__(self, model: str, batch_dir: str, cache_dir: str, server: str = 'local', **collector_options):
+        """
+        Args:
+            model: Model the requests are sent to
+            batch_dir: Directory for job files and the pending job list
+            cache_dir: LLM response cache directory results are ingested into
+            server: 'local' or 'openai'
+            collector_options: completion_delay (local server), collect_window, poll_interval, wait
+        """
+        super().__init__(model)
+        self.server = server
+        self.cache_dir = cache_dir
+        self.collector = get_batch_collector(server, batch_dir, **collector_options)
+
+    @property
+    def cache_model(self) -> str:
+        # Responses of the local stand-in server must not mix with real ones
+        return f"local/{self.model}" if self.server == 'local' else self.model
+
+    async def chat(self, prompt: str, **kwargs) -> str:
+        params = {name: kwargs[name] for name in SAMPLING_PARAMS if name in kwargs}
+        key = ResponseCache.make_key(self.cache_model, prompt, params)
+        body = {'model': self.model, 'messages': [{'role': 'user', 'content': prompt}], **params}
+        entry = {'model': self.cache_model, 'params': params, 'cache_dir': os.path.abspath(self.cache_dir)}
+        response = await self.collector.request(key, body, entry)
+        await self.record_usage(prompt, response)
+        return response
@@ -0,0 +1,196 @@
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from statistics import mean
+from typing import Callable, Dict, List, Optional, Tuple
+
+from writing import compose_paper, section_tasks, log_run_stats, add_composer_arguments, composer_options_from_args
+from batch_backend import BatchPending
+from executors import configure_executors, shutdown_executors
+from trace_writer import configure_tracing
+
+'''
+# Batch Writing
+
+Composes many papers in one process and one event loop, e.g.
+
+    python batch_writing.py --manifest papers.txt --max_concurrency 8
+
+The manifest lists one `research_field instance_id` pair per line (`#` starts a comment), or is a
+JSON list of {"research_field": ..., "instance_id": ...} objects. All papers share the process-wide
+LLM response caches, rate limiters, agent artifact store and template indexes, and a single
+semaphore caps the number of sections composed at once across all papers. A progress table with
+per-paper ETAs is logged every --report_interval seconds.
+'''
+
+def read_manifest(path: str) -> List[Tuple[str, str]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if path.endswith('.json'):
+        return [(item['research_field'], item['instance_id']) for item in json.loads(text)]
+    instances = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            research_field, instance_id = line.replace('/', ' ').split()
+            instances.append((research_field, instance_id))
+    return instances
+
+class InstanceProgress:
+    def __init__(self, research_field: str, instance_id: str, sections: List[str]):
+        self.research_field = research_field
+        self.instance_id = instance_id
+        self.sections = sections
+        self.finished: Dict[str, Optional[BaseException]] = {}
+        self.status = "queued"
+        self.started: Optional[float] = None
+        self.ended: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.research_field}/{self.instance_id}"
+
+    def remaining(self) -> List[str]:
+        return [section for section in self.sections if section not in self.finished]
+
+class ProgressTable:
+    """Per-paper progress with ETAs estimated from the durations of sections finished so far"""
+
+    def __init__(self, instances: List[Tuple[str, str]], concurrency: int):
+        sections = [task.name for task in section_tasks()]
+        self.instances = [InstanceProgress(research_field, instance_id, sections)
+                          for research_field, instance_id in instances]
+        self.concurrency = concurrency
+        self.durations: Dict[str, List[float]] = {}
+        self.started = time.perf_counter()
+
+    def section_finished(self, progress: InstanceProgress, section: str, seconds: Optional[float],
+                         error: Optional[BaseException]):
+        progress.finished[section] = error
+        if error is None:
+            self.durations.setdefault(section, []).append(seconds)
+
+    def expected_duration(self, section: str) -> Optional[float]:
+        if self.durations.get(section):
+            return mean(self.durations[section])
+        finished = [duration for durations in self.durations.values() for duration in durations]
+        return mean(finished) if finished else None
+
+    def remaining_work(self, progress: InstanceProgress) -> Optional[float]:
+        """Expected section-seconds left for a paper (None until there is data to estimate from)"""
+        if progress.status in ("done", "failed", "pending"):
+            return 0.0
+        expected = [self.expected_duration(section) for section in progress.remaining()]
+        if any(duration is None for duration in expected):
+            return None
+        return sum(expected)
+
+    def eta(self, progress: InstanceProgress) -> Optional[float]:
+        work = self.remaining_work(progress)
+        if work is None:
+            return None
+        # Sections of one paper run up to three at a time
+        return work / min(3, max(1, len(progress.remaining())))
+
+    def render(self) -> str:
+        now = time.perf_counter()
+        rows = [("paper", "status", "sections", "elapsed", "eta")]
+        for progress in self.instances:
+            done = sum(1 for error in progress.finished.values() if error is None)
+            elapsed = ((progress.ended or now) - progress.started) if progress.started else 0.0
+            eta = self.eta(progress)
+            rows.append((progress.name, progress.status, f"{done}/{len(progress.sections)}",
+                         f"{elapsed:.0f}s", "?" if eta is None else f"{eta:.0f}s"))
+
+        remaining_work = [self.remaining_work(progress) for progress in self.instances]
+        if any(work is None for work in remaining_work):
+            total_eta = "?"
+        else:
+            total_eta = f"{sum(remaining_work) / self.concurrency:.0f}s"
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows]
+        lines.append(f"elapsed {now - self.started:.0f}s, estimated remaining {total_eta}")
+        return '\n'.join(lines)
+
+async def batch_writing(instances: List[Tuple[str, str]], composer_options_for: Callable[[str], Dict],
+                        max_concurrency: int = 6, max_instances: Optional[int] = None,
+                        report_interval: float = 30.0) -> ProgressTable:
+    """Compose the papers of all instances in one event loop.
+
+    Args:
+        instances: (research_field, instance_id) pairs
+        composer_options_for: Returns the compose_paper options for a research field
+        max_concurrency: Cap on sections composed concurrently across all papers
+        max_instances: Cap on papers in progress at once (None for no cap)
+        report_interval: Seconds between progress table reports
+
+    Returns:
+        The final progress table
+    """
+    table = ProgressTable(instances, max_concurrency)
+    sections = asyncio.Semaphore(max_concurrency)
+    papers = asyncio.Semaphore(max_instances or len(instances) or 1)
+
+    async def run(progress: InstanceProgress):
+        async with papers:
+            progress.status = "running"
+            progress.started = time.perf_counter()
+
+            def on_section_finished(section, seconds, error):
+                table.section_finished(progress, section, seconds, error)
+
+            try:
+                await compose_paper(progress.research_field, progress.instance_id, semaphore=sections,
+                                    on_section_finished=on_section_finished,
+                                    **composer_options_for(progress.research_field))
+                progress.status = "done"
+            except BatchPending:
+                progress.status = "pending"
+            except Exception as e:
+                progress.status = "failed"
+                logging.error(f"Paper {progress.name} failed: {str(e)}")
+            finally:
+                progress.ended = time.perf_counter()
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            logging.info("Batch progress:\n" + table.render())
+
+    reporter = asyncio.ensure_future(report())
+    try:
+        await asyncio.gather(*(run(progress) for progress in table.instances))
+    finally:
+        reporter.cancel()
+        logging.info("Batch progress:\n" + table.render())
+        log_run_stats(sorted({research_field for research_field, _ in instances}))
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, required=True,
+                        help="File listing 'research_field instance_id' per line, or a JSON list")
+    parser.add_argument("--max_concurrency", type=int, default=6,
+                        help="Maximum number of sections composed concurrently across all papers")
+    parser.add_argument("--max_instances", type=int, default=None,
+                        help="Maximum number of papers in progress at once")
+    parser.add_argument("--report_interval", type=float, default=30.0,
+                        help="Seconds between progress reports")
+    add_composer_arguments(parser)
+    args = parser.parse_args()
+    configure_executors(cpu_workers=args.cpu_workers)
+    configure_tracing(int(args.trace_max_mb * 1024 * 1024) or None, args.trace_compress)
+
+    instances = read_manifest(args.manifest)
+    if not instances:
+        sys.exit(f"No instances in {args.manifest}")
+    try:
+        table = asyncio.run(batch_writing(instances, lambda research_field: composer_options_from_args(args, research_field),
+                                          args.max_concurrency, args.max_instances, args.report_interval))
+    finally:
+        shutdown_executors()
+    if any(progress.status == "failed" for progress in table.instances):
+        sys.exit(1)
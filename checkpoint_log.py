@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+class SubsectionStepLog:
+    """Append-only checkpoint of subsection detailization, one JSON line per (subsection, step).
+
+    Every step appends a single line instead of rewriting all subsections, and a crash can at most
+    leave a torn last line, which is ignored when the log is read back. Records are tied to the
+    structure they were written for, so a regenerated structure never resumes from stale text.
+
+    record() blocks on fsync and is meant to run on the thread pool; concurrent records are
+    appended one at a time.
+    """
+
+    def __init__(self, path: str, structure: str):
+        self.path = path
+        self.structure_digest = hashlib.sha256(structure.encode('utf-8')).hexdigest()
+        # (subsection, fold mode, step label) -> subsection text after that step
+        self.records: Dict[Tuple[str, str, str], str] = {}
+        # Whether the file ends in a torn line, which the next record must not be appended to
+        self.torn = False
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        self.torn = bool(content) and not content.endswith('\n')
+        # Split on '\n' only: texts may contain other line separators that JSON leaves unescaped
+        for line_number, line in enumerate(content.split('\n'), 1):
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning(f"Ignoring incomplete record on line {line_number} of {self.path}")
+                continue
+            if record.get('structure') == self.structure_digest:
+                self.records[(record['subsection'], record['mode'], record['step'])] = record['text']
+        if self.records:
+            logging.info(f"Loaded {len(self.records)} subsection steps from {self.path}")
+
+    def get(self, subsection: str, mode: str, step: str) -> Optional[str]:
+        return self.records.get((subsection, mode, step))
+
+    def record(self, subsection: str, mode: str, step: str, text: str):
+        line = json.dumps({'structure': self.structure_digest, 'subsection': subsection, 'mode': mode,
+                           'step': step, 'text': text}, ensure_ascii=False)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(('\n' if self.torn else '') + line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.torn = False
+            self.records[(subsection, mode, step)] = text
+
+    def clear(self):
+        """Drop the log once the subsections it covers have been saved as a whole"""
+        self.records.clear()
+        self.torn = False
+        if os.path.exists(self.path):
+            os.remove(self.path)
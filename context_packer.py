@@ -0,0 +1,205 @@
+import re
+import math
+import logging
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from executors import run_cpu
+from telemetry import count_call_tokens
+
+'''
+# Context Packing
+
+Composers paste whole payloads into prompts: model code, the project summary, agent outputs and
+related papers. The packer measures those payloads in model tokens and, when a prompt would not
+fit the token budget, keeps the chunks of the payload that are most relevant to the subsection
+being written. Prompts whose fixed parts alone exceed the budget fail before any call is made.
+'''
+
+# Context windows in tokens, matched by model name prefix (longest prefix wins)
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o1-mini': 128000,
+    'o3-mini': 200000,
+    'claude': 200000,
+    'gemini': 1000000,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+# Tokens kept free for the completion
+COMPLETION_RESERVE = 4096
+# Estimate for prompt instructions and the writing template, which are added inside the
+# composers' prompt methods after content has been packed
+PROMPT_OVERHEAD = 4000
+# Payloads shorter than this are counted and packed in the event loop; for them the round trip to
+# a worker process costs more than the work
+OFFLOAD_MIN_CHARS = 20000
+
+_encoders: Dict[str, object] = {}
+
+class ContextBudgetError(ValueError):
+    """Raised when a prompt cannot be made to fit the token budget"""
+
+def context_window(model: str) -> int:
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+def get_encoder(model: str):
+    """tiktoken encoder for model, or None when tiktoken is not installed"""
+    if model not in _encoders:
+        try:
+            import tiktoken
+        except ImportError:
+            logging.warning("tiktoken is not installed, estimating token counts from text length")
+            _encoders[model] = None
+            return None
+        try:
+            _encoders[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encoders[model] = tiktoken.get_encoding("o200k_base" if model.startswith(('gpt-4o', 'o1', 'o3')) else "cl100k_base")
+    return _encoders[model]
+
+def count_tokens(text: str, model: str) -> int:
+    encoder = get_encoder(model)
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+async def count_tokens_async(text: str, model: str) -> int:
+    """count_tokens, run in the process pool for large texts"""
+    if len(text) < OFFLOAD_MIN_CHARS or get_encoder(model) is None:
+        return count_tokens(text, model)
+    return await run_cpu(count_tokens, text, model)
+
+def tokenize_terms(text: str) -> List[str]:
+    """Lower-cased word terms used for relevance scoring"""
+    return re.findall(r"[a-z][a-z0-9_]+", text.lower())
+
+def split_into_chunks(text: str, max_chunk_tokens: int, model: str) -> List[str]:
+    """Split text at file markers (`# File: ...`) and blank lines into chunks of at most
+    max_chunk_tokens, merging small neighbouring paragraphs"""
+    blocks = re.split(r"\n(?=# File: )", text)
+    paragraphs = []
+    for block in blocks:
+        paragraphs.extend(part for part in re.split(r"\n\s*\n", block) if part.strip())
+
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in paragraphs:
+        tokens = count_tokens(paragraph, model)
+        if tokens > max_chunk_tokens:
+            # Oversized paragraph (e.g. a long single-line JSON payload): cut it by characters
+            step = max(1, len(paragraph) * max_chunk_tokens // tokens)
+            pieces = [paragraph[i:i + step] for i in range(0, len(paragraph), step)]
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = tokens if len(pieces) == 1 else count_tokens(piece, model)
+            if current and current_tokens + piece_tokens > max_chunk_tokens:
+                chunks.append('\n\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+def rank_chunks(chunks: List[str], query: str) -> List[int]:
+    """Indices of chunks sorted by TF-IDF relevance to query, ties kept in document order"""
+    query_terms = set(tokenize_terms(query))
+    chunk_terms = [Counter(tokenize_terms(chunk)) for chunk in chunks]
+    document_frequency = Counter()
+    for terms in chunk_terms:
+        document_frequency.update(query_terms & set(terms))
+
+    def score(index):
+        terms = chunk_terms[index]
+        total = sum((1 + math.log(terms[term])) * math.log(1 + len(chunks) / document_frequency[term])
+                    for term in query_terms if terms[term])
+        return total / (1 + math.log(1 + sum(terms.values())))
+
+    return sorted(range(len(chunks)), key=lambda index: (-score(index), index))
+
+class ContextPacker:
+    def __init__(self, model: str, budget: Optional[int] = None, max_chunk_tokens: int = 1500):
+        """
+        Args:
+            model: Model the prompts are sent to, used to count tokens
+            budget: Prompt token budget (defaults to the model's context window minus a
+                reserve for the completion)
+            max_chunk_tokens: Size of the chunks content is cut into when it has to be trimmed
+        """
+        self.model = model
+        self.budget = budget or context_window(model) - COMPLETION_RESERVE
+        self.max_chunk_tokens = max_chunk_tokens
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    async def count_async(self, text: str) -> int:
+        return await count_tokens_async(text, self.model)
+
+    def pack(self, content: str, query: str, reserved: int = 0) -> str:
+        """Fit content into the budget left after `reserved` tokens of fixed prompt parts.
+
+        Content that fits is returned unchanged. Otherwise it is cut into chunks and the chunks
+        most relevant to query are kept, in their original order.
+
+        Raises:
+            ContextBudgetError: If the fixed prompt parts alone do not fit the budget
+        """
+        packed, packing = self.select(content, query, reserved)
+        self.log_packing(query, packing)
+        return packed
+
+    async def pack_async(self, content: str, query: str, reserved: int = 0) -> str:
+        """pack(), run in the process pool for large content"""
+        if len(content) < OFFLOAD_MIN_CHARS:
+            return self.pack(content, query, reserved)
+        packed, packing = await run_cpu(self.select, content, query, reserved)
+        self.log_packing(query, packing)
+        return packed
+
+    def select(self, content: str, query: str, reserved: int = 0) -> Tuple[str, Optional[Tuple[int, int, int, int]]]:
+        """Packed content, and (used tokens, available tokens, kept chunks, chunks) if it was trimmed"""
+        available = self.budget - reserved
+        if available <= 0:
+            raise ContextBudgetError(
+                f"Required prompt parts take {reserved} tokens, over the budget of {self.budget} tokens")
+        if self.count(content) <= available:
+            return content, None
+
+        chunks = split_into_chunks(content, min(self.max_chunk_tokens, available), self.model)
+        selected, used = [], 0
+        for index in rank_chunks(chunks, query):
+            tokens = self.count(chunks[index])
+            if used + tokens <= available:
+                selected.append(index)
+                used += tokens
+        return '\n\n'.join(chunks[index] for index in sorted(selected)), (used, available, len(selected), len(chunks))
+
+    @staticmethod
+    def log_packing(query: str, packing: Optional[Tuple[int, int, int, int]]):
+        # Logged by the caller, worker processes have no logging configured
+        if packing:
+            used, available, kept, total = packing
+            logging.info(f"Packed content for '{query}' into {used}/{available} tokens, "
+                         f"keeping {kept} of {total} chunks")
+
+class BudgetedChatClient:
+    """Wraps a chat client and refuses prompts over the token budget before any call is made"""
+
+    def __init__(self, client, packer: ContextPacker):
+        self.client = client
+        self.packer = packer
+
+    async def chat(self, prompt: str, **kwargs) -> str:
+        tokens = await count_call_tokens('prompt', prompt, self.packer.count_async)
+        if tokens > self.packer.budget:
+            raise ContextBudgetError(
+                f"Prompt has {tokens} tokens, over the budget of {self.packer.budget} tokens")
+        return await self.client.chat(prompt=prompt, **kwargs)
@@ -0,0 +1,74 @@
+import os
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+'''
+# Executors
+
+Everything that runs in the event loop thread blocks every other composer in the process. Work
+that is not waiting on the model is therefore offloaded:
+
+- CPU-bound stages (token counting and context packing of large payloads) go to a process pool,
+  so they also run outside the GIL.
+- Blocking I/O (project walks, file reads and writes, serializing large artifacts) goes to a
+  thread pool.
+
+Both pools are process-wide and created on first use, and the entry points (writing.py,
+batch_writing.py) shut them down with shutdown_executors() when the run ends. Functions sent to
+the process pool and their arguments must be picklable (module-level functions, plain data). With
+cpu_workers=0 CPU-bound stages run in the thread pool instead, e.g. where subprocesses are not
+allowed.
+'''
+
+_cpu_workers: Optional[int] = None
+_io_workers: Optional[int] = None
+_process_pool: Optional[Executor] = None
+_thread_pool: Optional[ThreadPoolExecutor] = None
+
+def default_cpu_workers() -> int:
+    return max(1, min(4, (os.cpu_count() or 2) - 1))
+
+def configure_executors(cpu_workers: Optional[int] = None, io_workers: Optional[int] = None):
+    """Set the pool sizes (None keeps the defaults); takes effect for pools not yet created"""
+    global _cpu_workers, _io_workers
+    _cpu_workers = cpu_workers
+    _io_workers = io_workers
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=_io_workers or 16, thread_name_prefix="paper_agent_io")
+    return _thread_pool
+
+def get_process_pool() -> Executor:
+    global _process_pool
+    if _process_pool is None:
+        if _cpu_workers == 0:
+            _process_pool = get_thread_pool()
+        else:
+            # spawn: forking a process that runs an event loop and worker threads is unsafe
+            _process_pool = ProcessPoolExecutor(max_workers=_cpu_workers or default_cpu_workers(),
+                                                mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+async def run_cpu(func: Callable, *args, **kwargs) -> Any:
+    """Run func(*args, **kwargs) in the process pool"""
+    return await asyncio.get_running_loop().run_in_executor(
+        get_process_pool(), functools.partial(func, *args, **kwargs))
+
+async def run_io(func: Callable, *args, **kwargs) -> Any:
+    """Run func(*args, **kwargs) in the thread pool"""
+    return await asyncio.get_running_loop().run_in_executor(
+        get_thread_pool(), functools.partial(func, *args, **kwargs))
+
+def shutdown_executors():
+    """Shut down both pools, waiting for running work; they are recreated if used again"""
+    global _process_pool, _thread_pool
+    if _process_pool is not None and _process_pool is not _thread_pool:
+        _process_pool.shutdown()
+    if _thread_pool is not None:
+        _thread_pool.shutdown()
+    _process_pool = _thread_pool = None
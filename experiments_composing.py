@@ -1,12 +1,17 @@
 import os
 import json
+import fnmatch
 import asyncio
 import logging
+from typing import List
 from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.openai_utils import GPTClient
 from section_composer import SectionComposer, setup_logging
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW
+from project_index import ProjectIndex
+from results_extractor import ResultsTable, extract_project_outputs, fill_result_tables, unsupported_numbers
+from results_store import ResultsStore, results_db_path
 
 '''
 # Experiments Composition Flow
@@ -24,7 +29,8 @@ graph TD
     
     compose_section --> generate_project_summary[Generate Project Summary]
     
-    compose_section --> read_agent_files[Read Agent Files]
+    compose_section --> results_store[Ingest Agent Iterations into Results Store]
+    results_store --> read_agent_files[Read Latest Agent Files]
     read_agent_files --> experiment_analysis_agent[Experiment Analysis Agent]
     read_agent_files --> machine_learning_agent[Machine Learning Agent]
     
@@ -32,8 +38,8 @@ graph TD
     
     subgraph "Iterative Structure Generation"
         structure_generation --> generate_or_revise[generate_or_revise_structure]
-        generate_or_revise --> find_and_fill_results[find_and_fill_results]
-        find_and_fill_results --> write_temp_log[Write Temp Log]
+        generate_or_revise --> fill_results[fill_results]
+        fill_results --> write_temp_log[Write Temp Log]
         write_temp_log --> save_checkpoint[Save Checkpoint]
     end
     
@@ -60,44 +66,27 @@ and agent outputs to extract experimental details, results, and insights for pre
 '''
 
 class ExperimentsComposer(SectionComposer):
-    def __init__(self, research_field: str, structure_iterations: int = 3, gpt_model='gpt-4o-mini-2024-07-18'):
-        super().__init__(research_field, "experiments", structure_iterations)
-
-    def read_project_structure(self, project_dir):
-        """Read entire project directory structure and code files"""
-        dir_tree = []
-        code_contents = []
-        
-        for root, dirs, files in os.walk(project_dir):
-            # Skip system directories
-            dirs[:] = [d for d in dirs if not d.startswith(('__', '.', 'cache'))]
-            
-            rel_path = os.path.relpath(root, project_dir)
-            if rel_path == '.':
-                rel_path = ''
-                
-            current_dir = []
-            for f in files:
-                if f.endswith('.py'):
-                    try:
-                        filepath = os.path.join(root, f)
-                        with open(filepath, 'r', encoding='utf-8') as file:
-                            content = file.read()
-                            code_contents.append({
-                                'path': os.path.join(rel_path, f),
-                                'content': content
-                            })
-                    except Exception as e:
-                        logging.error(f"Error reading file {f}: {str(e)}")
-                current_dir.append(f)
-            
-            if current_dir or dirs:
-                dir_tree.append({
-                    'path': rel_path,
-                    'files': current_dir,
-                    'dirs': dirs
-                })
-                
+    # Focus on experiment-related agent files; every iteration is ingested into the results store
+    # and the prompts read the latest iteration of each agent, see results_store.py
+    AGENT_FILES = [
+        'experiment_analysis_agent_iter_*.json',
+        'machine_learning_agent_iter_*.json',
+    ]
+
+    def __init__(self, research_field: str, structure_iterations: int = 3, gpt_model='gpt-4o-mini-2024-07-18', **kwargs):
+        super().__init__(research_field, "experiments", structure_iterations, gpt_model=gpt_model, **kwargs)
+        self.project_fingerprint = None
+
+    def read_project_structure(self, project_dir, index_path=None):
+        """Read project directory structure and code files.
+
+        Files are read through a ProjectIndex persisted at index_path, so only files changed since
+        the last run are read again. The project fingerprint is kept in self.project_fingerprint;
+        structure and subsection checkpoints written for a different fingerprint are not reused.
+        """
+        project_index = ProjectIndex(index_path)
+        dir_tree, code_contents = project_index.scan(project_dir)
+        self.project_fingerprint = project_index.fingerprint
         return dir_tree, code_contents
 
     def generate_project_summary(self, dir_tree, code_contents):
@@ -161,6 +150,7 @@ Guidelines for structure generation:
    - Each experiment subsection is to test the performance of the proposed method from certain dimension. Each experiment subsection should include the purpose and methodology, the experimental results, as well as findings and insights based on analyzing the results. Please list subsection
    - Don't create subsections other than the above two types (e.g. discussion for related works, experiment summary without specific evaluation results, future work).
    - The comments should include detailed information collected from input files as much as possible, but no need to well-present them in certain paper-writing form
+   - Result tables can be LaTeX tabular environments with the metrics as columns and the methods or variants as rows; write -- in cells whose value is not given in the input files
 
 Output the LaTeX structure with detailed comments as specified above. Do not include any other contents."""
 
@@ -213,8 +203,80 @@ Output the complete LaTeX structure with actual results filled in, keeping all o
         
         return updated_structure
 
+    async def fill_unresolved_results(self, structure: str, results_table: str, unresolved) -> str:
+        """Fill the results the extractor could not place, from the extracted results only."""
+        cells = '\n'.join(f"- row \"{row}\", column \"{column}\"" for row, column in unresolved)
+        prompt = f"""Fill in specific numerical experimental results into the LaTeX structure for experiments section.
+
+Current structure with comments:
+{structure}
+
+Extracted results (tab-separated: experiment, variant, dataset, metric, value, source):
+{results_table}
+
+Table cells that are still empty:
+{cells or "None. Place the results in the comments of the matching experiments instead."}
+
+Requirements:
+1. Only use values from the extracted results, copied exactly as given. Never compute, round or invent a value.
+2. Fill a cell only if exactly one extracted result matches its row and column; otherwise leave its placeholder.
+3. For experiments without a table, list their extracted results in the comments.
+4. Keep all section titles, hierarchy, comments and already filled values unchanged.
+
+Output the complete LaTeX structure with the results filled in, keeping all other content unchanged. Do not include any other contents."""
+
+        return await self.gpt_client.chat(prompt=prompt)
+
+    def open_results_store(self, agent_dir: str, checkpoint_dir: str) -> ResultsStore:
+        """The instance's results store, updated with the agent iteration files"""
+        store = ResultsStore(results_db_path(checkpoint_dir))
+        ingested, unchanged = store.ingest(agent_dir)
+        logging.info(f"Results store: ingested {ingested} agent iteration files, {unchanged} unchanged")
+        return store
+
+    def select_agent_files(self, store: ResultsStore) -> List[str]:
+        """Latest iteration file of every agent matching AGENT_FILES"""
+        return [name for name in store.latest_files()
+                if any(fnmatch.fnmatch(name, pattern) for pattern in self.AGENT_FILES)]
+
+    async def fill_results(self, structure: str, store: ResultsStore, agent_dir: str, agent_files,
+                           project_dir: str, project_summary: str) -> str:
+        """Fill experimental results into the structure.
+
+        The latest result of every variant in each experiment is taken from the results store,
+        the project's output files are read without the model, and both are filled into the
+        structure's table skeletons directly, see results_extractor.py. The model is only asked
+        for what could not be placed, and is given the results table instead of the agent files.
+        Without any results, every agent file and the project summary are passed to
+        find_and_fill_results as before."""
+        table = ResultsTable(store.latest())
+        table.extend(await self.run_io(extract_project_outputs, project_dir))
+        if not table.records:
+            logging.info("No results extracted, finding results with the model")
+            for agent_file in agent_files:
+                if os.path.exists(os.path.join(agent_dir, agent_file)):
+                    structure = await self.find_and_fill_results(
+                        self.agent_store.load(agent_dir, agent_file).text, structure, self.structure_iterations + 1)
+            return await self.find_and_fill_results(
+                await self.pack_content(project_summary, self.section_name, structure), structure,
+                self.structure_iterations + 1)
+
+        results_table = table.render()
+        self.write_temp_log(results_table, "results_table")
+        filled_structure, filled, unresolved = fill_result_tables(structure, table)
+        logging.info(f"Filled {filled} result cells from {len(table)} extracted results, "
+                     f"{len(unresolved)} cells unresolved")
+        if filled and not unresolved:
+            return filled_structure
+
+        updated_structure = await self.fill_unresolved_results(filled_structure, results_table, unresolved)
+        unsupported = unsupported_numbers(updated_structure, table, filled_structure)
+        if unsupported:
+            logging.warning(f"Results filled by the model not found in the extracted results: {unsupported}")
+        return updated_structure
+
     async def detailize_subsection(self, structure: str, current_text: str, content: str, subsection: str) -> str:
-        writing_template = self.get_random_template()
+        writing_template = await self.select_template(f"{subsection}\n{current_text}\n{content}")
         
         prompt = f"""Write or revise the following subsection of the experiments section:
 \subsection{{{subsection}}}
@@ -272,7 +334,7 @@ Requirements for experiments writing:
 
 Output the detailed LaTeX text for this subsection only. Do not include any other content"""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_LOW)
 
     async def final_writing_checklist(self, experiments_text: str) -> str:
         prompt = f"""Review and revise the experiments section following these academic writing guidelines:
@@ -315,7 +377,7 @@ REVISION REQUIREMENTS:
 
 Output the revised experiments section incorporating all these improvements. Reply with LaTeX code only."""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_HIGH)
 
     async def compose_section(self, agent_dir: str, proj_dir: str, benchmark_path: str, target_paper: str) -> str:
         checkpoint_dir = self.get_checkpoint_path(target_paper)
@@ -326,94 +388,112 @@ Output the revised experiments section incorporating all these improvements. Rep
         # model_dir = os.path.join(workplace_dir, 'model/')
         
         # Read project structure and contents
-        dir_tree, code_contents = self.read_project_structure(workplace_dir)
+        dir_tree, code_contents = await self.run_io(
+            self.read_project_structure, workplace_dir, os.path.join(checkpoint_dir, "project_index.json"))
+        logging.info(f"Project fingerprint: {self.project_fingerprint}")
 
-        project_summary = '***Directory Tree***:\n' + str(dir_tree) + '\n\n' + '***Code Contents***:\n' + str(code_contents)
+        # One block per code file so the context packer can keep the files relevant to each prompt
+        project_summary = '***Directory Tree***:\n' + str(dir_tree) + '\n\n' + '***Code Contents***:\n' + '\n'.join(
+            f"# File: {code['path']}\n{code['content']}\n" for code in code_contents)
         self.write_temp_log(project_summary, "project_summary")
 
-        # Focus on experiment-related agent files
-        agent_files = [
-            'experiment_analysis_agent_iter_refine_1.json',
-            'machine_learning_agent_iter_refine_1.json',
-            'experiment_analysis_agent_iter_refine_2.json',
-            'machine_learning_agent_iter_refine_2.json',
-        ]
-
-        # Step 1: Iterative structure generation
-        structure = ""
-        structure_checkpoint = self.load_checkpoint(target_paper, "structure")
+        results_store = await self.run_io(self.open_results_store, agent_dir, checkpoint_dir)
+        try:
+            agent_files = self.select_agent_files(results_store)
+            results_summary = results_store.summary() if results_store.query() else None
+
+            # Step 1: Iterative structure generation
+            self.set_trace_stage("structure")
+            structure = ""
+            structure_checkpoint = self.load_checkpoint(target_paper, "structure")
+            # Checkpoints written for different project code are stale, and so are the subsections
+            # detailized from them
+            project_changed = (structure_checkpoint is not None and
+                               structure_checkpoint.get("project_fingerprint", self.project_fingerprint)
+                               != self.project_fingerprint)
+            if project_changed:
+                logging.info("Project code changed since the structure checkpoint, regenerating the structure")
+                structure_checkpoint = None
         
-        if structure_checkpoint:
-            structure = structure_checkpoint["final_structure"]
-            logging.info("Loaded structure from checkpoint")
-        else:
-            for iteration in range(self.structure_iterations + 1):
-                if iteration < self.structure_iterations:
-                    temp_func = self.generate_or_revise_structure
-                else:
-                    temp_func = self.find_and_fill_results
-                logging.info(f"Structure iteration {iteration + 1}/{self.structure_iterations + 1}")
+            if structure_checkpoint:
+                structure = structure_checkpoint["final_structure"]
+                logging.info("Loaded structure from checkpoint")
+            else:
+                for iteration in range(self.structure_iterations):
+                    self.set_trace_stage("structure", iteration + 1)
+                    logging.info(f"Structure iteration {iteration + 1}/{self.structure_iterations + 1}")
                 
-                for idx, agent_file in enumerate(tqdm(agent_files, desc="Processing agent files")):
-                    # Check if file exists before trying to read it
-                    agent_file_path = os.path.join(agent_dir, agent_file)
-                    if not os.path.exists(agent_file_path):
-                        logging.warning(f"Agent file {agent_file} not found. Skipping.")
-                        continue
+                    for idx, agent_file in enumerate(tqdm(agent_files, desc="Processing agent files")):
+                        # Check if file exists before trying to read it
+                        agent_file_path = os.path.join(agent_dir, agent_file)
+                        if not os.path.exists(agent_file_path):
+                            logging.warning(f"Agent file {agent_file} not found. Skipping.")
+                            continue
                         
-                    with open(agent_file_path, 'r') as f:
-                        content = json.load(f)
-                    structure = await temp_func(json.dumps(content, indent=2), structure, iteration + 1)
+                        content = self.agent_store.load(agent_dir, agent_file).text
+                        structure = await self.generate_or_revise_structure(content, structure, iteration + 1)
+
+                    # Results of all iterations, earlier ones included
+                    if results_summary:
+                        structure = await self.generate_or_revise_structure(results_summary, structure, iteration + 1)
                 
-                structure = await temp_func(
-                    project_summary, structure, iteration + 1)
+                    structure = await self.generate_or_revise_structure(
+                        await self.pack_content(project_summary, self.section_name, structure), structure, iteration + 1)
                 
-                self.write_temp_log(structure, f"iteration_{iteration+1}_final")
+                    self.write_temp_log(structure, f"iteration_{iteration+1}_final")
+
+                # Fill the results into the structure
+                self.set_trace_stage("find_and_fill_results")
+                logging.info(f"Structure iteration {self.structure_iterations + 1}/{self.structure_iterations + 1}")
+                structure = await self.fill_results(
+                    structure, results_store, agent_dir, agent_files, workplace_dir, project_summary)
+                self.write_temp_log(structure, f"iteration_{self.structure_iterations + 1}_final")
             
-            self.save_checkpoint(target_paper, "structure", {
-                "final_structure": structure
-            })
-
-        # Step 2: Detailize subsections
-        subsections = [line.split('{')[1].split('}')[0] 
-                    for line in structure.split('\n') 
-                    if line.strip().startswith('\\subsection')]
+                self.save_checkpoint(target_paper, "structure", {
+                    "final_structure": structure,
+                    "project_fingerprint": self.project_fingerprint
+                })
+
+            # Step 2: Detailize subsections
+            self.set_trace_stage("detailize")
+            subsections = self.get_subsections(structure)
         
-        subsection_contents = {}
-        subsection_checkpoint = self.load_checkpoint(target_paper, "subsections")
+            subsection_contents = {}
+            subsection_checkpoint = None if project_changed else self.load_checkpoint(target_paper, "subsections")
         
-        if subsection_checkpoint:
-            subsection_contents = subsection_checkpoint
-            logging.info("Loaded subsection contents from checkpoint")
-        else:
-            for subsection_id, subsection in enumerate(tqdm(subsections, desc="Detailizing subsections")):
-                experiments_part = ''
-                
-                # First process agent contents
-                for i, agent_file in enumerate(agent_files):
-                    # Check if file exists before trying to read it
-                    agent_file_path = os.path.join(agent_dir, agent_file)
-                    if not os.path.exists(agent_file_path):
-                        logging.warning(f"Agent file {agent_file} not found. Skipping.")
-                        continue
+            if subsection_checkpoint:
+                subsection_contents = subsection_checkpoint
+                logging.info("Loaded subsection contents from checkpoint")
+            else:
+                async def detailize(subsection_id, subsection):
+                    # First process agent contents
+                    steps = []
+                    for i, agent_file in enumerate(agent_files):
+                        # Check if file exists before trying to read it
+                        agent_file_path = os.path.join(agent_dir, agent_file)
+                        if not os.path.exists(agent_file_path):
+                            logging.warning(f"Agent file {agent_file} not found. Skipping.")
+                            continue
                         
-                    with open(agent_file_path, 'r') as f:
-                        content = json.load(f)
-                    experiments_part = await self.detailize_subsection(
-                        structure, experiments_part, json.dumps(content, indent=2), subsection)
-                    
-                    self.write_temp_log(
-                        experiments_part,
-                        f"subsection_{subsection_id}_agent_{i}"
-                    )
-                experiments_part = await self.detailize_subsection(structure, experiments_part, project_summary, subsection)
-                subsection_contents[subsection] = experiments_part
-                
-            self.save_checkpoint(target_paper, "subsections", subsection_contents)
+                        steps.append((f"agent_{i}", self.agent_store.load(agent_dir, agent_file).text))
+                    if results_summary:
+                        steps.append(("results", results_summary))
+                    steps.append(("project", project_summary))
+
+                    return await self.fold_into_subsection(
+                        structure, subsection, subsection_id, steps, step_log=step_log)
+
+                step_log = self.open_step_log(target_paper, structure)
+                subsection_contents = await self.detailize_subsections(subsections, detailize)
+                self.save_checkpoint(target_paper, "subsections", subsection_contents)
+                step_log.clear()
+        finally:
+            results_store.close()
 
         # Step 3: Fuse all subsections
+        self.set_trace_stage("fuse")
         self.write_temp_log(
-            json.dumps(subsection_contents, indent=2),
+            await self.dumps_json(subsection_contents),
             "pre_fusion_subsections"
         )
         
@@ -421,24 +501,19 @@ Output the revised experiments section incorporating all these improvements. Rep
         self.write_temp_log(fused_experiments, "post_fusion_experiments")
 
         # Step 4: Final writing checklist
+        self.set_trace_stage("checklist")
         final_experiments = await self.final_writing_checklist(fused_experiments)
         self.write_temp_log(final_experiments, "post_checklist_experiments")
 
         # Save final output
-        output_dir = f"{self.research_field}/target_sections/{self.normalize_title(target_paper)}"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "experiments.tex")
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(final_experiments)
-        logging.info(f"Saved final experiments to {output_path}")
+        self.save_section_output(target_paper, final_experiments)
 
         return final_experiments
 
-async def experiments_composing(research_field: str, instance_id: str):
+async def experiments_composing(research_field: str, instance_id: str, **composer_options):
     setup_logging(research_field)
     
-    composer = ExperimentsComposer(research_field=research_field, structure_iterations=1)#, gpt_model='o1-mini-2024-09-12')
+    composer = ExperimentsComposer(research_field=research_field, structure_iterations=1, **composer_options)#, gpt_model='o1-mini-2024-09-12')
     
     # Use local paths instead of hardcoded absolute paths
     proj_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), research_field, instance_id)
@@ -5,8 +5,8 @@ import logging
 from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.openai_utils import GPTClient
 from section_composer import SectionComposer, setup_logging
+from rate_limiter import PRIORITY_HIGH
 
 '''
 # Introduction Composition Flow
@@ -55,19 +55,10 @@ existing sections and benchmark data to create a coherent introduction for the p
 '''
 
 class IntroductionComposer(SectionComposer):
-    def __init__(self, research_field: str, structure_iterations: int = 3):
-        super().__init__(research_field, "introduction", structure_iterations)
+    INPUT_SECTIONS = ['methodology', 'related_work', 'experiments']
 
-    def read_section_content(self, target_paper: str, section_name: str) -> str:
-        """Read content from an existing section file"""
-        normalized_title = self.normalize_title(target_paper)
-        section_path = f"{self.research_field}/target_sections/{normalized_title}/{section_name}.tex"
-        try:
-            with open(section_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            logging.warning(f"Section file {section_path} not found")
-            return ""
+    def __init__(self, research_field: str, structure_iterations: int = 3, **kwargs):
+        super().__init__(research_field, "introduction", structure_iterations, **kwargs)
 
     def find_task1_content(self, benchmark_path: str, target_paper: str) -> str:
         """Find the task1 content for the target paper from benchmark dataset"""
@@ -133,7 +124,7 @@ Output only the LaTeX structure with comments as specified above."""
         return await self.gpt_client.chat(prompt=prompt)
 
     async def detailize_subsection(self, structure, current_text, content, subsection=None):
-        writing_template = self.get_random_template()
+        writing_template = await self.select_template(f"{subsection or ''}\n{structure}\n{content}")
         prompt = f"""Write a comprehensive introduction section based on the provided structure and content.
 
 CURRENT INTRODUCTION VERSION (if any):
@@ -228,22 +219,23 @@ CHECKLIST FOR REVISION:
 
 Output the revised introduction section incorporating all these improvements. Reply with LaTeX text only."""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_HIGH)
 
     async def compose_section(self, benchmark_path: str, target_paper: str) -> str:
         checkpoint_dir = self.get_checkpoint_path(target_paper)
         os.makedirs(checkpoint_dir, exist_ok=True)
 
         # Read existing sections
-        methodology = self.read_section_content(target_paper, "methodology")
-        related_work = self.read_section_content(target_paper, "related_work")
-        experiments = self.read_section_content(target_paper, "experiments")
+        methodology = await self.read_section_content(target_paper, "methodology")
+        related_work = await self.read_section_content(target_paper, "related_work")
+        experiments = await self.read_section_content(target_paper, "experiments")
         content_bundle = methodology + '\n\n' + experiments + '\n\n' + related_work
 
         # Get task1 content from benchmark
         task1_content = self.find_task1_content(benchmark_path, target_paper)
 
         # Step 1: Iterative structure generation
+        self.set_trace_stage("structure")
         structure = ""
         structure_checkpoint = self.load_checkpoint(target_paper, "structure")
         
@@ -252,6 +244,7 @@ Output the revised introduction section incorporating all these improvements. Re
             logging.info("Loaded structure from checkpoint")
         else:
             for iteration in range(self.structure_iterations):
+                self.set_trace_stage("structure", iteration + 1)
                 logging.info(f"Structure iteration {iteration + 1}/{self.structure_iterations}")
                 
                 structure = await self.generate_or_revise_structure(
@@ -268,6 +261,7 @@ Output the revised introduction section incorporating all these improvements. Re
             })
 
         # Step 2: Write complete introduction
+        self.set_trace_stage("detailize")
         introduction = ""
         introduction = await self.detailize_subsection(structure, content_bundle, introduction)
         if task1_content:
@@ -276,24 +270,19 @@ Output the revised introduction section incorporating all these improvements. Re
         self.write_temp_log(introduction, "initial_introduction")
 
         # Step 3: Final writing checklist
+        self.set_trace_stage("checklist")
         final_introduction = await self.final_writing_checklist(introduction)
         self.write_temp_log(final_introduction, "final_introduction")
 
         # Save final output
-        output_dir = f"{self.research_field}/target_sections/{self.normalize_title(target_paper)}"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "introduction.tex")
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(final_introduction)
-        logging.info(f"Saved final introduction to {output_path}")
+        self.save_section_output(target_paper, final_introduction)
 
         return final_introduction
 
-async def introduction_composing(research_field: str, instance_id: str):
+async def introduction_composing(research_field: str, instance_id: str, **composer_options):
     setup_logging(research_field)
     
-    composer = IntroductionComposer(research_field=research_field, structure_iterations=1)
+    composer = IntroductionComposer(research_field=research_field, structure_iterations=1, **composer_options)
     
     # target_paper = 'Heterogeneous Graph Contrastive Learning for Recommendation'
     # benchmark_path = '../benchmark_collection/advance_graph/merged_papers_with_fields.json'
@@ -0,0 +1,194 @@
+import re
+import hashlib
+from collections import OrderedDict
+from typing import Iterator, List, Optional
+
+'''
+# LaTeX Outline
+
+Section structures are LaTeX skeletons: \\section, \\subsection and \\subsubsection headings, each
+followed by a block of `%` comments describing what goes there. The model often wraps them in
+```latex fences. parse_outline() reads a structure in one pass into a tree of headings with their
+comment blocks; get_outline() caches the tree per structure, so every composer step that needs
+the subsections of a structure shares one parse.
+'''
+
+HEADING_LEVELS = {'section': 1, 'subsection': 2, 'subsubsection': 3}
+HEADING_PATTERN = re.compile(r'\\(subsubsection|subsection|section)(\*?)\s*(?:\[[^\]]*\]\s*)?\{')
+COMMENT_PATTERN = re.compile(r'(?<!\\)%')
+# Parsed outlines kept by get_outline()
+MAX_CACHED_OUTLINES = 256
+
+class OutlineNode:
+    def __init__(self, kind: str, title: str = "", starred: bool = False, heading: str = ""):
+        self.kind = kind
+        self.level = HEADING_LEVELS.get(kind, 0)
+        self.title = title
+        self.starred = starred
+        # The heading line as written, and the lines up to the next heading
+        self.heading = heading
+        self.lines: List[str] = []
+        self.children: List['OutlineNode'] = []
+        self.parent: Optional['OutlineNode'] = None
+
+    @property
+    def comments(self) -> List[str]:
+        """Text of the `%` comment block under the heading (including a comment on the heading line)"""
+        comments = []
+        heading_comment = split_comment(self.heading)
+        if heading_comment is not None:
+            comments.append(heading_comment)
+        for line in self.lines:
+            if line.lstrip().startswith('%'):
+                comments.append(split_comment(line))
+        return comments
+
+    @property
+    def heading_only(self) -> str:
+        """The heading line without its comment"""
+        comment = COMMENT_PATTERN.search(self.heading)
+        return (self.heading[:comment.start()] if comment else self.heading).rstrip()
+
+    def walk(self) -> Iterator['OutlineNode']:
+        """This node and all nodes below it, in document order"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def render(self, max_level: int = 3, with_body: bool = True) -> str:
+        """LaTeX of this node and its descendants down to max_level, optionally without the
+        lines under the headings"""
+        lines = []
+        for node in self.walk():
+            if node.level > max_level:
+                continue
+            if node.heading:
+                lines.append(node.heading)
+            if with_body:
+                lines.extend(node.lines)
+        return '\n'.join(lines).strip('\n')
+
+    def __repr__(self):
+        return f"OutlineNode({self.kind!r}, {self.title!r}, children={len(self.children)})"
+
+class Outline:
+    def __init__(self, root: OutlineNode):
+        self.root = root
+
+    def nodes(self, kind: Optional[str] = None) -> List[OutlineNode]:
+        return [node for node in self.root.walk() if node is not self.root and (kind is None or node.kind == kind)]
+
+    def titles(self, kind: str = 'subsection') -> List[str]:
+        """Titles of all headings of one kind, in document order"""
+        return [node.title for node in self.nodes(kind)]
+
+    def find(self, title: str, kind: str = 'subsection') -> Optional[OutlineNode]:
+        """First heading of kind with the given title (compared ignoring surrounding whitespace)"""
+        title = title.strip()
+        for node in self.nodes(kind):
+            if node.title.strip() == title:
+                return node
+        return None
+
+    def focus(self, title: str, kind: str = 'subsection') -> Optional[str]:
+        """The structure as seen from one heading: that heading's subtree in full, the comment
+        blocks of the headings above it and of the other headings in the same subsection (e.g.
+        the sibling subsubsections of a focused subsubsection), and every other heading as a bare
+        title line.
+
+        Returns None if there is no such heading."""
+        target = self.find(title, kind)
+        if target is None:
+            return None
+        ancestors = set()
+        subsection = target
+        node = target.parent
+        while node is not None:
+            ancestors.add(id(node))
+            if node.level >= HEADING_LEVELS['subsection']:
+                subsection = node
+            node = node.parent
+        focused = {id(node) for node in target.walk()}
+        commented = ancestors | {id(node) for node in subsection.walk()}
+
+        lines = []
+        for node in self.root.walk():
+            if node is self.root:
+                continue
+            if id(node) in focused:
+                lines.append(node.heading)
+                lines.extend(node.lines)
+            elif id(node) in commented:
+                lines.append(node.heading)
+                lines.extend(line for line in node.lines if line.lstrip().startswith('%'))
+            else:
+                lines.append(node.heading_only)
+        return '\n'.join(lines).strip('\n')
+
+def split_comment(line: str) -> Optional[str]:
+    """Text after the first unescaped `%` of line, or None if there is none"""
+    match = COMMENT_PATTERN.search(line)
+    if match is None:
+        return None
+    return line[match.end():].strip()
+
+def read_braced(text: str, start: int) -> Optional[int]:
+    """Index just past the brace group that opened before start, or None if it is not closed"""
+    depth = 1
+    index = start
+    while index < len(text):
+        char = text[index]
+        if char == '\\':
+            index += 2
+            continue
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return None
+
+def parse_outline(text: str) -> Outline:
+    """Parse the section/subsection/subsubsection headings of a LaTeX structure into a tree.
+
+    Headings may be starred, have an optional short title and contain nested braces. Code fence
+    lines (```latex, ```) are dropped, and text after the last heading stays with it. A heading
+    without a parent of the level above is attached to the closest shallower heading.
+    """
+    root = OutlineNode('document')
+    stack = [root]
+    for line in text.split('\n'):
+        if line.strip().startswith('```'):
+            continue
+        # Headings inside comments do not count
+        comment = COMMENT_PATTERN.search(line)
+        code = line[:comment.start()] if comment else line
+        match = HEADING_PATTERN.search(code)
+        end = read_braced(code, match.end()) if match else None
+        if match is None or end is None:
+            stack[-1].lines.append(line)
+            continue
+        kind = match.group(1)
+        node = OutlineNode(kind, line[match.end():end - 1].strip(), bool(match.group(2)), line)
+        while stack[-1].level >= node.level:
+            stack.pop()
+        node.parent = stack[-1]
+        stack[-1].children.append(node)
+        stack.append(node)
+    return Outline(root)
+
+_outlines: 'OrderedDict[str, Outline]' = OrderedDict()
+
+def get_outline(text: str) -> Outline:
+    """Parsed outline of a structure, shared by all callers (do not modify it)"""
+    key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    outline = _outlines.get(key)
+    if outline is None:
+        outline = _outlines[key] = parse_outline(text)
+        if len(_outlines) > MAX_CACHED_OUTLINES:
+            _outlines.popitem(last=False)
+    else:
+        _outlines.move_to_end(key)
+    return outline
@@ -0,0 +1,41 @@
+import math
+from collections import Counter
+from typing import List
+
+from context_packer import tokenize_terms
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of documents.
+
+    Queries can be whole payloads (agent outputs, paper text), so every distinct query term is
+    counted once and terms that do not occur in any document are ignored."""
+
+    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize_terms(document)) for document in documents]
+        self.lengths = [sum(terms.values()) for terms in self.term_frequencies]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        document_frequency = Counter()
+        for terms in self.term_frequencies:
+            document_frequency.update(terms.keys())
+        count = len(documents)
+        self.idf = {term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+                    for term, frequency in document_frequency.items()}
+
+    def __len__(self):
+        return len(self.term_frequencies)
+
+    def scores(self, query: str) -> List[float]:
+        query_terms = [term for term in set(tokenize_terms(query)) if term in self.idf]
+        scores = []
+        for terms, length in zip(self.term_frequencies, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+            scores.append(sum(self.idf[term] * terms[term] * (self.k1 + 1) / (terms[term] + norm)
+                              for term in query_terms if terms[term]))
+        return scores
+
+    def rank(self, query: str) -> List[int]:
+        """Document indices from most to least relevant, ties kept in document order"""
+        scores = self.scores(query)
+        return sorted(range(len(scores)), key=lambda index: (-scores[index], index))
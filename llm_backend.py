@@ -0,0 +1,213 @@
+import os
+import json
+import random
+import asyncio
+import time
+import hashlib
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_cache import SAMPLING_PARAMS, ResponseCache
+from context_packer import count_tokens_async, tokenize_terms
+from telemetry import count_call_tokens
+
+'''
+# LLM Backends
+
+Composers talk to the model through a backend with the GPTClient interface
+(`await backend.chat(prompt=..., **kwargs)`):
+
+- `openai`: utils.openai_utils.GPTClient, the real model.
+- `batch`: calls collected into batch jobs, see batch_backend.py.
+- `local`: an offline stand-in that needs no network. It replays responses recorded in an LLM
+  response cache directory (`{research_field}/llm_cache` of an earlier run) and synthesizes
+  deterministic LaTeX-shaped output for everything else, with configurable latency (fixed or
+  drawn from a distribution) and length.
+  It is meant for measuring orchestration overhead, concurrency and cache behaviour of the
+  pipeline, not for writing papers.
+'''
+
+# Usage totals and local call intervals of the process. Kept here rather than by registering
+# every backend, which would keep the backends of all composers of a batch alive
+_usage: Dict[str, int] = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+_intervals: List[Tuple[float, float]] = []
+
+class LLMBackend(ABC):
+    name = ""
+    # Whether calls are admitted by the per-model rate limiter (see rate_limiter.py)
+    rate_limited = True
+
+    def __init__(self, model: str):
+        self.model = model
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def cache_model(self) -> str:
+        """Model name used in response cache keys, so different backends never share responses"""
+        return self.model
+
+    @abstractmethod
+    async def chat(self, prompt: str, **kwargs) -> str:
+        pass
+
+    async def count_tokens(self, text: str) -> int:
+        return await count_tokens_async(text, self.model)
+
+    async def record_usage(self, prompt: str, response: str):
+        # Counted once per call, by whichever client layer needs a count first (see telemetry.py)
+        prompt_tokens = await count_call_tokens('prompt', prompt, self.count_tokens)
+        completion_tokens = await count_call_tokens('completion', response, self.count_tokens)
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        _usage['calls'] += 1
+        _usage['prompt_tokens'] += prompt_tokens
+        _usage['completion_tokens'] += completion_tokens
+
+    def usage(self) -> Dict:
+        return {
+            'backend': self.name,
+            'model': self.model,
+            'calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+        }
+
+class OpenAIBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, model: str):
+        super().__init__(model)
+        # Imported here so the pipeline can run offline without the OpenAI client installed
+        from utils.openai_utils import GPTClient
+        self.client = GPTClient(model=model)
+
+    async def chat(self, prompt: str, **kwargs) -> str:
+        response = await self.client.chat(prompt=prompt, **kwargs)
+        await self.record_usage(prompt, response)
+        return response
+
+# How LocalBackend draws the latency of a call; all have the configured latency as their mean
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+class LocalBackend(LLMBackend):
+    name = "local"
+
+    def __init__(self, model: str, replay_dir: Optional[str] = None, latency: float = 0.0,
+                 latency_distribution: str = "fixed", tokens_per_second: Optional[float] = None,
+                 completion_tokens: int = 400, subsections: int = 3):
+        """
+        Args:
+            model: Model name the responses are attributed to (and looked up under when replaying)
+            replay_dir: Response cache directory to replay recorded responses from
+            latency: Mean seconds a call takes before any tokens are produced
+            latency_distribution: One of LATENCY_DISTRIBUTIONS; draws are seeded by the prompt, so
+                a run is reproducible
+            tokens_per_second: Generation speed added on top of latency (None for instant output)
+            completion_tokens: Approximate length of synthesized responses
+            subsections: Number of subsections in synthesized responses
+        """
+        super().__init__(model)
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {latency_distribution!r}, expected one of {LATENCY_DISTRIBUTIONS}")
+        self.replay_dir = replay_dir
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens_target = completion_tokens
+        self.subsections = subsections
+        self.replayed = 0
+
+    @property
+    def cache_model(self) -> str:
+        return f"local/{self.model}"
+
+    async def chat(self, prompt: str, **kwargs) -> str:
+        started = time.monotonic()
+        response = self.replay(prompt, kwargs)
+        if response is None:
+            response = self.synthesize(prompt)
+        delay = self.call_latency(prompt)
+        if self.tokens_per_second:
+            delay += await count_call_tokens('completion', response, self.count_tokens) / self.tokens_per_second
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.record_usage(prompt, response)
+        _intervals.append((started, time.monotonic()))
+        return response
+
+    def call_latency(self, prompt: str) -> float:
+        if self.latency <= 0 or self.latency_distribution == "fixed":
+            return self.latency
+        rng = random.Random(hashlib.sha256(f"latency\n{prompt}".encode('utf-8')).hexdigest())
+        if self.latency_distribution == "uniform":
+            return rng.uniform(0, 2 * self.latency)
+        if self.latency_distribution == "exponential":
+            return rng.expovariate(1 / self.latency)
+        # Heavy right tail as seen with real endpoints, sigma 0.75
+        return self.latency * rng.lognormvariate(-0.75 ** 2 / 2, 0.75)
+
+    def replay(self, prompt: str, kwargs: Dict) -> Optional[str]:
+        if not self.replay_dir:
+            return None
+        params = {name: kwargs[name] for name in SAMPLING_PARAMS if name in kwargs}
+        path = os.path.join(self.replay_dir, f"{ResponseCache.make_key(self.model, prompt, params)}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            response = json.load(f)['response']
+        self.replayed += 1
+        return response
+
+    def synthesize(self, prompt: str) -> str:
+        """Deterministic LaTeX section built from the prompt's own vocabulary"""
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+        vocabulary = sorted(set(tokenize_terms(prompt))) or ['content']
+
+        def words(count):
+            return ' '.join(rng.choice(vocabulary) for _ in range(count))
+
+        # Roughly 1.3 tokens per word
+        words_per_subsection = max(8, int(self.completion_tokens_target / 1.3 / self.subsections))
+        lines = [f"\\section{{{words(2).title()}}}", f"% {words(12)}"]
+        for _ in range(self.subsections):
+            lines.append(f"\\subsection{{{words(3).title()}}}")
+            lines.append(f"% {words(12)}")
+            lines.append(words(words_per_subsection) + '.')
+        return '\n'.join(lines)
+
+    def usage(self) -> Dict:
+        usage = super().usage()
+        usage['replayed'] = self.replayed
+        return usage
+
+BACKENDS = {
+    OpenAIBackend.name: OpenAIBackend,
+    LocalBackend.name: LocalBackend,
+}
+
+BACKEND_NAMES = tuple(BACKENDS) + ("batch",)
+
+
+def create_backend(name: str, model: str, **options) -> LLMBackend:
+    if name == "batch":
+        # batch_backend builds on this module, so it is imported on demand
+        from batch_backend import BatchBackend
+        backend_class = BatchBackend
+    elif name in BACKENDS:
+        backend_class = BACKENDS[name]
+    else:
+        raise ValueError(f"Unknown LLM backend {name!r}, expected one of {BACKEND_NAMES}")
+    return backend_class(model, **options)
+
+def backend_usage() -> Dict[str, int]:
+    """Calls and tokens sent by all backends of the process (cache hits are not counted)"""
+    return dict(_usage)
+
+def call_intervals() -> List[Tuple[float, float]]:
+    """(start, end) monotonic times of every call of the local backends of the process, e.g. to
+    measure the critical path of a run"""
+    return list(_intervals)
@@ -0,0 +1,163 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from telemetry import note_call
+
+'''
+# LLM Response Cache
+
+Responses are stored on disk, one JSON file per response, named by the SHA-256 of
+(model, prompt, sampling params). Reruns of the pipeline therefore only pay for prompts that
+actually changed. The cache is bounded in bytes and evicts the least recently used responses;
+recency survives restarts through the files' modification times.
+'''
+
+# chat() keyword arguments that change the response and therefore take part in the cache key
+SAMPLING_PARAMS = ('temperature', 'top_p', 'max_tokens', 'presence_penalty', 'frequency_penalty',
+                   'stop', 'seed', 'response_format')
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+class ResponseCache:
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Requests currently being answered, so concurrent identical requests share one call
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> size in bytes, least recently used first
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        files = []
+        for filename in os.listdir(cache_dir):
+            if filename.endswith('.json'):
+                stat = os.stat(os.path.join(cache_dir, filename))
+                files.append((stat.st_mtime, filename[:-len('.json')], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+        self.total_bytes = sum(self.entries.values())
+
+    @staticmethod
+    def make_key(model: str, prompt: str, params: Optional[Dict] = None) -> str:
+        """Content address of a request"""
+        payload = json.dumps({'model': model, 'prompt': prompt, 'params': params or {}},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None on a miss"""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)['response']
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Dropping unreadable cache entry {path}: {str(e)}")
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        os.utime(path)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: str, model: str, params: Optional[Dict] = None):
+        """Store a response and evict least recently used responses beyond max_bytes"""
+        path = self.entry_path(key)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': model, 'params': params or {}, 'response': response}, f)
+        os.replace(temp_path, path)
+
+        self.total_bytes -= self.entries.pop(key, 0)
+        self.entries[key] = os.path.getsize(path)
+        self.total_bytes += self.entries[key]
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, key: str):
+        self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+        }
+
+_caches: Dict[str, ResponseCache] = {}
+
+def get_response_cache(cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES) -> ResponseCache:
+    """Return the process-wide cache for cache_dir, so all composers share entries and counters"""
+    cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ResponseCache(cache_dir, max_bytes)
+    return _caches[cache_dir]
+
+class CachedChatClient:
+    """Wraps a chat client so identical requests are answered from a ResponseCache.
+
+    With bypass=True cached responses are ignored, but fresh responses are still written, which
+    refreshes the cache for the prompts that were sent. Identical requests issued concurrently
+    share a single call."""
+
+    def __init__(self, client, cache: ResponseCache, model: str, bypass: bool = False):
+        self.client = client
+        self.cache = cache
+        self.model = model
+        self.bypass = bypass
+
+    async def chat(self, prompt: str, **kwargs) -> str:
+        params = {name: kwargs[name] for name in SAMPLING_PARAMS if name in kwargs}
+        key = self.cache.make_key(self.model, prompt, params)
+        if not self.bypass:
+            response = self.cache.get(key)
+            if response is not None:
+                note_call(cache_hit=True)
+                return response
+        in_flight = self.cache.in_flight
+        if key in in_flight:
+            # Answered by an identical call in flight, no request of its own
+            note_call(cache_hit=True)
+            return await asyncio.shield(in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        in_flight[key] = future
+        try:
+            response = await self.client.chat(prompt=prompt, **kwargs)
+            self.cache.put(key, response, self.model, params)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else is waiting for it
+            future.exception()
+            raise
+        finally:
+            del in_flight[key]
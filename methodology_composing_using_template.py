@@ -1,12 +1,11 @@
 import os
-import json
 import asyncio
 import logging
 from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.openai_utils import GPTClient
 from section_composer import SectionComposer, setup_logging
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW
 
 '''
 # Methodology Composition Flow
@@ -52,8 +51,19 @@ followed by iterative structure generation, subsection detailization, fusion, an
 '''
 
 class MethodologyComposer(SectionComposer):
-    def __init__(self, research_field: str, structure_iterations: int = 3):
-        super().__init__(research_field, "methodology", structure_iterations)
+    AGENT_FILES = [
+        'prepare_agent.json',
+        'survey_agent.json',
+        'coding_plan_agent.json',
+        'machine_learning_agent.json',
+        'judge_agent.json',
+        'machine_learning_agent_iter_submit.json',
+        'experiment_analysis_agent_iter_refine_1.json',
+        'machine_learning_agent_iter_refine_1.json',
+    ]
+
+    def __init__(self, research_field: str, structure_iterations: int = 3, **kwargs):
+        super().__init__(research_field, "methodology", structure_iterations, **kwargs)
 
     def read_model_code(self, model_dir):
         """Combine all Python files in the model directory"""
@@ -129,8 +139,8 @@ Output only the LaTeX structure with comments as specified above. Note again tha
         return await self.gpt_client.chat(prompt=prompt)
 
     async def detailize_subsection(self, structure, current_text, content, subsection):
-        # Get a random writing template
-        writing_template = self.get_random_template()
+        # Get the writing template closest to the subsection's content
+        writing_template = await self.select_template(f"{subsection}\n{current_text}\n{content}")
         
         prompt = f"""Revise or write the following subsection of the methodology section:
 \subsection{{{subsection}}}
@@ -201,7 +211,7 @@ Requirements:
 
 Output the detailed LaTeX text for this subsection only."""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_LOW)
 
     async def final_writing_checklist(self, methodology_text: str) -> str:
         prompt = f"""Review and revise the methodology section following these academic writing guidelines:
@@ -245,25 +255,17 @@ CHECKLIST FOR REVISION:
 
 Output the revised methodology section incorporating all these improvements while maintaining the core technical content. Reply your latex without any additional explanations."""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_HIGH)
 
     async def compose_section(self, agent_dir: str, model_dir: str, benchmark_path: str, target_paper: str) -> str:
         checkpoint_dir = self.get_checkpoint_path(target_paper)
         os.makedirs(checkpoint_dir, exist_ok=True)
         
-        agent_files = [
-            'prepare_agent.json',
-            'survey_agent.json',
-            'coding_plan_agent.json',
-            'machine_learning_agent.json',
-            'judge_agent.json',
-            'machine_learning_agent_iter_submit.json',
-            'experiment_analysis_agent_iter_refine_1.json',
-            'machine_learning_agent_iter_refine_1.json',
-        ]
-        combined_code = self.read_model_code(model_dir)
+        agent_files = self.AGENT_FILES
+        combined_code = await self.run_io(self.read_model_code, model_dir)
 
         # Step 1: Iterative structure generation
+        self.set_trace_stage("structure")
         structure = ""
         structure_checkpoint = self.load_checkpoint(target_paper, "structure")
         
@@ -272,17 +274,17 @@ Output the revised methodology section incorporating all these improvements whil
             logging.info("Loaded structure from checkpoint")
         else:
             for iteration in range(self.structure_iterations):
+                self.set_trace_stage("structure", iteration + 1)
                 logging.info(f"Structure iteration {iteration + 1}/{self.structure_iterations}")
                 
                 structure = await self.generate_or_revise_structure(
-                    combined_code, structure, iteration + 1)
+                    await self.pack_content(combined_code, self.section_name, structure), structure, iteration + 1)
 
                 # Process agent files
                 for idx, agent_file in enumerate(tqdm(agent_files, desc="Processing agent files")):
-                    with open(os.path.join(agent_dir, agent_file), 'r') as f:
-                        content = json.load(f) 
+                    content = self.agent_store.load(agent_dir, agent_file).text
                     structure = await self.generate_or_revise_structure(
-                        json.dumps(content, indent=2), structure, iteration + 1)
+                        content, structure, iteration + 1)
                 
                 self.write_temp_log(structure, f"iteration_{iteration+1}_final")
             
@@ -291,9 +293,8 @@ Output the revised methodology section incorporating all these improvements whil
             })
 
         # Step 2: Detailize subsections
-        subsections = [line.split('{')[1].split('}')[0] 
-                    for line in structure.split('\n') 
-                    if line.strip().startswith('\\subsection')]
+        self.set_trace_stage("detailize")
+        subsections = self.get_subsections(structure)
         
         subsection_contents = {}
         subsection_checkpoint = self.load_checkpoint(target_paper, "subsections")
@@ -302,35 +303,24 @@ Output the revised methodology section incorporating all these improvements whil
             subsection_contents = subsection_checkpoint
             logging.info("Loaded subsection contents from checkpoint")
         else:
-            for subsection_id, subsection in enumerate(tqdm(subsections, desc="Detailizing subsections")):
-                methodology_part = ''
-                
-                # Process code content
-                methodology_part = await self.detailize_subsection(
-                    structure, methodology_part, combined_code, subsection)
-                self.write_temp_log(
-                    methodology_part,
-                    f"subsection_{subsection_id}_code"
-                )
-                
-                # Process agent contents
+            async def detailize(subsection_id, subsection):
+                # Process code content, then agent contents
+                steps = [("code", combined_code)]
                 for i, agent_file in enumerate(agent_files):
-                    with open(os.path.join(agent_dir, agent_file), 'r') as f:
-                        content = json.load(f)
-                    methodology_part = await self.detailize_subsection(
-                        structure, methodology_part, json.dumps(content, indent=2), subsection)
-                    
-                    self.write_temp_log(
-                        methodology_part,
-                        f"subsection_{subsection_id}_agent_{i}"
-                    )
-                    
-                    subsection_contents[subsection] = methodology_part
-                    self.save_checkpoint(target_paper, "subsections", subsection_contents)
+                    steps.append((f"agent_{i}", self.agent_store.load(agent_dir, agent_file).text))
+
+                return await self.fold_into_subsection(
+                    structure, subsection, subsection_id, steps, step_log=step_log)
+
+            step_log = self.open_step_log(target_paper, structure)
+            subsection_contents = await self.detailize_subsections(subsections, detailize)
+            self.save_checkpoint(target_paper, "subsections", subsection_contents)
+            step_log.clear()
 
         # Step 3: Fuse all subsections
+        self.set_trace_stage("fuse")
         self.write_temp_log(
-            json.dumps(subsection_contents, indent=2),
+            await self.dumps_json(subsection_contents),
             "pre_fusion_subsections"
         )
         
@@ -338,26 +328,21 @@ Output the revised methodology section incorporating all these improvements whil
         self.write_temp_log(fused_methodology, "post_fusion_methodology")
 
         # Step 4: Final writing checklist
+        self.set_trace_stage("checklist")
         final_methodology = await self.final_writing_checklist(fused_methodology)
         self.write_temp_log(final_methodology, "post_checklist_methodology")
 
         # Save final output
-        output_dir = f"{self.research_field}/target_sections/{self.normalize_title(target_paper)}"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "methodology.tex")
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(final_methodology)
-        logging.info(f"Saved final methodology to {output_path}")
+        self.save_section_output(target_paper, final_methodology)
 
         return final_methodology
 
-async def methodology_composing(research_field: str, instance_id: str):
+async def methodology_composing(research_field: str, instance_id: str, **composer_options):
     # research_field = "vq"
     # instance_id = "rotation_vq"
     setup_logging(research_field)
     
-    composer = MethodologyComposer(research_field=research_field, structure_iterations=1)
+    composer = MethodologyComposer(research_field=research_field, structure_iterations=1, **composer_options)
     
     # Use local paths instead of hardcoded absolute paths
     proj_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), research_field, instance_id)
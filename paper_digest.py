@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+'''
+# Paper Digests
+
+Related papers are condensed once into a short structured record, and the related work prompts
+carry the record instead of the paper's full text:
+
+    {"title": "...", "contribution": "...", "method_family": "...", "limitations": "...",
+     "bibtex": {"key": "...", "author": "...", "title": "...", "year": "...", "venue": "..."}}
+
+Digests are stored on disk per research field, one JSON file per paper named by the SHA-256 of
+the paper's text (PaperFile.content_hash in paper_source.py),
+`{research_field}/paper_digests/<hash>.json`. A paper is therefore digested once per research
+field, no matter how many subsections, reruns or instances read it, and again only when its text
+changes. Concurrent requests for the same paper share one digest call.
+'''
+
+DIGEST_FIELDS = ('title', 'contribution', 'method_family', 'limitations')
+BIBTEX_FIELDS = ('key', 'author', 'title', 'year', 'venue')
+
+def digest_dir(research_field: str) -> str:
+    return f"{research_field}/paper_digests"
+
+def parse_digest(response: str) -> Optional[Dict]:
+    """Digest record from a model response (a JSON object, possibly fenced), or None if the
+    response does not contain one"""
+    match = re.search(r'\{.*\}', response, re.DOTALL)
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not data.get('contribution'):
+        return None
+    digest = {field: str(data.get(field) or '').strip() for field in DIGEST_FIELDS}
+    bibtex = data.get('bibtex') if isinstance(data.get('bibtex'), dict) else {}
+    digest['bibtex'] = {field: str(bibtex.get(field) or '').strip() for field in BIBTEX_FIELDS}
+    return digest
+
+def render_digest(digest: Dict) -> str:
+    """Compact plain-text form of a digest for prompts"""
+    lines = [f"{field.replace('_', ' ').capitalize()}: {digest[field]}"
+             for field in DIGEST_FIELDS if digest.get(field)]
+    bibtex = {field: value for field, value in digest.get('bibtex', {}).items() if value}
+    if bibtex.get('key'):
+        entries = ', '.join(f"{field} = {{{value}}}" for field, value in bibtex.items() if field != 'key')
+        lines.append(f"BibTeX: @article{{{bibtex['key']}, {entries}}}")
+    return '\n'.join(lines)
+
+class DigestStore:
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.hits = 0
+        self.misses = 0
+        # Digests in memory by content hash, read from disk on first use
+        self.digests: Dict[str, Dict] = {}
+        # Papers currently being digested, so concurrent requests share one call
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.store_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        if key in self.digests:
+            return self.digests[key]
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.digests[key] = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Dropping unreadable paper digest {path}: {str(e)}")
+            os.remove(path)
+            return None
+        return self.digests[key]
+
+    def put(self, key: str, digest: Dict):
+        path = self.entry_path(key)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(digest, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, path)
+        self.digests[key] = digest
+
+    async def get_or_create(self, key: str, create: Callable[[], Awaitable[Optional[Dict]]]) -> Optional[Dict]:
+        """Digest of the paper with content hash key, calling create() only if none is stored.
+
+        A None result of create() (e.g. an unparsable response) is returned but not stored."""
+        digest = self.get(key)
+        if digest is not None:
+            self.hits += 1
+            return digest
+        if key in self.in_flight:
+            self.hits += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            digest = await create()
+            if digest is not None:
+                self.put(key, digest)
+            future.set_result(digest)
+            return digest
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+_stores: Dict[str, DigestStore] = {}
+
+def get_digest_store(research_field: str) -> DigestStore:
+    """The process-wide digest store of a research field, shared by all composers"""
+    store_dir = os.path.abspath(digest_dir(research_field))
+    if store_dir not in _stores:
+        _stores[store_dir] = DigestStore(store_dir)
+    return _stores[store_dir]
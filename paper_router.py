@@ -0,0 +1,67 @@
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from lexical_index import BM25Index
+
+'''
+# Paper Routing
+
+The related work composer folds related papers into subsections one call at a time. Instead of
+folding every paper into every subsection, each subsection only gets the papers that match its
+title and structure comments:
+
+- Papers are indexed once with BM25 and every subsection's heading and comment block is a query.
+- A paper is routed to a subsection if its score is at least min_relevance times the best score
+  for that subsection, keeping at most max_papers_per_subsection papers per subsection.
+- Papers that no subsection picked are not folded one by one. They are left over as a group for
+  a single summary step in the subsection they match best together (the first subsection if
+  none of them matches any), so they can still be cited somewhere for one call in total.
+'''
+
+class PaperRouter:
+    def __init__(self, papers: Sequence[Tuple[str, str]], min_relevance: float = 0.3,
+                 max_papers_per_subsection: int = 8):
+        """
+        Args:
+            papers: (paper id, text) pairs
+            min_relevance: Score relative to the best paper of a subsection a paper needs (0 to 1)
+            max_papers_per_subsection: Cap on papers routed to one subsection
+        """
+        self.paper_ids = [paper_id for paper_id, _ in papers]
+        self.index = BM25Index([text for _, text in papers])
+        self.min_relevance = min_relevance
+        self.max_papers_per_subsection = max_papers_per_subsection
+
+    def route(self, queries: Dict[str, str]) -> Tuple[Dict[str, List[str]], Optional[str], List[str]]:
+        """Paper ids routed to each subsection, most relevant first, and the leftover papers.
+
+        Args:
+            queries: Query text (title and structure comments) by subsection title
+
+        Returns:
+            (paper ids by subsection, subsection for the summary step of the leftover papers or
+            None if there are none, leftover paper ids)
+        """
+        scores = {subsection: self.index.scores(query) for subsection, query in queries.items()}
+        routes: Dict[str, List[int]] = {}
+        for subsection, paper_scores in scores.items():
+            best = max(paper_scores, default=0.0)
+            ranked = sorted(range(len(paper_scores)), key=lambda index: (-paper_scores[index], index))
+            routes[subsection] = [index for index in ranked
+                                  if paper_scores[index] > 0 and paper_scores[index] >= self.min_relevance * best
+                                  ][:self.max_papers_per_subsection]
+
+        routed = {index for indices in routes.values() for index in indices}
+        leftovers = [index for index in range(len(self.paper_ids)) if index not in routed]
+        leftover_subsection = None
+        if leftovers and scores:
+            # max() keeps the first subsection on ties, e.g. when no leftover matches anything
+            leftover_subsection = max(scores, key=lambda subsection: sum(scores[subsection][index]
+                                                                          for index in leftovers))
+
+        total = sum(len(indices) for indices in routes.values()) + (1 if leftover_subsection else 0)
+        logging.info(f"Routed {len(self.paper_ids)} papers to {len(routes)} subsections: {total} paper "
+                     f"folds instead of {len(self.paper_ids) * len(routes)}, {len(leftovers)} unmatched papers "
+                     f"in one summary step")
+        return ({subsection: [self.paper_ids[index] for index in indices] for subsection, indices in routes.items()},
+                leftover_subsection, [self.paper_ids[index] for index in leftovers])
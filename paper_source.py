@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import hashlib
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+'''
+# Paper Source
+
+Related papers are read lazily from `workplace/papers/` instead of being loaded into memory up
+front. A PaperFile is only a path; its text is streamed line by line and split into
+section-aware chunks whenever it is needed:
+
+    front (title, authors) -> abstract -> introduction -> related_work -> method -> experiments
+    -> conclusion -> references
+
+Sections are recognized from heading lines ("Abstract", "1 Introduction", "3. Proposed Method",
+"\\section{Conclusion}", "# Experiments"), or from the keys of a JSON paper. Text before the
+first recognized heading belongs to "front", and a paper without recognized headings is one long
+"front" section.
+
+excerpt() keeps only the chunks of the sections a prompt needs, up to a character budget, so the
+memory held per paper is bounded by the budget rather than by the size of the file.
+'''
+
+# Section kind by heading title, matched against the start of the heading
+SECTION_TITLES = {
+    'abstract': ('abstract',),
+    'introduction': ('introduction',),
+    'related_work': ('related work', 'background', 'preliminaries', 'prior work'),
+    'method': ('method', 'methods', 'methodology', 'approach', 'proposed method', 'our method', 'model'),
+    'experiments': ('experiment', 'experiments', 'experimental', 'evaluation', 'results'),
+    'conclusion': ('conclusion', 'conclusions', 'discussion', 'limitations', 'future work'),
+    'references': ('references', 'bibliography', 'acknowledgment', 'acknowledgement', 'appendix'),
+}
+# Optional markup and numbering around a heading title: "# ", "\section{", "3.", "IV."
+HEADING_PATTERN = re.compile(
+    r'^\s*(?:#+\s*|\\section\*?\{)?(?:(?:\d+|[IVX]+)\.?\s+)?([A-Za-z][A-Za-z &\-]*?)\s*\}?\s*:?\s*$')
+MAX_HEADING_CHARS = 60
+MAX_HEADING_WORDS = 5
+
+# Sections a paper digest is written from
+DIGEST_SECTIONS = ('front', 'abstract', 'introduction', 'method', 'conclusion')
+DEFAULT_CHUNK_CHARS = 4000
+DEFAULT_EXCERPT_CHARS = 32000
+
+def section_kind(line: str) -> Optional[str]:
+    """Section a heading line starts, or None if the line is not a section heading"""
+    if len(line) > MAX_HEADING_CHARS:
+        return None
+    match = HEADING_PATTERN.match(line)
+    if not match:
+        return None
+    title = match.group(1).lower()
+    if len(title.split()) > MAX_HEADING_WORDS:
+        return None
+    for kind, titles in SECTION_TITLES.items():
+        if any(title == name or title.startswith(f"{name} ") or title.startswith(f"{name}s") for name in titles):
+            return kind
+    return None
+
+class PaperChunk:
+    def __init__(self, filename: str, section: str, index: int, text: str):
+        self.filename = filename
+        self.section = section
+        # Position of the chunk in the paper
+        self.index = index
+        self.text = text
+
+class PaperFile:
+    """A related paper on disk, read on demand"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.filename = os.path.basename(path)
+
+    def lines(self) -> Iterator[str]:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            yield from f
+
+    def content_hash(self) -> str:
+        """SHA-256 of the paper's text, computed without holding the text"""
+        digest = hashlib.sha256()
+        for line in self.lines():
+            digest.update(line.encode('utf-8'))
+        return digest.hexdigest()
+
+    def sections(self) -> Iterator[Tuple[str, str]]:
+        """(section kind, line) pairs in document order"""
+        if self.filename.endswith('.json'):
+            yield from self.json_sections()
+            return
+        section = 'front'
+        for line in self.lines():
+            section = section_kind(line) or section
+            yield section, line
+
+    def json_sections(self) -> Iterator[Tuple[str, str]]:
+        # JSON papers cannot be streamed; the parsed file is dropped as soon as it is split
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            data = {'text': data}
+        for key, value in data.items():
+            text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            yield section_kind(str(key).replace('_', ' ')) or 'front', f"{key}: {text}\n"
+
+    def chunks(self, max_chars: int = DEFAULT_CHUNK_CHARS) -> Iterator[PaperChunk]:
+        """Chunks of at most max_chars that never span two sections, in document order"""
+        index = 0
+        current: List[str] = []
+        current_section, size = None, 0
+        for section, line in self.sections():
+            pieces = [line[i:i + max_chars] for i in range(0, len(line), max_chars)] or [line]
+            for piece in pieces:
+                if current and (section != current_section or size + len(piece) > max_chars):
+                    yield PaperChunk(self.filename, current_section, index, ''.join(current))
+                    index += 1
+                    current, size = [], 0
+                current.append(piece)
+                current_section = section
+                size += len(piece)
+        if current:
+            yield PaperChunk(self.filename, current_section, index, ''.join(current))
+
+    def excerpt(self, max_chars: int = DEFAULT_EXCERPT_CHARS, sections: Sequence[str] = DIGEST_SECTIONS,
+                chunk_chars: int = DEFAULT_CHUNK_CHARS) -> str:
+        """Leading chunks of the given sections, at most max_chars in total.
+
+        Sections shorter than their share of the budget leave the rest to the others."""
+        kept: Dict[str, List[PaperChunk]] = {section: [] for section in sections}
+        sizes = {section: 0 for section in sections}
+        for chunk in self.chunks(chunk_chars):
+            if chunk.section in kept and sizes[chunk.section] < max_chars:
+                kept[chunk.section].append(chunk)
+                sizes[chunk.section] += len(chunk.text)
+
+        # Fair share of the budget, smallest sections first
+        remaining, allowed = max_chars, {}
+        present = sorted((section for section in sections if sizes[section]), key=lambda section: sizes[section])
+        for position, section in enumerate(present):
+            allowed[section] = min(sizes[section], remaining // (len(present) - position))
+            remaining -= allowed[section]
+
+        selected = []
+        for section in present:
+            budget = allowed[section]
+            for chunk in kept[section]:
+                if budget <= 0:
+                    break
+                text = chunk.text if len(chunk.text) <= budget else chunk.text[:budget].rstrip() + '\n'
+                selected.append((chunk.index, text))
+                budget -= len(chunk.text)
+        return ''.join(text for _, text in sorted(selected))
+
+class PaperSource:
+    """The related papers of an instance, yielded one at a time"""
+
+    EXTENSIONS = ('.txt', '.json')
+
+    def __init__(self, papers_dir: str):
+        self.papers_dir = papers_dir
+        self.filenames = sorted(filename for filename in os.listdir(papers_dir)
+                                if filename.endswith(self.EXTENSIONS)) if os.path.isdir(papers_dir) else []
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __iter__(self) -> Iterator[PaperFile]:
+        for filename in self.filenames:
+            yield PaperFile(os.path.join(self.papers_dir, filename))
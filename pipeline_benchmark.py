@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from typing import Dict, List, Tuple
+
+from llm_backend import LATENCY_DISTRIBUTIONS
+
+'''
+# Pipeline Benchmark
+
+Runs the full writing() pipeline on the committed `vq/rotated_vq` instance with the offline local
+backend in place of the model, so the numbers measure orchestration only:
+
+    python pipeline_benchmark.py --latency 0.5 --latency_distribution lognormal
+
+Every configuration runs in a fresh process and a scratch working directory (with a copy of the
+research field's writing templates) and reports:
+
+- wall_clock: Seconds for the whole pipeline
+- llm_rounds: Length of the longest chain of calls that each started after the previous one ended,
+  i.e. the number of call latencies on the critical path
+- llm_calls, cache_hits: Calls that reached the backend and calls answered from the response cache
+- prompt_tokens: Prompt tokens sent to the backend
+- peak_rss_mb: Peak resident memory of the process
+- files_written: Files created or modified in the working directory
+
+The "cached" configuration first runs the pipeline once to fill the LLM response cache, removes
+checkpoints and outputs, and measures the second run.
+'''
+
+RESEARCH_FIELD = "vq"
+INSTANCE_ID = "rotated_vq"
+
+# compose_paper options of each configuration
+CONFIGS = {
+    'sequential': dict(max_concurrency=1, subsection_concurrency=1),
+    'parallel': dict(max_concurrency=3, subsection_concurrency=4),
+    'map_reduce': dict(max_concurrency=3, subsection_concurrency=4, fold_modes={'*': 'tree'}),
+    'cached': dict(max_concurrency=3, subsection_concurrency=4),
+}
+WARM_CONFIGS = {'cached'}
+
+def call_rounds(intervals: List[Tuple[float, float]]) -> int:
+    """Length of the longest chain of calls in which every call starts after the previous one ended"""
+    calls = sorted(intervals)
+    by_end = sorted(range(len(calls)), key=lambda index: calls[index][1])
+    depth = [0] * len(calls)
+    # Longest chain among the calls that ended before the current call started
+    best, ended = 0, 0
+    for index, (start, _) in enumerate(calls):
+        while ended < len(calls) and calls[by_end[ended]][1] <= start:
+            best = max(best, depth[by_end[ended]])
+            ended += 1
+        depth[index] = best + 1
+    return max(depth, default=0)
+
+def snapshot(directory: str) -> Dict[str, int]:
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            files[path] = os.stat(path).st_mtime_ns
+    return files
+
+def prepare_workdir(workdir: str):
+    templates = os.path.join(RESEARCH_FIELD, "writing_templates")
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), templates),
+                    os.path.join(workdir, templates))
+
+def clear_outputs(workdir: str):
+    """Remove everything but the writing templates and the LLM response cache"""
+    field_dir = os.path.join(workdir, RESEARCH_FIELD)
+    for name in os.listdir(field_dir):
+        if name not in ("writing_templates", "llm_cache"):
+            path = os.path.join(field_dir, name)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+async def run_pipeline(config: Dict, latency: float, latency_distribution: str) -> Dict:
+    """Run the pipeline once in the current directory and measure it"""
+    # Imported in the worker process only, the driver never composes anything itself
+    from writing import writing
+    from llm_backend import backend_usage, call_intervals
+    from telemetry import get_call_telemetry
+
+    options = dict(config)
+    before = snapshot('.')
+    started = time.perf_counter()
+    await writing(RESEARCH_FIELD, INSTANCE_ID, llm_backend="local",
+                  llm_backend_options={'latency': latency, 'latency_distribution': latency_distribution},
+                  **options)
+    wall_clock = time.perf_counter() - started
+    after = snapshot('.')
+
+    intervals = call_intervals()
+    usage = backend_usage()
+    return {
+        'wall_clock': round(wall_clock, 3),
+        'llm_rounds': call_rounds(intervals),
+        'llm_calls': usage['calls'],
+        'cache_hits': sum(1 for call in get_call_telemetry().calls if call.get('cache_hit')),
+        'prompt_tokens': usage['prompt_tokens'],
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'files_written': sum(1 for path, mtime in after.items() if before.get(path) != mtime),
+    }
+
+def run_config(name: str, latency: float, latency_distribution: str, keep_workdir: bool = False) -> Dict:
+    """Run one configuration in fresh processes and a scratch working directory"""
+    workdir = tempfile.mkdtemp(prefix=f"paper_agent_bench_{name}_")
+    try:
+        prepare_workdir(workdir)
+        command = [sys.executable, os.path.abspath(__file__), "--worker", name,
+                   "--latency", str(latency), "--latency_distribution", latency_distribution]
+        if name in WARM_CONFIGS:
+            subprocess.run(command, cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+            clear_outputs(workdir)
+        output = subprocess.run(command, cwd=workdir, check=True, stdout=subprocess.PIPE, text=True).stdout
+        return {'config': name, **json.loads(output.strip().splitlines()[-1])}
+    finally:
+        if keep_workdir:
+            logging.info(f"Kept working directory of {name}: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def render(results: List[Dict]) -> str:
+    columns = ['config', 'wall_clock', 'llm_rounds', 'llm_calls', 'cache_hits', 'prompt_tokens',
+               'peak_rss_mb', 'files_written']
+    rows = [columns] + [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", type=str, nargs='*', default=list(CONFIGS), choices=list(CONFIGS),
+                        help="Pipeline configurations to run")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Mean seconds per simulated LLM call")
+    parser.add_argument("--latency_distribution", type=str, default="fixed",
+                        choices=LATENCY_DISTRIBUTIONS,
+                        help="Distribution simulated call latencies are drawn from")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Also write the results to this JSON file")
+    parser.add_argument("--keep_workdirs", action="store_true",
+                        help="Keep the scratch working directories for inspection")
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # Runs inside the scratch working directory; the last line of stdout is the result
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+        result = asyncio.run(run_pipeline(CONFIGS[args.worker], args.latency, args.latency_distribution))
+        print(json.dumps(result))
+        sys.exit(0)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    results = []
+    for name in args.configs:
+        logging.info(f"Running {name} (latency {args.latency}s, {args.latency_distribution})")
+        results.append(run_config(name, args.latency, args.latency_distribution, args.keep_workdirs))
+    print(render(results))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'latency': args.latency, 'latency_distribution': args.latency_distribution,
+                       'results': results}, f, indent=2)
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+'''
+# Project Index
+
+Workplaces hold generated datasets, checkpoints and logs next to the code, so reading the whole
+project tree on every run is slow. The index persists (path, size, mtime, content hash, content)
+for every code file it has read and only re-reads files whose size or modification time changed.
+Changed files are read in parallel on a thread pool, and per-file and total size caps keep large
+generated files out of prompts.
+
+The fingerprint is a hash over the indexed paths and content hashes: it only changes when the
+code changes. The experiments composer keys its structure checkpoint on it, so a structure is
+regenerated once the project's code changes.
+'''
+
+DEFAULT_MAX_FILE_BYTES = 512 * 1024
+DEFAULT_MAX_TOTAL_BYTES = 8 * 1024 * 1024
+
+def read_text_file(path: str) -> Tuple[str, str]:
+    """Return (content, sha256 of the raw bytes)"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return raw.decode('utf-8'), hashlib.sha256(raw).hexdigest()
+
+class ProjectIndex:
+    def __init__(self, index_path: Optional[str] = None, extensions: Tuple[str, ...] = ('.py',),
+                 max_file_bytes: int = DEFAULT_MAX_FILE_BYTES, max_total_bytes: int = DEFAULT_MAX_TOTAL_BYTES,
+                 workers: int = 8):
+        """
+        Args:
+            index_path: JSON file the index is persisted to (None keeps it in memory)
+            extensions: Suffixes of the files whose content is indexed
+            max_file_bytes: Files larger than this are listed but their content is not read
+            max_total_bytes: Content is read until this many bytes are indexed in total
+            workers: Threads used to read changed files
+        """
+        self.index_path = index_path
+        self.extensions = extensions
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.workers = workers
+        self.files: Dict[str, Dict] = {}
+        self.fingerprint = ''
+        if index_path and os.path.exists(index_path):
+            try:
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    self.files = json.load(f).get('files', {})
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable project index {index_path}: {str(e)}")
+
+    def scan(self, project_dir: str) -> Tuple[List[Dict], List[Dict]]:
+        """Walk project_dir and refresh the index.
+
+        Returns:
+            (dir_tree, code_contents) in the format of ExperimentsComposer.read_project_structure
+        """
+        dir_tree = []
+        candidates = []
+        for root, dirs, files in os.walk(project_dir):
+            # Skip system directories
+            dirs[:] = sorted(d for d in dirs if not d.startswith(('__', '.', 'cache')))
+            # Every file is listed, only code files are read
+            files = sorted(files)
+
+            rel_path = os.path.relpath(root, project_dir)
+            if rel_path == '.':
+                rel_path = ''
+            candidates.extend((os.path.join(rel_path, f), os.path.join(root, f))
+                              for f in files if f.endswith(self.extensions))
+            if files or dirs:
+                dir_tree.append({
+                    'path': rel_path,
+                    'files': files,
+                    'dirs': dirs
+                })
+
+        files, to_read, total_bytes = {}, [], 0
+        for rel_file, path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logging.error(f"Error reading file {rel_file}: {str(e)}")
+                continue
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if stat.st_size > self.max_file_bytes:
+                entry['skipped'] = 'file_size'
+            elif total_bytes + stat.st_size > self.max_total_bytes:
+                entry['skipped'] = 'total_size'
+            else:
+                total_bytes += stat.st_size
+                previous = self.files.get(rel_file)
+                if (previous and 'content' in previous and previous['size'] == stat.st_size
+                        and previous['mtime_ns'] == stat.st_mtime_ns):
+                    entry.update(sha256=previous['sha256'], content=previous['content'])
+                else:
+                    to_read.append((rel_file, path))
+            if 'skipped' in entry:
+                logging.warning(f"Not indexing content of {rel_file} ({stat.st_size} bytes, {entry['skipped']} cap)")
+            files[rel_file] = entry
+
+        if to_read:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                results = pool.map(lambda item: self._read(*item), to_read)
+                for (rel_file, _), result in zip(to_read, results):
+                    if result is None:
+                        del files[rel_file]
+                    else:
+                        files[rel_file].update(content=result[0], sha256=result[1])
+        logging.info(f"Indexed {len(files)} files in {project_dir}, re-read {len(to_read)}")
+
+        changed = files != self.files
+        self.files = files
+        self.fingerprint = self.compute_fingerprint()
+        if changed and self.index_path:
+            self.save()
+
+        code_contents = [{'path': rel_file, 'content': entry['content']}
+                         for rel_file, entry in files.items() if 'content' in entry]
+        return dir_tree, code_contents
+
+    def _read(self, rel_file: str, path: str) -> Optional[Tuple[str, str]]:
+        try:
+            return read_text_file(path)
+        except Exception as e:
+            logging.error(f"Error reading file {rel_file}: {str(e)}")
+            return None
+
+    def compute_fingerprint(self) -> str:
+        digest = hashlib.sha256()
+        for rel_file in sorted(self.files):
+            entry = self.files[rel_file]
+            # Files without indexed content contribute their size and mtime instead
+            marker = entry.get('sha256') or f"{entry['size']}:{entry['mtime_ns']}"
+            digest.update(f"{rel_file}\0{marker}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'files': self.files}, f)
+        os.replace(temp_path, self.index_path)
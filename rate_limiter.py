@@ -0,0 +1,228 @@
+import re
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from typing import Dict, Optional, Tuple
+
+from telemetry import count_call_tokens, note_call
+
+'''
+# Rate Limiting
+
+Sections and subsections are composed concurrently, so the pipeline can easily exceed the
+provider's requests-per-minute (RPM) and tokens-per-minute (TPM) quotas. Every call to a model
+first acquires admission from the process-wide limiter of that model:
+
+- Two token buckets, one for requests and one for tokens (prompt plus expected completion), both
+  refilled continuously at the configured per-minute rate.
+- Waiting calls are admitted strictly by priority class and then in arrival order, so a
+  final-checklist call overtakes queued bulk folds over related papers.
+- Rate limit errors (HTTP 429) pause admission for the provider's retry-after (or an exponential
+  backoff) and halve the admitted rate, which then recovers gradually with every success.
+'''
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# (requests per minute, tokens per minute) by model name prefix, longest prefix wins
+# Defaults follow a mid usage tier; set the account's own quota with --requests_per_minute and
+# --tokens_per_minute
+MODEL_RATE_LIMITS = {
+    'gpt-4o': (5000, 800000),
+    'gpt-4o-mini': (5000, 4000000),
+    'o1': (5000, 800000),
+    'o1-mini': (5000, 4000000),
+}
+DEFAULT_RATE_LIMITS = (5000, 4000000)
+# Completion size assumed when a call does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 1000
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, scale: float = 1.0):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate * scale)
+        self.updated = now
+
+    def wait_time(self, amount: float, scale: float = 1.0) -> float:
+        """Seconds until amount is available (0 if it is available now)"""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / (self.rate * scale))
+
+    def take(self, amount: float):
+        # Requests larger than the bucket are admitted once it is full and leave it in debt
+        self.level -= amount
+
+class RateLimiter:
+    def __init__(self, model: str, requests_per_minute: int, tokens_per_minute: int):
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        # Fraction of the configured rate currently admitted, lowered on rate limit errors
+        self.rate_scale = 1.0
+        self.paused_until = 0.0
+        self.backoff = 0.0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.loop = None
+        self.changed = None
+        self.admitted = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL):
+        """Wait until a call of `tokens` tokens may be sent"""
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # The limiter outlives event loops (e.g. several asyncio.run() calls in one process)
+            self.loop = loop
+            self.changed = asyncio.Event()
+        entry = (priority, next(self.counter))
+        heapq.heappush(self.waiters, entry)
+        started = time.monotonic()
+        try:
+            while True:
+                delay = self.admission_delay(tokens) if self.waiters[0] == entry else None
+                if delay == 0:
+                    heapq.heappop(self.waiters)
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    self.admitted += 1
+                    self.wait_seconds += time.monotonic() - started
+                    return
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            raise
+        finally:
+            # Let the next waiter check whether it can go
+            self.changed.set()
+
+    def admission_delay(self, tokens: int) -> float:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.requests.refill(self.rate_scale)
+        self.tokens.refill(self.rate_scale)
+        return max(self.requests.wait_time(1, self.rate_scale), self.tokens.wait_time(tokens, self.rate_scale))
+
+    def adjust(self, tokens: int):
+        """Correct the token bucket once the actual size of an admitted call is known"""
+        self.tokens.take(tokens)
+
+    def report_success(self):
+        self.backoff = 0.0
+        if self.rate_scale < 1.0:
+            self.rate_scale = min(1.0, self.rate_scale + 0.05)
+
+    def report_rate_limited(self, retry_after: Optional[float] = None):
+        """Pause admission and halve the admitted rate after a rate limit error"""
+        self.rate_limited += 1
+        self.backoff = min(60.0, self.backoff * 2 if self.backoff else 1.0)
+        pause = retry_after if retry_after is not None else self.backoff * (1 + random.random() / 2)
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        self.rate_scale = max(0.1, self.rate_scale / 2)
+        logging.warning(f"Rate limited on {self.model}, pausing {pause:.1f}s at {self.rate_scale:.0%} of the quota")
+        if self.changed:
+            self.changed.set()
+
+    def stats(self) -> Dict:
+        return {
+            'admitted': self.admitted,
+            'rate_limited': self.rate_limited,
+            'wait_seconds': round(self.wait_seconds, 2),
+            'rate_scale': self.rate_scale,
+        }
+
+def default_rate_limits(model: str) -> Tuple[int, int]:
+    matches = [prefix for prefix in MODEL_RATE_LIMITS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_RATE_LIMITS
+    return MODEL_RATE_LIMITS[max(matches, key=len)]
+
+_limiters: Dict[str, RateLimiter] = {}
+
+def get_rate_limiter(model: str, requests_per_minute: Optional[int] = None,
+                     tokens_per_minute: Optional[int] = None) -> RateLimiter:
+    """Return the process-wide limiter of model, shared by all composers.
+
+    Limits passed here replace the ones of an existing limiter."""
+    default_requests, default_tokens = default_rate_limits(model)
+    limiter = _limiters.get(model)
+    if limiter is None:
+        limiter = _limiters[model] = RateLimiter(
+            model, requests_per_minute or default_requests, tokens_per_minute or default_tokens)
+    else:
+        if requests_per_minute and requests_per_minute != limiter.requests.per_minute:
+            limiter.requests = TokenBucket(requests_per_minute)
+        if tokens_per_minute and tokens_per_minute != limiter.tokens.per_minute:
+            limiter.tokens = TokenBucket(tokens_per_minute)
+    return limiter
+
+def rate_limiter_stats() -> Dict[str, Dict]:
+    return {model: limiter.stats() for model, limiter in _limiters.items()}
+
+def rate_limit_retry_after(error: Exception) -> Tuple[bool, Optional[float]]:
+    """Whether error is a rate limit error, and the retry-after it carries (if any)"""
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if status != 429 and type(error).__name__ != 'RateLimitError' and not re.search(r'\b429\b', str(error)):
+        return False, None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return True, float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return True, None
+
+class RateLimitedChatClient:
+    """Wraps a chat client so every call is admitted by a RateLimiter and retried on rate limits.
+
+    chat() takes an extra `priority` keyword (PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW)
+    that is not passed on to the wrapped client. Without a limiter calls are passed through.
+    count_tokens is a coroutine function returning the token count of a text."""
+
+    def __init__(self, client, limiter: Optional[RateLimiter], count_tokens, max_retries: int = 6):
+        self.client = client
+        self.limiter = limiter
+        self.count_tokens = count_tokens
+        self.max_retries = max_retries
+
+    async def chat(self, prompt: str, priority: int = PRIORITY_NORMAL, **kwargs) -> str:
+        if self.limiter is None:
+            return await self.client.chat(prompt=prompt, **kwargs)
+        prompt_tokens = await count_call_tokens('prompt', prompt, self.count_tokens)
+        expected_tokens = prompt_tokens + kwargs.get('max_tokens', DEFAULT_COMPLETION_TOKENS)
+        queue_wait = 0.0
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            await self.limiter.acquire(expected_tokens, priority)
+            queue_wait += time.monotonic() - started
+            note_call(queue_wait=queue_wait, retries=attempt)
+            try:
+                response = await self.client.chat(prompt=prompt, **kwargs)
+            except Exception as e:
+                is_rate_limit, retry_after = rate_limit_retry_after(e)
+                if not is_rate_limit or attempt == self.max_retries:
+                    raise
+                self.limiter.report_rate_limited(retry_after)
+                continue
+            self.limiter.report_success()
+            completion_tokens = await count_call_tokens('completion', response, self.count_tokens)
+            self.limiter.adjust(prompt_tokens + completion_tokens - expected_tokens)
+            return response
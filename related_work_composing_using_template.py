@@ -1,12 +1,15 @@
 import os
-import json
 import asyncio
 import logging
+from typing import List
 from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.openai_utils import GPTClient
 from section_composer import SectionComposer, setup_logging
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW
+from paper_router import PaperRouter
+from paper_digest import get_digest_store, parse_digest, render_digest
+from paper_source import PaperFile, PaperSource
 
 '''
 # Related Work Composition Flow
@@ -53,8 +56,21 @@ and related papers to generate a comprehensive literature review section.
 '''
 
 class RelatedWorkComposer(SectionComposer):
-    def __init__(self, research_field: str, structure_iterations: int = 3):
-        super().__init__(research_field, "related_work", structure_iterations)
+    # Focus on literature review related agent files
+    AGENT_FILES = [
+        'prepare_agent.json',
+        'survey_agent.json',
+    ]
+
+    # Papers digested at once; bounds the paper excerpts held in memory
+    DIGEST_CONCURRENCY = 8
+
+    def __init__(self, research_field: str, structure_iterations: int = 3, paper_relevance: float = 0.3,
+                 max_papers_per_subsection: int = 8, **kwargs):
+        super().__init__(research_field, "related_work", structure_iterations, **kwargs)
+        # Each subsection is only written from the related papers that match it, see paper_router.py
+        self.paper_relevance = paper_relevance
+        self.max_papers_per_subsection = max_papers_per_subsection
 
     async def generate_or_revise_structure(self, content: str, current_structure: str, iteration: int) -> str:
         prompt = f"""Based on the given content, generate or revise the related work structure, using latex format.
@@ -115,7 +131,7 @@ Output only the LaTeX structure with comments as specified above."""
         return await self.gpt_client.chat(prompt=prompt)
 
     async def detailize_subsection(self, structure: str, current_text: str, content: str, subsection: str) -> str:
-        writing_template = self.get_random_template()
+        writing_template = await self.select_template(f"{subsection}\n{current_text}\n{content}")
         
         prompt = f"""Write or revise the following subsection of the related work:
 \subsection{{{subsection}}}
@@ -167,7 +183,7 @@ Requirements for related work writing:
 
 Output the detailed LaTeX text for this subsection only."""
 
-        return await self.gpt_client.chat(prompt=prompt)
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_LOW)
 
     async def final_writing_checklist(self, related_work_text: str) -> str:
         prompt = f"""Review and revise the related work section following these academic writing guidelines:
@@ -188,46 +204,92 @@ CHECKLIST FOR REVISION:
 
 Output the revised related work section incorporating all these improvements. Reply with LaTeX code only."""
 
-        return await self.gpt_client.chat(prompt=prompt)
-
-    def read_related_papers(self, papers_dir):
-        """Read all related papers from the papers directory"""
-        papers_content = []
-        for filename in os.listdir(papers_dir):
-            if filename.endswith('.txt') or filename.endswith('.json'):
+        return await self.gpt_client.chat(prompt=prompt, priority=PRIORITY_HIGH)
+
+    async def digest_paper(self, paper: PaperFile) -> str:
+        """Condensed form of a related paper for the subsection prompts, see paper_digest.py.
+
+        Only an excerpt of the paper's front matter, abstract, introduction, method and
+        conclusion is read into memory. Falls back to the excerpt if the model does not return a
+        usable digest."""
+        instructions = """Summarize the following paper for the related work section of another paper.
+
+Reply with a single JSON object and nothing else:
+{
+  "title": "paper title",
+  "contribution": "main contribution and key results, 2-3 sentences",
+  "method_family": "family of methods the paper belongs to, a few words",
+  "limitations": "main limitations, 1-2 sentences",
+  "bibtex": {"key": "citation key, e.g. vandenoord2017neural", "author": "authors in BibTeX format", "title": "paper title", "year": "publication year", "venue": "journal or conference"}
+}
+
+Only use information found in the paper.
+
+PAPER:
+"""
+        async def create():
+            content = await self.pack_content(
+                await self.run_io(paper.excerpt), "abstract contribution method results limitations", instructions)
+            return parse_digest(await self.gpt_client.chat(prompt=instructions + content))
+
+        key = await self.run_io(paper.content_hash)
+        digest = await get_digest_store(self.research_field).get_or_create(key, create)
+        if digest is None:
+            logging.warning(f"No usable digest for {paper.filename}, using an excerpt of it")
+            return await self.run_io(paper.excerpt)
+        return render_digest(digest)
+
+    async def digest_papers(self, papers: PaperSource) -> List[str]:
+        """Digests of all related papers, in order, at most DIGEST_CONCURRENCY at a time"""
+        semaphore = asyncio.Semaphore(self.DIGEST_CONCURRENCY)
+
+        async def digest(paper):
+            async with semaphore:
                 try:
-                    with open(os.path.join(papers_dir, filename), 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        papers_content.append({
-                            'filename': filename,
-                            'content': content
-                        })
-                except Exception as e:
-                    logging.error(f"Error reading paper file {filename}: {str(e)}")
-        return papers_content
-    
+                    return await self.digest_paper(paper)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Error reading paper file {paper.filename}: {str(e)}")
+                    return ""
+
+        return list(await asyncio.gather(*[digest(paper) for paper in papers]))
+
+    def read_related_papers(self, papers_dir) -> PaperSource:
+        """The related papers in the papers directory, read lazily, see paper_source.py"""
+        return PaperSource(papers_dir)
+
+    def route_papers(self, structure: str, subsections, paper_texts: List[str]):
+        """Indices of the related papers to fold into each subsection one by one, and the subsection
+        and indices of the papers that match no subsection, folded in together in one step"""
+        if not paper_texts or not subsections:
+            return {subsection: [] for subsection in subsections}, None, []
+        router = PaperRouter([(str(i), text) for i, text in enumerate(paper_texts)],
+                             self.paper_relevance, self.max_papers_per_subsection)
+        routes, leftover_subsection, leftovers = router.route(
+            {subsection: self.describe_subsection(structure, subsection) for subsection in subsections})
+        leftovers = [int(i) for i in leftovers if paper_texts[int(i)]]
+        return ({subsection: [int(i) for i in routes.get(subsection, []) if paper_texts[int(i)]]
+                 for subsection in subsections}, leftover_subsection if leftovers else None, leftovers)
+
     async def compose_section(self, agent_dir: str, papers_dir: str, benchmark_path: str, target_paper: str) -> str:
         checkpoint_dir = self.get_checkpoint_path(target_paper)
         os.makedirs(checkpoint_dir, exist_ok=True)
 
-        # Focus on literature review related agent files
-        agent_files = [
-            'prepare_agent.json',
-            'survey_agent.json',
-
-            # 'coding_plan_agent.json',
-            # 'machine_learning_agent.json',
-            # 'judge_agent.json',
-            # 'machine_learning_agent_iter_submit.json',
-            # 'experiment_analysis_agent_iter_refine_1.json',
-            # 'machine_learning_agent_iter_refine_1.json',
-        ]
+        agent_files = self.AGENT_FILES
         
         # Read related papers
         related_papers = self.read_related_papers(papers_dir)
         logging.info(f"Found {len(related_papers)} related papers in {papers_dir}")
 
+        # Digest every paper once; digests are reused across subsections, runs and instances
+        self.set_trace_stage("digest")
+        store = get_digest_store(self.research_field)
+        created = store.misses
+        paper_digests = await self.digest_papers(related_papers)
+        created = store.misses - created
+        logging.info(f"Paper digests: {created} created, {len(related_papers) - created} reused")
+
         # Step 1: Iterative structure generation
+        self.set_trace_stage("structure")
         structure = ""
         structure_checkpoint = self.load_checkpoint(target_paper, "structure")
         
@@ -236,14 +298,14 @@ Output the revised related work section incorporating all these improvements. Re
             logging.info("Loaded structure from checkpoint")
         else:
             for iteration in range(self.structure_iterations):
+                self.set_trace_stage("structure", iteration + 1)
                 logging.info(f"Structure iteration {iteration + 1}/{self.structure_iterations}")
                 
                 # Process agent files for literature information
                 for idx, agent_file in enumerate(tqdm(agent_files, desc="Processing agent files")):
-                    with open(os.path.join(agent_dir, agent_file), 'r') as f:
-                        content = json.load(f)
+                    content = self.agent_store.load(agent_dir, agent_file).text
                     structure = await self.generate_or_revise_structure(
-                        json.dumps(content, indent=2), structure, iteration + 1)
+                        content, structure, iteration + 1)
                 
                 self.write_temp_log(structure, f"iteration_{iteration+1}_final")
             
@@ -252,9 +314,8 @@ Output the revised related work section incorporating all these improvements. Re
             })
 
         # Step 2: Detailize subsections
-        subsections = [line.split('{')[1].split('}')[0] 
-                    for line in structure.split('\n') 
-                    if line.strip().startswith('\\subsection')]
+        self.set_trace_stage("detailize")
+        subsections = self.get_subsections(structure)
         
         subsection_contents = {}
         subsection_checkpoint = self.load_checkpoint(target_paper, "subsections")
@@ -263,38 +324,34 @@ Output the revised related work section incorporating all these improvements. Re
             subsection_contents = subsection_checkpoint
             logging.info("Loaded subsection contents from checkpoint")
         else:
-            for subsection_id, subsection in enumerate(tqdm(subsections, desc="Detailizing subsections")):
-                related_work_part = ''
-                
+            paper_routes, leftover_subsection, leftovers = self.route_papers(structure, subsections, paper_digests)
+
+            async def detailize(subsection_id, subsection):
                 # First process agent contents
+                steps = []
                 for i, agent_file in enumerate(agent_files):
-                    with open(os.path.join(agent_dir, agent_file), 'r') as f:
-                        content = json.load(f)
-                    related_work_part = await self.detailize_subsection(
-                        structure, related_work_part, json.dumps(content, indent=2), subsection)
-                    
-                    self.write_temp_log(
-                        related_work_part,
-                        f"subsection_{subsection_id}_agent_{i}"
-                    )
-                
-                # Then process related papers
-                for i, paper in enumerate(tqdm(related_papers, desc=f"Processing related papers for subsection {subsection}")):
-                    related_work_part = await self.detailize_subsection(
-                        structure, related_work_part, paper['content'], subsection)
-                    
-                    self.write_temp_log(
-                        related_work_part,
-                        f"subsection_{subsection_id}_paper_{i}"
-                    )
-                    
-                    subsection_contents[subsection] = related_work_part
-                    self.save_checkpoint(target_paper, "subsections", subsection_contents)
+                    steps.append((f"agent_{i}", self.agent_store.load(agent_dir, agent_file).text))
+
+                # Then process the related papers routed to this subsection, most relevant first
+                for i in paper_routes[subsection]:
+                    steps.append((f"paper_{i}", paper_digests[i]))
+                # The papers no subsection matched, in one step
+                if subsection == leftover_subsection:
+                    steps.append(("other_papers", '\n\n'.join(paper_digests[i] for i in leftovers)))
+
+                return await self.fold_into_subsection(
+                    structure, subsection, subsection_id, steps, step_log=step_log)
+
+            step_log = self.open_step_log(target_paper, structure)
+            subsection_contents = await self.detailize_subsections(subsections, detailize)
+            self.save_checkpoint(target_paper, "subsections", subsection_contents)
+            step_log.clear()
 
 
         # Step 3: Fuse all subsections
+        self.set_trace_stage("fuse")
         self.write_temp_log(
-            json.dumps(subsection_contents, indent=2),
+            await self.dumps_json(subsection_contents),
             "pre_fusion_subsections"
         )
         
@@ -302,24 +359,19 @@ Output the revised related work section incorporating all these improvements. Re
         self.write_temp_log(fused_related_work, "post_fusion_related_work")
 
         # Step 4: Final writing checklist
+        self.set_trace_stage("checklist")
         final_related_work = await self.final_writing_checklist(fused_related_work)
         self.write_temp_log(final_related_work, "post_checklist_related_work")
 
         # Save final output
-        output_dir = f"{self.research_field}/target_sections/{self.normalize_title(target_paper)}"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "related_work.tex")
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(final_related_work)
-        logging.info(f"Saved final related work to {output_path}")
+        self.save_section_output(target_paper, final_related_work)
 
         return final_related_work
 
-async def related_work_composing(research_field: str, instance_id: str):
+async def related_work_composing(research_field: str, instance_id: str, **composer_options):
     setup_logging(research_field)
     
-    composer = RelatedWorkComposer(research_field=research_field)
+    composer = RelatedWorkComposer(research_field=research_field, **composer_options)
     
     # Use local paths instead of hardcoded absolute paths
     proj_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), research_field, instance_id)
@@ -0,0 +1,325 @@
+import os
+import re
+import csv
+import json
+import logging
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+'''
+# Results Extraction
+
+Numerical results are read from the agent files and the project's output files (JSON metric
+dumps, CSV tables, training logs) without the model, into a table of typed records:
+
+    experiment        variant                               dataset   metric               value   source
+    ablation_studies  without Rotation Transformation                 reconstruction_loss  0.0189  experiment_analysis_agent_iter_refine_1.json:ablation_studies[1].reconstruction_loss
+    results                                                           perplexity           7950.4  machine_learning_agent_iter_refine_1.json:results.perplexity
+
+A numeric value counts as a result if it sits under a results-like key (results, metrics,
+evaluation, ablation, ...) or its own key names a metric (loss, accuracy, fid, ...), and it is not
+under a settings-like key (training, architecture, hyperparameters, ...).
+
+fill_result_tables() then fills the placeholder cells (`--`, `?`, `TBD`, `x.xx`, ...) of the LaTeX
+tables in a structure, including tables written in comments, by matching column headers to
+metrics and row labels to variants. A row only matches a record if it names the record's variant
+and nothing else (see ResultRecord.matches_row), and each filled value is copied from the record
+verbatim; every other cell is left for the model.
+'''
+
+# Key terms of numeric values that are results
+METRIC_TERMS = ('loss', 'accuracy', 'acc', 'error', 'usage', 'utilization', 'perplexity', 'fid', 'psnr',
+                'ssim', 'lpips', 'mse', 'mae', 'rmse', 'precision', 'recall', 'f1', 'auc', 'map', 'ndcg',
+                'hr', 'hit', 'mrr', 'bleu', 'rouge', 'score', 'bpd', 'nll', 'likelihood', 'throughput', 'latency', 'runtime', 'speedup', 'top1', 'top5')
+# Keys whose numeric descendants are results
+CONTAINER_TERMS = ('result', 'results', 'metric', 'metrics', 'evaluation', 'eval', 'ablation',
+                   'performance', 'comparison', 'scores', 'benchmark', 'benchmarks', 'test', 'validation')
+# Keys whose numeric descendants are settings, not results
+SETTING_TERMS = ('training', 'train', 'architecture', 'hyperparameters', 'hyperparameter', 'config',
+                 'configuration', 'implementation', 'setting', 'settings', 'optimizer', 'model', 'datasets')
+# String fields that name what a record measures
+LABEL_KEYS = ('name', 'method', 'model', 'baseline', 'variant', 'component', 'setting', 'config',
+              'experiment', 'approach', 'ablation', 'split')
+DATASET_KEYS = ('dataset', 'dataset_name', 'data')
+# Numeric fields holding the value of a metric named by a sibling field: {"metric": "FID", "value": 3.1}
+VALUE_KEYS = ('value', 'score', 'result')
+METRIC_NAME_KEYS = ('metric', 'metric_name', 'name')
+# Row label words naming the proposed method, and words a row label may add to any variant
+PROPOSED_TERMS = ('ours', 'proposed', 'full')
+NEUTRAL_TERMS = PROPOSED_TERMS + ('our', 'model', 'method', 'approach')
+
+OUTPUT_EXTENSIONS = ('.json', '.csv', '.log')
+MAX_OUTPUT_BYTES = 5 * 1024 * 1024
+SKIPPED_DIRS = ('__pycache__', '.git', 'node_modules')
+
+PLACEHOLDER_PATTERN = re.compile(
+    r'^(?:|-{1,3}|\?+|[xX]+(?:\.[xX]+)?%?|TBD|TODO|\.\.\.|\\dots|\\ldots|\[[^\]]*\]|\\textit\{TBD\})$')
+LOG_PATTERN = re.compile(r'([A-Za-z][\w\-@ ]{0,30}?)\s*[:=]\s*(-?\d+(?:\.\d+)?(?:[eE]-?\d+)?)')
+NUMBER_PATTERN = re.compile(r'-?\d+\.\d+')
+
+def terms(text: str) -> List[str]:
+    """Lowercase word terms of a key, header or label; 'w/o' reads as 'without'"""
+    text = re.sub(r'\\[a-zA-Z]+', ' ', text)
+    text = re.sub(r'\bw/o\b', ' without ', text, flags=re.IGNORECASE)
+    return re.findall(r'[a-z0-9]+', text.replace('_', ' ').lower())
+
+def is_metric_key(key: str) -> bool:
+    return any(term in METRIC_TERMS for term in terms(key))
+
+def has_term(key: str, vocabulary: Sequence[str]) -> bool:
+    return any(term in vocabulary for term in terms(key))
+
+class ResultRecord:
+    def __init__(self, experiment: str, variant: str, dataset: str, metric: str, value: float,
+                 text: str, source: str):
+        """
+        Args:
+            experiment: Results container the value belongs to (e.g. "ablation_studies")
+            variant: Method, baseline or ablation setting the value was measured for ("" for the
+                proposed method itself)
+            dataset: Dataset the value was measured on ("" if not stated)
+            metric: Metric name as written in the source
+            value: Numeric value
+            text: Value as written in the source, keeping its precision
+            source: File and path of the value in it
+        """
+        self.experiment = experiment
+        self.variant = variant
+        self.dataset = dataset
+        self.metric = metric
+        self.value = value
+        self.text = text
+        self.source = source
+
+    def to_dict(self) -> Dict:
+        return {'experiment': self.experiment, 'variant': self.variant, 'dataset': self.dataset,
+                'metric': self.metric, 'value': self.value, 'source': self.source}
+
+    def matches_row(self, row_terms: Set[str]) -> bool:
+        """Whether a table row with these label terms names exactly this record's variant.
+
+        Every term of the variant must appear in the row, and the row may only add terms of the
+        record's experiment and dataset or neutral words ("model", "method", ...). Any other term,
+        such as a qualifier ("w/o", "no") or another method's name, makes the row a different
+        variant. The proposed method itself (empty variant) must be named "ours", "proposed" or
+        "full"."""
+        variant_terms = set(terms(self.variant))
+        if not variant_terms <= row_terms:
+            return False
+        if not self.variant and not row_terms & set(PROPOSED_TERMS):
+            return False
+        allowed = variant_terms | set(terms(self.experiment)) | set(terms(self.dataset)) | set(NEUTRAL_TERMS)
+        return row_terms <= allowed
+
+class ResultsTable:
+    def __init__(self, records: Optional[List[ResultRecord]] = None):
+        self.records: List[ResultRecord] = list(records or [])
+
+    def __len__(self):
+        return len(self.records)
+
+    def extend(self, records: Iterable[ResultRecord]):
+        self.records.extend(records)
+
+    def metrics(self) -> List[str]:
+        return sorted({record.metric for record in self.records})
+
+    def render(self) -> str:
+        """One tab-separated line per record, with a header"""
+        columns = ['experiment', 'variant', 'dataset', 'metric', 'value', 'source']
+        lines = ['\t'.join(columns)]
+        for record in self.records:
+            lines.append('\t'.join([record.experiment, record.variant, record.dataset, record.metric,
+                                    record.text, record.source]))
+        return '\n'.join(lines)
+
+    def match_metric(self, header: str) -> Optional[str]:
+        """Metric a column header names, or None"""
+        header_terms = set(terms(header))
+        if not header_terms:
+            return None
+        best, best_score = None, 0.0
+        for metric in self.metrics():
+            metric_terms = set(terms(metric))
+            score = len(header_terms & metric_terms) / len(header_terms | metric_terms)
+            if score > best_score:
+                best, best_score = metric, score
+        return best if best_score >= 0.5 else None
+
+    def lookup(self, metric: str, row_label: str) -> Optional[ResultRecord]:
+        """The record of metric a table row names, or None if no record matches it exactly or
+        the matching records disagree on the value"""
+        row_terms = set(terms(row_label))
+        matches = [record for record in self.records
+                   if record.metric == metric and record.matches_row(row_terms)]
+        if not matches or len({record.text for record in matches}) > 1:
+            return None
+        return matches[0]
+
+def extract_json(data, source: str, experiment: str = "", in_results: bool = False) -> List[ResultRecord]:
+    """Result records in parsed JSON data"""
+    known_datasets = set()
+    if isinstance(data, dict) and isinstance(data.get('datasets'), list):
+        known_datasets = {str(item.get('name')).lower() for item in data['datasets']
+                          if isinstance(item, dict) and item.get('name')}
+    records = []
+
+    def walk(node, path, experiment, variant, dataset, in_results):
+        if isinstance(node, dict):
+            metric_name = next((node[key] for key in METRIC_NAME_KEYS if isinstance(node.get(key), str)), None)
+            value_key = next((key for key in VALUE_KEYS if type(node.get(key)) in (int, float)), None)
+            if metric_name and value_key:
+                records.append(ResultRecord(experiment or "results", variant, dataset, metric_name,
+                                            float(node[value_key]), json.dumps(node[value_key]),
+                                            f"{source}:{path}.{value_key}"))
+                return
+            labels = [str(node[key]) for key in LABEL_KEYS if isinstance(node.get(key), str)]
+            flags = [(key, value) for key, value in node.items() if isinstance(value, bool)]
+            if labels and len(flags) == 1:
+                labels = [f"{'with' if flags[0][1] else 'without'} {labels[0]}"] + labels[1:]
+            if labels:
+                variant = ', '.join(filter(None, [variant] + labels))
+            dataset = next((str(node[key]) for key in DATASET_KEYS if isinstance(node.get(key), str)), dataset)
+            for key, value in node.items():
+                child = f"{path}.{key}" if path else key
+                if isinstance(value, bool) or isinstance(value, str):
+                    continue
+                if isinstance(value, (int, float)):
+                    if in_results or is_metric_key(key):
+                        records.append(ResultRecord(experiment or "results", variant, dataset, key, float(value),
+                                                    json.dumps(value), f"{source}:{child}"))
+                    continue
+                if has_term(key, SETTING_TERMS) and not has_term(key, CONTAINER_TERMS):
+                    continue
+                if str(key).lower() in known_datasets:
+                    walk(value, child, experiment, variant, str(key), in_results)
+                elif has_term(key, CONTAINER_TERMS):
+                    walk(value, child, experiment or key, variant, dataset, True)
+                elif in_results:
+                    # A nested key under results names a method or setting
+                    walk(value, child, experiment, ', '.join(filter(None, [variant, key])), dataset, in_results)
+                else:
+                    walk(value, child, experiment, variant, dataset, in_results)
+        elif isinstance(node, list):
+            for index, item in enumerate(node):
+                walk(item, f"{path}[{index}]", experiment, variant, dataset, in_results)
+
+    walk(data, "", experiment, "", "", in_results)
+    return records
+
+def extract_csv(path: str, source: str) -> List[ResultRecord]:
+    """Result records in a CSV table with a header row: numeric metric columns are values, the
+    other columns label the row"""
+    experiment = os.path.splitext(os.path.basename(path))[0]
+    records = []
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            numbers, labels, dataset = {}, [], ""
+            for column, cell in row.items():
+                if column is None or cell is None:
+                    continue
+                try:
+                    numbers[column] = (float(cell), cell.strip())
+                except ValueError:
+                    if column.lower() in DATASET_KEYS:
+                        dataset = cell.strip()
+                    elif cell.strip():
+                        labels.append(cell.strip())
+            for column, (value, text) in numbers.items():
+                if is_metric_key(column) or has_term(experiment, CONTAINER_TERMS):
+                    records.append(ResultRecord(experiment, ', '.join(labels), dataset, column, value, text,
+                                                f"{source}:{line}"))
+    return records
+
+def extract_log(path: str, source: str) -> List[ResultRecord]:
+    """Last logged value of every metric in a log file"""
+    experiment = os.path.splitext(os.path.basename(path))[0]
+    latest: Dict[str, ResultRecord] = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line_number, line in enumerate(f, start=1):
+            for name, text in LOG_PATTERN.findall(line):
+                name = name.strip()
+                if is_metric_key(name):
+                    latest[name.lower()] = ResultRecord(experiment, "", "", name, float(text), text,
+                                                        f"{source}:{line_number}")
+    return list(latest.values())
+
+def extract_project_outputs(project_dir: str) -> List[ResultRecord]:
+    """Result records in the JSON, CSV and log files of a project directory"""
+    records = []
+    if not os.path.isdir(project_dir):
+        return records
+    for root, dirs, files in os.walk(project_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIPPED_DIRS)
+        for filename in sorted(files):
+            if not filename.endswith(OUTPUT_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            source = os.path.relpath(path, project_dir)
+            if os.path.getsize(path) > MAX_OUTPUT_BYTES:
+                logging.warning(f"Skipping results in {source}: larger than {MAX_OUTPUT_BYTES} bytes")
+                continue
+            try:
+                if filename.endswith('.json'):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        stem = os.path.splitext(filename)[0]
+                        records.extend(extract_json(json.load(f), source, stem, has_term(stem, CONTAINER_TERMS)))
+                elif filename.endswith('.csv'):
+                    records.extend(extract_csv(path, source))
+                else:
+                    records.extend(extract_log(path, source))
+            except (OSError, ValueError, csv.Error) as e:
+                logging.warning(f"Skipping results in {source}: {str(e)}")
+    return records
+
+def split_row(line: str) -> Tuple[str, List[str], str]:
+    """(prefix, cells, suffix) of a table row line; the prefix keeps indentation and a comment
+    marker, the suffix the row terminator"""
+    match = re.match(r'^(\s*%?\s*)(.*?)(\s*\\\\.*)?$', line)
+    prefix, body, suffix = match.group(1), match.group(2), match.group(3) or ''
+    return prefix, [cell.strip() for cell in re.split(r'(?<!\\)&', body)], suffix
+
+def is_row(line: str) -> bool:
+    return bool(re.search(r'(?<!\\)&', line)) and not re.match(r'^\s*%?\s*\\begin\{', line)
+
+def fill_result_tables(structure: str, table: ResultsTable) -> Tuple[str, int, List[Tuple[str, str]]]:
+    """Fill placeholder cells of the tables in a structure from a results table.
+
+    Returns:
+        (filled structure, number of filled cells, (row label, column header) of the placeholder
+        cells that could not be resolved)
+    """
+    lines = structure.split('\n')
+    filled, unresolved = 0, []
+    header: Optional[List[str]] = None
+    for index, line in enumerate(lines):
+        if not is_row(line):
+            # Rules and comments between rows keep the current table open
+            if not re.match(r'^\s*%?\s*(\\(hline|toprule|midrule|bottomrule|cline)\b.*)?$', line):
+                header = None
+            continue
+        prefix, cells, suffix = split_row(line)
+        if header is None:
+            header = cells
+            continue
+        changed = False
+        row_label = ' '.join(cell for cell in cells
+                             if not PLACEHOLDER_PATTERN.match(cell) and not NUMBER_PATTERN.fullmatch(cell))
+        for column, cell in enumerate(cells):
+            if column == 0 or column >= len(header) or not PLACEHOLDER_PATTERN.match(cell):
+                continue
+            metric = table.match_metric(header[column])
+            record = table.lookup(metric, row_label) if metric else None
+            if record is None:
+                unresolved.append((cells[0], header[column]))
+                continue
+            cells[column] = record.text
+            filled += 1
+            changed = True
+        if changed:
+            lines[index] = f"{prefix}{' & '.join(cells)}{suffix}"
+    return '\n'.join(lines), filled, unresolved
+
+def unsupported_numbers(text: str, table: ResultsTable, before: str = "") -> List[str]:
+    """Decimal numbers in text that are neither in the results table nor in the text before"""
+    known = {record.text for record in table.records} | set(NUMBER_PATTERN.findall(before))
+    return [number for number in NUMBER_PATTERN.findall(text) if number not in known]
@@ -0,0 +1,202 @@
+import os
+import re
+import glob
+import json
+import sqlite3
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from results_extractor import ResultRecord, extract_json, terms
+
+'''
+# Results Store
+
+The agents refine their experiments over several iterations and write one file per iteration,
+e.g. `machine_learning_agent_iter_submit.json`, `machine_learning_agent_iter_refine_1.json`,
+`machine_learning_agent_iter_refine_2.json`. The results store ingests every `*_iter_*` agent file
+of an instance into a SQLite database (see results_extractor.py for what counts as a result),
+tagging each result with its agent and iteration, so results of different iterations are kept
+apart instead of overwriting or duplicating each other:
+
+    SELECT metric, value, iteration FROM results WHERE metric = 'codebook_usage' ORDER BY iteration
+
+Iterations are numbered by the refine round in the file name; a file without a round (the
+initial submit) is iteration 0. Files are re-ingested only when their size or modification time
+changes, and results of files that disappeared are dropped.
+
+The database lives next to the experiments checkpoints of the instance,
+`{research_field}/experiments_checkpoints/<paper>/results.sqlite`.
+'''
+
+ITERATION_PATTERN = re.compile(r'^(?P<agent>.+?)_iter_(?P<stage>[A-Za-z]+(?:_(?P<round>\d+))?)\.json$')
+# Metrics for which smaller values are better; larger is better for all others
+LOWER_IS_BETTER_TERMS = ('loss', 'error', 'fid', 'mse', 'mae', 'rmse', 'nll', 'bpd', 'lpips', 'latency', 'runtime')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    agent TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    file TEXT NOT NULL REFERENCES files(name) ON DELETE CASCADE,
+    agent TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    experiment TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    text TEXT NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_metric ON results(metric);
+CREATE INDEX IF NOT EXISTS results_dataset ON results(dataset);
+CREATE INDEX IF NOT EXISTS results_iteration ON results(iteration);
+CREATE INDEX IF NOT EXISTS results_variant ON results(experiment, variant, dataset, metric);
+"""
+
+RESULT_COLUMNS = "experiment, variant, dataset, metric, value, text, source, iteration"
+
+def parse_iteration_file(filename: str) -> Optional[Tuple[str, str, int]]:
+    """(agent, stage, iteration) of an iteration agent file name, or None for other files"""
+    match = ITERATION_PATTERN.match(filename)
+    if not match:
+        return None
+    return match.group('agent'), match.group('stage'), int(match.group('round') or 0)
+
+def lower_is_better(metric: str) -> bool:
+    return any(term in LOWER_IS_BETTER_TERMS for term in terms(metric))
+
+def results_db_path(checkpoint_dir: str) -> str:
+    return os.path.join(checkpoint_dir, "results.sqlite")
+
+class StoredResult(ResultRecord):
+    """A result record with the refine iteration it was reported in"""
+
+    def __init__(self, experiment: str, variant: str, dataset: str, metric: str, value: float,
+                 text: str, source: str, iteration: int):
+        super().__init__(experiment, variant, dataset, metric, value, text, source)
+        self.iteration = iteration
+
+    def to_dict(self) -> Dict:
+        return {**super().to_dict(), 'iteration': self.iteration}
+
+class ResultsStore:
+    def __init__(self, db_path: str):
+        """
+        Args:
+            db_path: SQLite database file (":memory:" for a throwaway store)
+        """
+        self.db_path = db_path
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        # Opened on a worker thread by the composers and then used from the event loop, one
+        # caller at a time
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, agent_dir: str, pattern: str = "*_iter_*.json") -> Tuple[int, int]:
+        """Bring the store up to date with the iteration files matching pattern in agent_dir.
+
+        Returns:
+            (files ingested, files unchanged)
+        """
+        known = {name: (size, mtime_ns) for name, size, mtime_ns
+                 in self.connection.execute("SELECT name, size, mtime_ns FROM files")}
+        found = set()
+        ingested = 0
+        with self.connection:
+            for path in sorted(glob.glob(os.path.join(agent_dir, pattern))):
+                name = os.path.basename(path)
+                parsed = parse_iteration_file(name)
+                if parsed is None:
+                    continue
+                found.add(name)
+                stat = os.stat(path)
+                if known.get(name) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        records = extract_json(json.load(f), name)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Skipping results of {name}: {str(e)}")
+                    continue
+                agent, stage, iteration = parsed
+                self.connection.execute("DELETE FROM files WHERE name = ?", (name,))
+                self.connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                        (name, agent, stage, iteration, stat.st_size, stat.st_mtime_ns))
+                self.connection.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(name, agent, iteration, record.experiment, record.variant, record.dataset,
+                      record.metric, record.value, record.text, record.source) for record in records])
+                ingested += 1
+            for name in set(known) - found:
+                self.connection.execute("DELETE FROM files WHERE name = ?", (name,))
+        return ingested, len(found) - ingested
+
+    def files(self) -> List[Tuple[str, str, int]]:
+        """(file name, agent, iteration) of the ingested files, oldest iteration first"""
+        return list(self.connection.execute("SELECT name, agent, iteration FROM files ORDER BY iteration, name"))
+
+    def latest_files(self) -> List[str]:
+        """The file of the latest iteration of every agent"""
+        rows = self.connection.execute(
+            "SELECT name FROM (SELECT name, agent, ROW_NUMBER() OVER "
+            "(PARTITION BY agent ORDER BY iteration DESC, stage DESC) AS position FROM files) "
+            "WHERE position = 1 ORDER BY agent")
+        return [name for name, in rows]
+
+    def rows(self, sql: str, parameters: Sequence = ()) -> List[StoredResult]:
+        return [StoredResult(*row) for row in self.connection.execute(sql, parameters)]
+
+    def query(self, metric: Optional[str] = None, dataset: Optional[str] = None,
+              iteration: Optional[int] = None, variant: Optional[str] = None) -> List[StoredResult]:
+        """Results matching all given filters, by iteration"""
+        filters = {'metric': metric, 'dataset': dataset, 'iteration': iteration, 'variant': variant}
+        conditions = [(f"{column} = ?", value) for column, value in filters.items() if value is not None]
+        where = f"WHERE {' AND '.join(condition for condition, _ in conditions)}" if conditions else ""
+        return self.rows(f"SELECT {RESULT_COLUMNS} FROM results {where} ORDER BY iteration, file, rowid",
+                         [value for _, value in conditions])
+
+    def latest(self) -> List[StoredResult]:
+        """The most recent result of every (experiment, variant, dataset, metric), e.g. the latest
+        numbers of each baseline and of the proposed method (variant "") in every experiment.
+
+        Experiments are kept apart, so the same variant reported by the main comparison and by
+        a sensitivity study yields one result for each."""
+        return self.rows(
+            f"SELECT {RESULT_COLUMNS} FROM (SELECT *, ROW_NUMBER() OVER "
+            f"(PARTITION BY experiment, variant, dataset, metric ORDER BY iteration DESC, file, rowid) AS position "
+            f"FROM results) WHERE position = 1 ORDER BY metric, dataset, experiment, variant")
+
+    def best_per_metric(self) -> List[StoredResult]:
+        """The best result of every (metric, dataset) over all variants and iterations"""
+        best = []
+        for metric, in self.connection.execute("SELECT DISTINCT metric FROM results ORDER BY metric"):
+            order = "ASC" if lower_is_better(metric) else "DESC"
+            best.extend(self.rows(
+                f"SELECT {RESULT_COLUMNS} FROM (SELECT *, ROW_NUMBER() OVER "
+                f"(PARTITION BY dataset ORDER BY value {order}, iteration DESC) AS position "
+                f"FROM results WHERE metric = ?) WHERE position = 1 ORDER BY dataset", (metric,)))
+        return best
+
+    def summary(self) -> str:
+        """Latest and best results as tab-separated tables for prompts"""
+        def table(records):
+            lines = ['\t'.join(['iteration', 'experiment', 'variant', 'dataset', 'metric', 'value', 'source'])]
+            lines.extend('\t'.join([str(record.iteration), record.experiment, record.variant, record.dataset,
+                                    record.metric, record.text, record.source]) for record in records)
+            return '\n'.join(lines)
+
+        iterations = sorted({iteration for _, _, iteration in self.files()})
+        return (f"Experimental results over refine iterations {iterations}\n\n"
+                f"Latest result of every method, baseline and ablation variant per experiment:\n{table(self.latest())}\n\n"
+                f"Best result of every metric:\n{table(self.best_per_metric())}")
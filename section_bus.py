@@ -0,0 +1,82 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+'''
+# Section Bus
+
+Composers that build on other sections (introduction, conclusion, abstract) used to re-read their
+inputs from `target_sections/` and relied on the scheduler having run the writers first. Final
+section texts are now also published on an in-process bus:
+
+- A composer publishes its final text right after writing it to `target_sections/`, which stays
+  the durable copy.
+- A reader gets a published text immediately. If the section is still expected in this process
+  (the scheduler announces every section of a paper before starting them), the reader waits for
+  it. Otherwise, e.g. for a composer run on its own, it falls back to the file on disk.
+'''
+
+SectionKey = Tuple[str, str, str]
+
+class SectionBus:
+    def __init__(self):
+        # (research_field, paper, section) -> final text
+        self.texts: Dict[SectionKey, str] = {}
+        # Sections announced but neither published nor withdrawn yet
+        self.expected: set = set()
+        self.waiters: Dict[SectionKey, List[asyncio.Future]] = {}
+
+    def expect(self, research_field: str, paper: str, section: str):
+        """Announce that section will be published in this process, so readers wait for it"""
+        key = (research_field, paper, section)
+        if key not in self.texts:
+            self.expected.add(key)
+
+    def publish(self, research_field: str, paper: str, section: str, text: str):
+        key = (research_field, paper, section)
+        self.texts[key] = text
+        self.settle(key, text)
+
+    def withdraw(self, research_field: str, paper: str, section: str):
+        """The section will not be published after all (e.g. its composer failed); waiting
+        readers fall back to disk"""
+        key = (research_field, paper, section)
+        if key not in self.texts:
+            self.settle(key, None)
+
+    def settle(self, key: SectionKey, text: Optional[str]):
+        self.expected.discard(key)
+        for waiter in self.waiters.pop(key, []):
+            if not waiter.done():
+                waiter.set_result(text)
+
+    def get(self, research_field: str, paper: str, section: str) -> Optional[str]:
+        return self.texts.get((research_field, paper, section))
+
+    async def wait_for(self, research_field: str, paper: str, section: str) -> Optional[str]:
+        """The published text of section, waiting for it if it is expected; None if it is
+        neither published nor expected, or was withdrawn"""
+        key = (research_field, paper, section)
+        if key in self.texts:
+            return self.texts[key]
+        if key not in self.expected:
+            return None
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, []).append(waiter)
+        try:
+            return await waiter
+        finally:
+            if key in self.waiters and waiter in self.waiters[key]:
+                self.waiters[key].remove(waiter)
+
+    def discard(self, research_field: str, paper: str):
+        """Drop the texts of a paper, e.g. once all of its sections are written"""
+        for key in [key for key in self.texts if key[:2] == (research_field, paper)]:
+            del self.texts[key]
+        for key in [key for key in self.expected if key[:2] == (research_field, paper)]:
+            self.settle(key, None)
+
+_bus = SectionBus()
+
+def get_section_bus() -> SectionBus:
+    """The process-wide section bus"""
+    return _bus
@@ -1,16 +1,26 @@
 import os
 import json
+import time
+import asyncio
 import logging
-from datetime import datetime
-import random
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from tqdm import tqdm
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.openai_utils import GPTClient
+from llm_cache import CachedChatClient, get_response_cache
+from llm_backend import create_backend
+from rate_limiter import RateLimitedChatClient, get_rate_limiter
+from agent_store import AgentArtifactStore
+from context_packer import ContextPacker, BudgetedChatClient, PROMPT_OVERHEAD
+from template_index import select_template
+from checkpoint_log import SubsectionStepLog
+from latex_outline import Outline, get_outline
+from section_bus import get_section_bus
+from trace_writer import TracingChatClient, get_trace_writer, trace_context, trace_stage, trace_iteration, trace_subsection, trace_step
+import executors
 
 def setup_logging(research_field):
-    os.makedirs(f"{research_field}/temp", exist_ok=True)
     os.makedirs(f"{research_field}/target_sections", exist_ok=True)
     os.makedirs(f"{research_field}/methodology_checkpoints", exist_ok=True)
     
@@ -22,21 +32,61 @@ def setup_logging(research_field):
             logging.StreamHandler()]
     )
 
+# How content pieces are folded into a subsection: "sequential" revises the text once per piece,
+# "tree" drafts from every piece in parallel and merges the drafts pairwise
+FOLD_MODES = ("sequential", "tree")
+
+def llm_cache_dir(research_field):
+    return f"{research_field}/llm_cache"
+
 class SectionComposer(ABC):
-    def __init__(self, research_field: str, section_name: str, structure_iterations: int = 3, gpt_model='gpt-4o-mini-2024-07-18'):
-        self.gpt_client = GPTClient(model=gpt_model)
+    # Agent files (in cache_*/agents/) and target_sections outputs the composer reads
+    AGENT_FILES: List[str] = []
+    INPUT_SECTIONS: List[str] = []
+    # Agent files are parsed and serialized once and shared by all composers in the process
+    agent_store = AgentArtifactStore()
+    # Final section texts are published here for the composers that read them, see section_bus.py
+    section_bus = get_section_bus()
+
+    def __init__(self, research_field: str, section_name: str, structure_iterations: int = 3, gpt_model='gpt-4o-mini-2024-07-18',
+                 subsection_concurrency: int = 1, fold_mode: str = "sequential", bypass_llm_cache: bool = False,
+                 context_budget: Optional[int] = None, llm_backend: str = "openai",
+                 llm_backend_options: Optional[Dict] = None, requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None):
+        if fold_mode not in FOLD_MODES:
+            raise ValueError(f"Unknown fold mode {fold_mode!r}, expected one of {FOLD_MODES}")
+        # Identical requests are answered from the on-disk response cache of the research field;
+        # bypass_llm_cache sends every request again and refreshes the cached responses
+        # Prompts over the token budget (context_budget, or the model's context window) fail
+        # before they are sent
+        # llm_backend selects the model client ("openai", or "local" to run offline), see llm_backend.py
+        self.context_packer = ContextPacker(gpt_model, context_budget)
+        # Calls that miss the cache are admitted by the process-wide rate limiter of the model
+        # (requests_per_minute and tokens_per_minute default to the model's usual quota)
+        self.backend = create_backend(llm_backend, gpt_model, **(llm_backend_options or {}))
+        self.rate_limiter = None
+        if self.backend.rate_limited:
+            self.rate_limiter = get_rate_limiter(self.backend.cache_model, requests_per_minute, tokens_per_minute)
+        # Intermediate results and every call go to the run's trace file, see trace_writer.py
+        self.trace_writer = get_trace_writer(research_field)
+        self.gpt_client = TracingChatClient(BudgetedChatClient(CachedChatClient(
+            RateLimitedChatClient(self.backend, self.rate_limiter, self.context_packer.count_async),
+            get_response_cache(llm_cache_dir(research_field)),
+            model=self.backend.cache_model, bypass=bypass_llm_cache), self.context_packer),
+            self.trace_writer, research_field, section_name, gpt_model, self.context_packer.count_async)
         self.structure_iterations = structure_iterations
+        # Number of subsections detailized concurrently in step 2 (1 keeps them sequential)
+        self.subsection_concurrency = max(1, subsection_concurrency)
+        self.fold_mode = fold_mode
         self.research_field = research_field
         self.section_name = section_name
         
         # Create necessary directories
         self.setup_directories()
-        self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
     def setup_directories(self):
         """Set up necessary directories for the composer"""
         directories = [
-            f"{self.research_field}/temp",
             f"{self.research_field}/target_sections",
             f"{self.research_field}/{self.section_name}_checkpoints",
             f"{self.research_field}/writing_templates/{self.section_name}"
@@ -45,11 +95,21 @@ class SectionComposer(ABC):
             os.makedirs(directory, exist_ok=True)
 
     def write_temp_log(self, content: str, step: str):
-        """Write intermediate results to temporary log file"""
-        filename = f"{self.research_field}/temp/{self.timestamp}_{step}.log"
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(content)
-        logging.info(f"Written intermediate result to {filename}")
+        """Record an intermediate result in the run's trace file (written in the background)"""
+        self.trace_writer.write({
+            'type': 'step',
+            'time': time.time(),
+            'section': self.section_name,
+            **trace_context(),
+            'step': step,
+            'text': content,
+        })
+
+    def set_trace_stage(self, stage: str, iteration: Optional[int] = None):
+        """Tag the trace records and call telemetry of the current task from here on with a
+        pipeline stage (and structure iteration)"""
+        trace_stage.set(stage)
+        trace_iteration.set(iteration)
 
     def get_checkpoint_path(self, target_paper: str) -> str:
         """Get checkpoint directory path for the target paper"""
@@ -62,8 +122,11 @@ class SectionComposer(ABC):
         os.makedirs(checkpoint_dir, exist_ok=True)
         
         checkpoint_file = os.path.join(checkpoint_dir, f"{step}.json")
-        with open(checkpoint_file, 'w', encoding='utf-8') as f:
+        # Write to a temporary file first so a crash never leaves a truncated checkpoint behind
+        temp_file = f"{checkpoint_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2)
+        os.replace(temp_file, checkpoint_file)
         logging.info(f"Saved checkpoint: {checkpoint_file}")
 
     def load_checkpoint(self, target_paper: str, step: str) -> Optional[Dict]:
@@ -81,6 +144,33 @@ class SectionComposer(ABC):
         """Normalize title for file naming"""
         return '_'.join(title.lower().split())
 
+    def get_section_path(self, target_paper: str, section_name: str) -> str:
+        return f"{self.research_field}/target_sections/{self.normalize_title(target_paper)}/{section_name}.tex"
+
+    def save_section_output(self, target_paper: str, text: str) -> str:
+        """Write the final text of this section to target_sections and publish it on the bus"""
+        output_path = self.get_section_path(target_paper, self.section_name)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        logging.info(f"Saved final {self.section_name.replace('_', ' ')} to {output_path}")
+        self.section_bus.publish(self.research_field, target_paper, self.section_name, text)
+        return output_path
+
+    async def read_section_content(self, target_paper: str, section_name: str) -> str:
+        """Final text of another section: from the section bus, waiting for it if it is still
+        being composed in this process, or else from its file in target_sections"""
+        text = await self.section_bus.wait_for(self.research_field, target_paper, section_name)
+        if text is not None:
+            return text
+        section_path = self.get_section_path(target_paper, section_name)
+        try:
+            with open(section_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            logging.warning(f"Section file {section_path} not found")
+            return ""
+
     def load_benchmark_data(self, json_path: str, target_paper: str) -> List[Dict]:
         """Load source papers from benchmark data"""
         with open(json_path, 'r') as f:
@@ -91,21 +181,156 @@ class SectionComposer(ABC):
                 return item['source_papers']
         return []
 
-    def get_random_template(self) -> str:
-        """Randomly select a writing template from the templates directory"""
-        template_dir = f"{self.research_field}/writing_templates/{self.section_name}"
-        template_files = [f for f in os.listdir(template_dir) if f.endswith('_template.txt')]
-        if not template_files:
+    async def run_io(self, func: Callable, *args, **kwargs):
+        """Run a blocking I/O function in the process-wide thread pool"""
+        return await executors.run_io(func, *args, **kwargs)
+
+    async def dumps_json(self, data) -> str:
+        """json.dumps(data, indent=2) of a large artifact, serialized in the thread pool.
+
+        Not the process pool: pickling data to a worker and the result back costs as much as
+        serializing it."""
+        return await self.run_io(json.dumps, data, indent=2)
+
+    async def pack_content(self, content: str, query: str, *fixed_parts: str) -> str:
+        """Trim content to the chunks most relevant to query so that it fits the token budget
+        next to fixed_parts (structure, current text, ...) and the prompt instructions"""
+        reserved = sum([await self.context_packer.count_async(part) for part in fixed_parts]) + PROMPT_OVERHEAD
+        return await self.context_packer.pack_async(content, query, reserved)
+
+    def get_outline(self, structure: str) -> Outline:
+        """Heading tree of a structure, parsed once per distinct structure"""
+        return get_outline(structure)
+
+    def get_subsections(self, structure: str) -> List[str]:
+        """Titles of the subsections of a structure, in order"""
+        return self.get_outline(structure).titles('subsection')
+
+    def describe_subsection(self, structure: str, subsection: str) -> str:
+        """Title and structure comments of a subsection, e.g. as a retrieval query"""
+        node = self.get_outline(structure).find(subsection)
+        return '\n'.join([subsection] + (node.comments if node else []))
+
+    def scope_structure(self, structure: str, subsection: str) -> str:
+        """The part of a structure a subsection prompt needs: the subsection's own block, the
+        section overview and the titles of the other subsections (the full structure if the
+        subsection is not found in it)"""
+        focused = self.get_outline(structure).focus(subsection)
+        return structure if focused is None else focused
+
+    async def select_template(self, query: str) -> str:
+        """Select the writing template most relevant to query (BM25 over the section's templates,
+        which are read once per process).
+
+        Unlike random selection the choice is deterministic, so repeated prompts stay cacheable.
+        Queries are whole payloads, so they are tokenized and scored in the thread pool."""
+        name, template = await self.run_io(
+            select_template, f"{self.research_field}/writing_templates/{self.section_name}", query)
+        if not template:
             logging.warning("No templates found. Will proceed without template.")
-            return ""
-        
-        selected_template = random.choice(template_files)
+        else:
+            logging.info(f"Selected writing template {name}")
+        return template
+
+    async def detailize_subsections(self, subsections: List[str],
+                                    detailize_one: Callable[[int, str], Awaitable[str]]) -> Dict[str, str]:
+        """Detailize all subsections, running up to subsection_concurrency of them at once.
+
+        Args:
+            subsections: Subsection titles in structure order
+            detailize_one: Coroutine function called as detailize_one(subsection_id, subsection)
+                that returns the subsection text
+
+        Returns:
+            Subsection texts keyed by title, in structure order regardless of completion order
+        """
+        semaphore = asyncio.Semaphore(self.subsection_concurrency)
+        progress = tqdm(total=len(subsections), desc="Detailizing subsections")
+
+        async def run(subsection_id, subsection):
+            async with semaphore:
+                content = await detailize_one(subsection_id, subsection)
+            progress.update(1)
+            return content
+
+        tasks = [asyncio.ensure_future(run(subsection_id, subsection))
+                 for subsection_id, subsection in enumerate(subsections)]
         try:
-            with open(os.path.join(template_dir, selected_template), 'r', encoding='utf-8') as f:
-                return f.read()
-        except Exception as e:
-            logging.error(f"Error reading template {selected_template}: {str(e)}")
-            return ""
+            contents = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            progress.close()
+        return dict(zip(subsections, contents))
+
+    def open_step_log(self, target_paper: str, structure: str) -> SubsectionStepLog:
+        """Append-only log of subsection steps for target_paper, used to resume step 2 after a crash"""
+        checkpoint_dir = self.get_checkpoint_path(target_paper)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        return SubsectionStepLog(os.path.join(checkpoint_dir, "subsection_steps.jsonl"), structure)
+
+    async def fold_into_subsection(self, structure: str, subsection: str, subsection_id: int,
+                                   steps: List[Tuple[str, str]],
+                                   step_log: Optional[SubsectionStepLog] = None) -> str:
+        """Fold content pieces into the text of one subsection with detailize_subsection.
+
+        In "sequential" mode each piece revises the text produced by the previous one, a chain of
+        len(steps) calls. In "tree" mode every piece first yields its own draft, all in parallel,
+        and neighbouring drafts are then merged pairwise (the first draft is revised with the second
+        as new content) in ceil(log2(len(steps))) rounds.
+
+        Args:
+            structure: Section structure (prompts get the part of it scoped to the subsection)
+            subsection: Title of the subsection being written
+            subsection_id: Index of the subsection, used to name trace steps
+            steps: (label, content) pairs in fold order; labels name the trace steps
+            step_log: Records the text after every step; steps already recorded are not sent again,
+                so an interrupted fold resumes at the step where it stopped
+
+        Returns:
+            The subsection text
+        """
+        mode = "tree" if self.fold_mode == "tree" and len(steps) > 1 else "sequential"
+        # Prompts only carry the part of the structure that concerns this subsection
+        scoped_structure = self.scope_structure(structure, subsection)
+
+        async def run_step(label, current_text, content):
+            if step_log:
+                recorded = step_log.get(subsection, mode, label)
+                if recorded is not None:
+                    return recorded
+            subsection_token, step_token = trace_subsection.set(subsection), trace_step.set(label)
+            try:
+                content = await self.pack_content(content, subsection, scoped_structure, current_text)
+                text = await self.detailize_subsection(scoped_structure, current_text, content, subsection)
+                self.write_temp_log(text, f"subsection_{subsection_id}_{label}")
+            finally:
+                trace_subsection.reset(subsection_token)
+                trace_step.reset(step_token)
+            if step_log:
+                await self.run_io(step_log.record, subsection, mode, label, text)
+            return text
+
+        if mode == "tree":
+            drafts = list(await asyncio.gather(*(run_step(label, '', content) for label, content in steps)))
+
+            merge_round = 0
+            while len(drafts) > 1:
+                merge_round += 1
+                merged = list(await asyncio.gather(*(
+                    run_step(f"merge_{merge_round}_{i // 2}", drafts[i], drafts[i + 1])
+                    for i in range(0, len(drafts) - 1, 2))))
+                if len(drafts) % 2:
+                    merged.append(drafts[-1])
+                drafts = merged
+            return drafts[0]
+
+        text = ''
+        for label, content in steps:
+            text = await run_step(label, text, content)
+        return text
 
     @abstractmethod
     async def generate_or_revise_structure(self, content: str, current_structure: str, iteration: int) -> str:
@@ -124,6 +349,7 @@ class SectionComposer(ABC):
 
     async def fuse_subsections(self, structure: str, subsection_contents: Dict[str, str]) -> str:
         """Fuse all subsections into one complete section"""
+        contents_json = await self.dumps_json(subsection_contents)
         prompt = f"""Combine the following subsections into a complete {self.section_name} section according to the established structure.
     The content of each subsection MUST BE PRESERVED EXACTLY as provided.
 
@@ -131,7 +357,7 @@ class SectionComposer(ABC):
     {structure}
 
     Subsection contents:
-    {json.dumps(subsection_contents, indent=2)}
+    {contents_json}
 
     Requirements:
     1. STRICT CONTENT PRESERVATION:
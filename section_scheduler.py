@@ -0,0 +1,149 @@
+import os
+import glob
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from section_bus import get_section_bus
+
+'''
+# Section Scheduling
+
+Each section composer declares what it reads: agent files from `cache_*/agents/` (which exist
+before the run starts) and the `target_sections` outputs of other composers. The scheduler turns
+those declarations into a dependency graph and starts every section as soon as all the sections
+it reads have been written, running independent sections concurrently under a shared cap.
+Every section is announced on the section bus before the run starts, so composers reading it
+get the text published by its writer rather than racing the file in `target_sections`.
+
+For the default pipeline this gives three levels:
+
+    methodology, related_work, experiments  ->  introduction  ->  conclusion, abstract
+'''
+
+class SectionSkipped(RuntimeError):
+    """Raised for a section that was not run because a section it reads failed"""
+
+class SectionTask:
+    def __init__(self, name: str, compose: Callable[..., Awaitable], inputs: Sequence[str] = (),
+                 agent_files: Sequence[str] = (), options: Optional[Dict] = None):
+        """
+        Args:
+            name: Section produced by the task (the `target_sections/<name>.tex` it writes)
+            compose: Coroutine function called as compose(research_field, instance_id, **composer_options)
+            inputs: Sections whose outputs the task reads
+            agent_files: Agent files (or glob patterns) the task reads from the instance's agent directory
+            options: Composer options for this section only, overriding the shared ones
+        """
+        self.name = name
+        self.compose = compose
+        self.inputs = tuple(inputs)
+        self.agent_files = tuple(agent_files)
+        self.options = dict(options or {})
+
+def topological_order(tasks: Sequence[SectionTask]) -> List[SectionTask]:
+    """Order tasks so that every task comes after the sections it reads.
+
+    Ties keep the order in which the tasks were declared."""
+    by_name = {task.name: task for task in tasks}
+    if len(by_name) != len(tasks):
+        raise ValueError("Duplicate section names in task graph")
+    for task in tasks:
+        missing = [name for name in task.inputs if name not in by_name]
+        if missing:
+            raise ValueError(f"Section {task.name} reads unknown sections: {missing}")
+
+    ordered, placed = [], set()
+    while len(ordered) < len(tasks):
+        ready = [task for task in tasks
+                 if task.name not in placed and all(name in placed for name in task.inputs)]
+        if not ready:
+            pending = [task.name for task in tasks if task.name not in placed]
+            raise ValueError(f"Cyclic section dependencies among: {pending}")
+        ordered.extend(ready)
+        placed.update(task.name for task in ready)
+    return ordered
+
+def check_agent_files(tasks: Sequence[SectionTask], agent_dir: str):
+    """Warn about declared agent files (or glob patterns without any match) that are missing from
+    the agent directory"""
+    for task in tasks:
+        for agent_file in task.agent_files:
+            if not glob.glob(os.path.join(agent_dir, agent_file)):
+                logging.warning(f"Section {task.name}: agent file {agent_file} not found in {agent_dir}")
+
+async def run_section_graph(tasks: Sequence[SectionTask], research_field: str, instance_id: str,
+                            max_concurrency: Optional[int] = None,
+                            semaphore: Optional[asyncio.Semaphore] = None,
+                            composer_options: Optional[Dict] = None,
+                            on_section_finished: Optional[Callable[[str, Optional[float], Optional[BaseException]], None]] = None
+                            ) -> Dict[str, float]:
+    """Run section tasks in dependency order, at most max_concurrency at a time.
+
+    A section starts as soon as all of its inputs have finished. When a section fails, sections
+    that do not depend on it still run to completion (so their checkpoints and outputs are kept),
+    sections that depend on it are skipped, and the first failure is raised at the end.
+
+    Args:
+        tasks: Section tasks making up the pipeline
+        research_field: Research field passed to each composer
+        instance_id: Instance passed to each composer
+        max_concurrency: Cap on concurrently running sections (None for no cap)
+        semaphore: Shared semaphore to use instead of max_concurrency, e.g. to cap several
+            pipelines running in the same event loop
+        composer_options: Keyword arguments forwarded to every composer
+        on_section_finished: Called as on_section_finished(name, seconds, error) when a section
+            finishes (error None), fails or is skipped (seconds None), e.g. to report progress
+
+    Returns:
+        Wall-clock seconds spent composing each section
+    """
+    ordered = topological_order(tasks)
+    composer_options = composer_options or {}
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_concurrency or len(ordered) or 1)
+
+    runs: Dict[str, asyncio.Future] = {}
+    durations: Dict[str, float] = {}
+    bus = get_section_bus()
+    for task in ordered:
+        bus.expect(research_field, instance_id, task.name)
+
+    async def run(task: SectionTask):
+        try:
+            await compose(task)
+        except Exception as e:
+            if on_section_finished:
+                on_section_finished(task.name, None, e)
+            raise
+        finally:
+            # Readers fall back to disk if the composer did not publish its section
+            bus.withdraw(research_field, instance_id, task.name)
+        if on_section_finished:
+            on_section_finished(task.name, durations[task.name], None)
+
+    async def compose(task: SectionTask):
+        for name in task.inputs:
+            try:
+                await runs[name]
+            except Exception:
+                raise SectionSkipped(f"Skipping {task.name}: required section {name} failed")
+        async with semaphore:
+            logging.info(f"Starting {task.name} composition for {instance_id}")
+            start = time.perf_counter()
+            await task.compose(research_field, instance_id, **{**composer_options, **task.options})
+            durations[task.name] = time.perf_counter() - start
+            logging.info(f"Finished {task.name} composition in {durations[task.name]:.1f}s")
+
+    for task in ordered:
+        runs[task.name] = asyncio.ensure_future(run(task))
+
+    results = await asyncio.gather(*runs.values(), return_exceptions=True)
+    for task, result in zip(ordered, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Section {task.name} did not complete: {result}")
+    for result in results:
+        if isinstance(result, BaseException) and not isinstance(result, SectionSkipped):
+            raise result
+    return durations
@@ -0,0 +1,132 @@
+import math
+import contextvars
+from typing import Dict, List, Optional, Sequence, Tuple
+
+'''
+# Call Telemetry
+
+Every LLM call made through a composer's client is measured once, at the outermost client
+(TracingChatClient in trace_writer.py), and tagged with the composer (section), the stage
+(structure, detailize, fuse, checklist, find_and_fill_results), the structure iteration, the
+subsection and the fold step.
+
+The inner clients add what only they know to the call being measured via note_call():
+CachedChatClient whether the response came from the cache, RateLimitedChatClient the time spent
+waiting for admission and the number of rate limit retries. The prompt and the response are
+tokenized once per call, by the first client that needs their token count (count_call_tokens),
+and the other clients reuse it.
+
+At the end of a run the calls are summarized per stage with p50/p95 latencies, token totals,
+cache hit counts and the cost of the calls that reached the model.
+'''
+
+# USD per million (prompt, completion) tokens by model name prefix, longest prefix wins
+MODEL_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'o1': (15.00, 60.00),
+    'o1-mini': (1.10, 4.40),
+    'o3-mini': (1.10, 4.40),
+}
+
+# Metrics of the call being made in the current task, filled in by the inner clients
+current_call: contextvars.ContextVar = contextvars.ContextVar('current_call', default=None)
+
+def note_call(**values):
+    """Attach values to the call currently being measured (no-op outside a measured call)"""
+    metrics = current_call.get()
+    if metrics is not None:
+        metrics.update(values)
+
+async def count_call_tokens(name: str, text: str, count_tokens, metrics: Optional[Dict] = None) -> int:
+    """Token count of the prompt (name "prompt") or response ("completion") of the call being
+    measured, counted with the coroutine function count_tokens only if no client has counted the
+    same text for this call yet.
+
+    metrics defaults to the call currently being measured."""
+    if metrics is None:
+        metrics = current_call.get()
+    counted = metrics.get('token_counts', {}).get(name) if metrics is not None else None
+    if counted is not None and counted[0] is text:
+        return counted[1]
+    tokens = await count_tokens(text)
+    if metrics is not None:
+        metrics.setdefault('token_counts', {})[name] = (text, tokens)
+    return tokens
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """USD cost of a call, or None for models without a known price"""
+    matches = [prefix for prefix in MODEL_PRICES if model.startswith(prefix)]
+    if not matches:
+        return None
+    prompt_price, completion_price = MODEL_PRICES[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """q-th percentile (0-100) of values by linear interpolation, 0.0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+class CallTelemetry:
+    """Measured calls of the process"""
+
+    def __init__(self):
+        self.calls: List[Dict] = []
+
+    def record(self, call: Dict):
+        self.calls.append(call)
+
+    def summary(self, research_field: Optional[str] = None,
+                group_by: Tuple[str, ...] = ('section', 'stage')) -> List[Dict]:
+        """Per-group statistics of the calls (of one research field, if given)"""
+        groups: Dict[Tuple, List[Dict]] = {}
+        for call in self.calls:
+            if research_field is None or call.get('research_field') == research_field:
+                groups.setdefault(tuple(call.get(key) for key in group_by), []).append(call)
+
+        rows = []
+        for key, calls in groups.items():
+            latencies = [call['latency'] for call in calls]
+            queue_waits = [call.get('queue_wait', 0.0) for call in calls]
+            sent = [call for call in calls if not call.get('cache_hit') and not call.get('error')]
+            costs = [call.get('cost') for call in sent]
+            rows.append({
+                **dict(zip(group_by, key)),
+                'calls': len(calls),
+                'cache_hits': sum(1 for call in calls if call.get('cache_hit')),
+                'errors': sum(1 for call in calls if call.get('error')),
+                'retries': sum(call.get('retries', 0) for call in calls),
+                'latency_total': round(sum(latencies), 3),
+                'latency_p50': round(percentile(latencies, 50), 3),
+                'latency_p95': round(percentile(latencies, 95), 3),
+                'queue_wait_p95': round(percentile(queue_waits, 95), 3),
+                'prompt_tokens': sum(call.get('prompt_tokens', 0) for call in sent),
+                'completion_tokens': sum(call.get('completion_tokens', 0) for call in sent),
+                'cost': None if any(cost is None for cost in costs) else round(sum(costs), 4),
+            })
+        rows.sort(key=lambda row: -row['latency_total'])
+        return rows
+
+    def render(self, research_field: Optional[str] = None) -> str:
+        """Summary table, stages taking the most call time first"""
+        rows = self.summary(research_field)
+        if not rows:
+            return "No LLM calls"
+        columns = ['section', 'stage', 'calls', 'cache_hits', 'retries', 'latency_total', 'latency_p50',
+                   'latency_p95', 'queue_wait_p95', 'prompt_tokens', 'completion_tokens', 'cost']
+        table = [columns] + [['-' if row[column] is None else str(row[column]) for column in columns] for row in rows]
+        widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+        return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(line, widths)) for line in table)
+
+    def clear(self):
+        self.calls.clear()
+
+_telemetry = CallTelemetry()
+
+def get_call_telemetry() -> CallTelemetry:
+    """The process-wide call telemetry"""
+    return _telemetry
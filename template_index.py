@@ -0,0 +1,47 @@
+import os
+import logging
+from typing import Dict, List, Tuple
+
+from lexical_index import BM25Index
+
+class TemplateIndex:
+    """Writing templates of one section, read once and indexed for relevance-based selection"""
+
+    def __init__(self, template_dir: str):
+        self.template_dir = template_dir
+        self.names: List[str] = []
+        self.texts: List[str] = []
+        for name in sorted(os.listdir(template_dir)):
+            if not name.endswith('_template.txt'):
+                continue
+            try:
+                with open(os.path.join(template_dir, name), 'r', encoding='utf-8') as f:
+                    self.texts.append(f.read())
+                self.names.append(name)
+            except Exception as e:
+                logging.error(f"Error reading template {name}: {str(e)}")
+        self.index = BM25Index(self.texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def select(self, query: str) -> Tuple[str, str]:
+        """(name, text) of the template most relevant to query"""
+        if not self.texts:
+            return "", ""
+        best = self.index.rank(query)[0]
+        return self.names[best], self.texts[best]
+
+_indexes: Dict[str, TemplateIndex] = {}
+
+def get_template_index(template_dir: str) -> TemplateIndex:
+    """Return the process-wide index of template_dir, read and tokenized once per process
+    (templates added during a run are picked up by the next run)"""
+    template_dir = os.path.abspath(template_dir)
+    if template_dir not in _indexes:
+        _indexes[template_dir] = TemplateIndex(template_dir)
+    return _indexes[template_dir]
+
+def select_template(template_dir: str, query: str) -> Tuple[str, str]:
+    """(name, text) of the template of template_dir most relevant to query"""
+    return get_template_index(template_dir).select(query)
@@ -0,0 +1,36 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from latex_outline import parse_outline
+
+STRUCTURE = r"""\section{Method}
+% overview
+\subsection{Rotation}
+% rotation comment
+\subsubsection{Rotation Matrix}
+% matrix comment
+\subsubsection{Gradient Flow} % gradient heading comment
+% gradient comment
+gradient text
+\subsection{Codebook}
+% codebook comment
+\subsubsection{Reset}
+% reset comment"""
+
+def test_focus_keeps_the_target_subtree_and_outlines_the_rest():
+    focused = parse_outline(STRUCTURE).focus('Rotation')
+
+    assert '% gradient comment\ngradient text' in focused
+    assert r'\subsection{Codebook}' in focused
+    assert '% codebook comment' not in focused
+    assert '% reset comment' not in focused
+
+def test_focus_keeps_comments_of_sibling_subsubsections():
+    focused = parse_outline(STRUCTURE).focus('Rotation Matrix', 'subsubsection')
+
+    assert '% matrix comment' in focused
+    assert r'\subsubsection{Gradient Flow} % gradient heading comment' in focused
+    assert '% gradient comment' in focused
+    assert 'gradient text' not in focused
+    assert '% overview' in focused and '% rotation comment' in focused
+    assert '% codebook comment' not in focused
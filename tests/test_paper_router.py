@@ -0,0 +1,38 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from paper_router import PaperRouter
+
+PAPERS = [
+    ("vqvae", "vector quantization codebook discrete latent autoencoder"),
+    ("rqvae", "residual quantization codebook stacked discrete codes"),
+    ("gan", "adversarial training generator discriminator image synthesis"),
+    ("diffusion", "denoising diffusion score matching image generation"),
+    ("speech", "speech recognition acoustic model"),
+]
+
+QUERIES = {
+    "Vector Quantization": "vector quantization codebook discrete",
+    "Generative Models": "adversarial generator diffusion image",
+}
+
+def test_unmatched_papers_are_left_over_instead_of_folded():
+    routes, leftover_subsection, leftovers = PaperRouter(PAPERS).route(QUERIES)
+
+    assert set(routes["Vector Quantization"]) == {"vqvae", "rqvae"}
+    assert set(routes["Generative Models"]) == {"gan", "diffusion"}
+    assert leftovers == ["speech"]
+    assert leftover_subsection == "Vector Quantization"
+
+def test_papers_over_the_cap_are_left_over_to_their_best_subsection():
+    routes, leftover_subsection, leftovers = PaperRouter(PAPERS, max_papers_per_subsection=1).route(QUERIES)
+
+    assert all(len(papers) == 1 for papers in routes.values())
+    assert len(leftovers) == 3
+    assert leftover_subsection in QUERIES
+
+def test_no_leftovers_when_every_paper_matches():
+    routes, leftover_subsection, leftovers = PaperRouter(PAPERS[:4]).route(QUERIES)
+
+    assert leftovers == [] and leftover_subsection is None
+    assert sum(len(papers) for papers in routes.values()) == 4
@@ -0,0 +1,51 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from results_extractor import ResultRecord, ResultsTable, fill_result_tables
+
+def make_table():
+    return ResultsTable([
+        ResultRecord("comparison", "", "", "reconstruction_loss", 0.21, "0.21", "a.json:ours.loss"),
+        ResultRecord("comparison", "", "", "fid", 12.3, "12.3", "a.json:ours.fid"),
+        ResultRecord("comparison", "VQ-VAE", "", "reconstruction_loss", 0.41, "0.41", "a.json:vq_vae.loss"),
+        ResultRecord("comparison", "VQ-VAE", "", "fid", 18.2, "18.2", "a.json:vq_vae.fid"),
+    ])
+
+STRUCTURE = r"""\begin{tabular}{lcc}
+\toprule
+Method & Reconstruction Loss & FID \\
+\midrule
+Ours & -- & -- \\
+VQ-VAE & -- & -- \\
+RQ-VAE & -- & -- \\
+VQ-GAN & -- & -- \\
+Ours w/o rotation & -- & -- \\
+Ours (no codebook reset) & -- & -- \\
+\bottomrule
+\end{tabular}"""
+
+def test_fills_only_rows_naming_a_variant_exactly():
+    filled_structure, filled, unresolved = fill_result_tables(STRUCTURE, make_table())
+    rows = {line.split('&')[0].strip(): line for line in filled_structure.split('\n') if '&' in line}
+
+    assert rows['Ours'] == r"Ours & 0.21 & 12.3 \\"
+    assert rows['VQ-VAE'] == r"VQ-VAE & 0.41 & 18.2 \\"
+    assert filled == 4
+
+def test_leaves_other_baselines_and_ablations_unresolved():
+    filled_structure, _, unresolved = fill_result_tables(STRUCTURE, make_table())
+    rows = {line.split('&')[0].strip(): line for line in filled_structure.split('\n') if '&' in line}
+
+    for label in ('RQ-VAE', 'VQ-GAN', 'Ours w/o rotation', 'Ours (no codebook reset)'):
+        assert rows[label] == rf"{label} & -- & -- \\"
+        assert (label, 'Reconstruction Loss') in unresolved
+        assert (label, 'FID') in unresolved
+    assert len(unresolved) == 8
+
+def test_disagreeing_records_leave_the_cell_unresolved():
+    table = make_table()
+    table.extend([ResultRecord("sensitivity", "", "", "fid", 11.9, "11.9", "b.json:ours.fid")])
+    _, _, unresolved = fill_result_tables(STRUCTURE, table)
+
+    assert ('Ours', 'FID') in unresolved
+    assert ('Ours', 'Reconstruction Loss') not in unresolved
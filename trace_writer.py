@@ -0,0 +1,222 @@
+import os
+import json
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import hashlib
+import logging
+import threading
+import contextvars
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from telemetry import call_cost, count_call_tokens, current_call, get_call_telemetry
+
+'''
+# Traces
+
+Intermediate results (structure iterations, subsection steps, fused and final texts) and every
+LLM call of a run are appended as JSON lines to one trace file per research field and process,
+`{research_field}/traces/run_<timestamp>_<pid>.jsonl`:
+
+    {"type": "step", "time": ..., "section": "methodology", "stage": "detailize", "subsection": "Encoder", "step": "subsection_0_agent_1", "text": "..."}
+    {"type": "llm_call", "time": ..., "section": "methodology", "stage": "detailize", "subsection": "Encoder", "step": "agent_1", "prompt_hash": "...", "prompt_tokens": 2210, "completion_tokens": 512, "latency": 3.2, "queue_wait": 0.4, "retries": 0, "cache_hit": false, "cost": 0.0006, "response": "..."}
+
+Records are queued by the event loop and serialized and written in batches by a background
+thread. Once the file reaches max_bytes it is rotated to `run_..._<n>.jsonl` (gzip-compressed to
+`.jsonl.gz` with compress=True) and a new file is started.
+
+The composer stage, subsection and step of a record come from context variables, so concurrent
+subsection tasks each tag their own calls.
+'''
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Where in the pipeline the current task is: stage (e.g. "structure", "detailize"), structure
+# iteration, subsection title and fold step label
+trace_stage: contextvars.ContextVar = contextvars.ContextVar('trace_stage', default=None)
+trace_iteration: contextvars.ContextVar = contextvars.ContextVar('trace_iteration', default=None)
+trace_subsection: contextvars.ContextVar = contextvars.ContextVar('trace_subsection', default=None)
+trace_step: contextvars.ContextVar = contextvars.ContextVar('trace_step', default=None)
+
+def trace_context() -> Dict:
+    return {'stage': trace_stage.get(), 'iteration': trace_iteration.get(),
+            'subsection': trace_subsection.get(), 'step': trace_step.get()}
+
+class TraceWriter:
+    """Appends records to a JSONL file from a background thread"""
+
+    def __init__(self, path: str, max_bytes: Optional[int] = DEFAULT_MAX_BYTES, compress: bool = False,
+                 flush_interval: float = 0.5, batch_size: int = 256):
+        """
+        Args:
+            path: Trace file
+            max_bytes: Size at which the file is rotated (None to never rotate)
+            compress: Gzip rotated files
+            flush_interval: Seconds the writer waits for more records before flushing a batch
+            batch_size: Maximum number of records written at once
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.rotations = 0
+        self.records = 0
+        self.queue: queue.Queue = queue.Queue()
+        self.closed = False
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="trace_writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record: Dict):
+        """Queue a record; never blocks on I/O"""
+        if not self.closed:
+            self.queue.put(record)
+
+    def flush(self):
+        """Block until every record queued so far is on disk"""
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        file = open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while batch[-1] is not None and len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                records = [record for record in batch if record is not None]
+                try:
+                    if records:
+                        file.write(''.join(self.serialize(record) for record in records))
+                        file.flush()
+                        self.records += len(records)
+                        if self.max_bytes and file.tell() >= self.max_bytes:
+                            file.close()
+                            self.rotate()
+                            file = open(self.path, 'a', encoding='utf-8')
+                except Exception as e:
+                    logging.error(f"Error writing trace {self.path}: {str(e)}")
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if stop:
+                    return
+        finally:
+            file.close()
+
+    @staticmethod
+    def serialize(record: Dict) -> str:
+        return json.dumps(record, ensure_ascii=False, default=str) + '\n'
+
+    def rotate(self):
+        self.rotations += 1
+        base = self.path[:-len('.jsonl')] if self.path.endswith('.jsonl') else self.path
+        rotated = f"{base}_{self.rotations}.jsonl"
+        os.replace(self.path, rotated)
+        if self.compress:
+            with open(rotated, 'rb') as source, gzip.open(f"{rotated}.gz", 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+
+    def files(self) -> List[str]:
+        """Trace files written so far, oldest first"""
+        base = self.path[:-len('.jsonl')] if self.path.endswith('.jsonl') else self.path
+        suffix = '.jsonl.gz' if self.compress else '.jsonl'
+        return [f"{base}_{n}{suffix}" for n in range(1, self.rotations + 1)] + [self.path]
+
+_options: Dict = {}
+_writers: Dict[str, TraceWriter] = {}
+_run_id = f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+
+def configure_tracing(max_bytes: Optional[int] = DEFAULT_MAX_BYTES, compress: bool = False):
+    """Set the rotation options of trace writers created from now on"""
+    _options.update(max_bytes=max_bytes, compress=compress)
+
+def trace_dir(research_field: str) -> str:
+    return f"{research_field}/traces"
+
+def get_trace_writer(research_field: str) -> TraceWriter:
+    """The trace writer of a research field, shared by all composers of the process"""
+    path = os.path.abspath(os.path.join(trace_dir(research_field), f"{_run_id}.jsonl"))
+    if path not in _writers:
+        _writers[path] = TraceWriter(path, **_options)
+    return _writers[path]
+
+@atexit.register
+def close_trace_writers():
+    for writer in _writers.values():
+        writer.close()
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+class TracingChatClient:
+    """Wraps a chat client, measures every call (see telemetry.py) and writes a trace record for it"""
+
+    def __init__(self, client, writer: TraceWriter, research_field: str, section: str, model: str, count_tokens):
+        """
+        Args:
+            client: Chat client to wrap
+            writer: Trace writer the records go to
+            research_field: Research field the calls are made for
+            section: Section the calls are made for
+            model: Model the calls are priced for
+            count_tokens: Coroutine function returning the token count of a text
+        """
+        self.client = client
+        self.writer = writer
+        self.research_field = research_field
+        self.section = section
+        self.model = model
+        self.count_tokens = count_tokens
+
+    async def chat(self, prompt: str, **kwargs) -> str:
+        metrics = {}
+        token = current_call.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.client.chat(prompt=prompt, **kwargs)
+        except Exception as e:
+            await self.record(prompt, None, time.perf_counter() - started, metrics, f"{type(e).__name__}: {str(e)}")
+            raise
+        finally:
+            current_call.reset(token)
+        await self.record(prompt, response, time.perf_counter() - started, metrics)
+        return response
+
+    async def record(self, prompt: str, response: Optional[str], latency: float, metrics: Dict,
+                     error: Optional[str] = None):
+        call = {
+            'research_field': self.research_field,
+            'section': self.section,
+            **trace_context(),
+            'latency': round(latency, 4),
+            'queue_wait': round(metrics.get('queue_wait', 0.0), 4),
+            'retries': metrics.get('retries', 0),
+            'cache_hit': metrics.get('cache_hit', False),
+            'prompt_tokens': await count_call_tokens('prompt', prompt, self.count_tokens, metrics),
+            'completion_tokens': (await count_call_tokens('completion', response, self.count_tokens, metrics)
+                                  if response is not None else 0),
+        }
+        if error:
+            call['error'] = error
+        call['cost'] = 0.0 if call['cache_hit'] else call_cost(
+            self.model, call['prompt_tokens'], call['completion_tokens'])
+        get_call_telemetry().record(call)
+        self.writer.write({'type': 'llm_call', 'time': time.time(), **call,
+                           'prompt_hash': prompt_hash(prompt), 'response': response})
@@ -1,25 +1,188 @@
-from methodology_composing_using_template import methodology_composing
-from related_work_composing_using_template import related_work_composing
-from experiments_composing import experiments_composing
-from introduction_composing import introduction_composing
-from conclusion_composing import conclusion_composing
-from abstract_composing import abstract_composing
+from methodology_composing_using_template import methodology_composing, MethodologyComposer
+from related_work_composing_using_template import related_work_composing, RelatedWorkComposer
+from experiments_composing import experiments_composing, ExperimentsComposer
+from introduction_composing import introduction_composing, IntroductionComposer
+from conclusion_composing import conclusion_composing, ConclusionComposer
+from abstract_composing import abstract_composing, AbstractComposer
+from section_scheduler import SectionTask, run_section_graph, check_agent_files
+from section_composer import setup_logging, llm_cache_dir
+from llm_cache import get_response_cache
+from llm_backend import BACKEND_NAMES, LATENCY_DISTRIBUTIONS, backend_usage
+from rate_limiter import rate_limiter_stats
+from batch_backend import BatchPending, batch_stats
+from executors import configure_executors, shutdown_executors
+from section_bus import get_section_bus
+from trace_writer import configure_tracing, get_trace_writer
+from telemetry import get_call_telemetry
+import os
+import json
 import asyncio
+import logging
 import argparse
+from typing import Callable, Dict, Optional
 
-async def writing(research_field: str, instance_id: str):
-    await methodology_composing(research_field, instance_id)
-    await related_work_composing(research_field, instance_id)
-    await experiments_composing(research_field, instance_id)
-    await introduction_composing(research_field, instance_id)
-    await conclusion_composing(research_field, instance_id)
-    await abstract_composing(research_field, instance_id)
+def section_tasks():
+    """Section composers of the pipeline with the inputs each one reads"""
+    return [
+        SectionTask("methodology", methodology_composing, agent_files=MethodologyComposer.AGENT_FILES),
+        SectionTask("related_work", related_work_composing, agent_files=RelatedWorkComposer.AGENT_FILES),
+        SectionTask("experiments", experiments_composing, agent_files=ExperimentsComposer.AGENT_FILES),
+        SectionTask("introduction", introduction_composing, inputs=IntroductionComposer.INPUT_SECTIONS),
+        SectionTask("conclusion", conclusion_composing, inputs=ConclusionComposer.INPUT_SECTIONS),
+        SectionTask("abstract", abstract_composing, inputs=AbstractComposer.INPUT_SECTIONS),
+    ]
+
+def parse_fold_modes(values):
+    """Parse --fold_mode values: "tree" applies to every section, "methodology=tree" to one section"""
+    fold_modes = {}
+    for value in values or []:
+        section, _, mode = value.rpartition('=')
+        fold_modes[section or '*'] = mode
+    return fold_modes
+
+async def compose_paper(research_field: str, instance_id: str, max_concurrency: int = 3,
+                        fold_modes: Optional[Dict[str, str]] = None,
+                        section_options: Optional[Dict[str, Dict]] = None,
+                        semaphore: Optional[asyncio.Semaphore] = None,
+                        on_section_finished: Optional[Callable[[str, Optional[float], Optional[BaseException]], None]] = None,
+                        **composer_options) -> Dict[str, float]:
+    """Compose all sections of one paper.
+
+    Args:
+        fold_modes: Fold mode per section name ("*" for every section without its own entry),
+            see SectionComposer.fold_into_subsection
+        section_options: Composer options for single sections by section name, e.g. the paper
+            routing options of related_work
+        semaphore: Section concurrency cap shared with other papers (replaces max_concurrency)
+        on_section_finished: Progress callback, see run_section_graph
+        composer_options: Keyword arguments forwarded to every composer
+
+    Returns:
+        Wall-clock seconds spent composing each section
+    """
+    setup_logging(research_field)
+    tasks = section_tasks()
+    for task in tasks:
+        fold_mode = (fold_modes or {}).get(task.name, (fold_modes or {}).get('*'))
+        if fold_mode:
+            task.options['fold_mode'] = fold_mode
+        task.options.update((section_options or {}).get(task.name, {}))
+    proj_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), research_field, instance_id)
+    if os.path.isdir(proj_dir):
+        cache_dirs = sorted(d for d in os.listdir(proj_dir) if d.startswith('cache_'))
+        if cache_dirs:
+            check_agent_files(tasks, os.path.join(proj_dir, cache_dirs[-1], 'agents'))
+    try:
+        return await run_section_graph(tasks, research_field, instance_id, max_concurrency=max_concurrency,
+                                       semaphore=semaphore, composer_options=composer_options,
+                                       on_section_finished=on_section_finished)
+    finally:
+        # The sections are on disk now; keep the bus from growing over a batch of papers
+        get_section_bus().discard(research_field, instance_id)
+
+def log_run_stats(research_fields):
+    """Log cache, backend, rate limiter and batch job statistics of the process"""
+    for research_field in research_fields:
+        logging.info(f"LLM response cache ({research_field}): {get_response_cache(llm_cache_dir(research_field)).stats()}")
+    logging.info(f"LLM backend usage: {backend_usage()}")
+    logging.info(f"Rate limiters: {rate_limiter_stats()}")
+    if batch_stats():
+        logging.info(f"Batch jobs: {batch_stats()}")
+    telemetry = get_call_telemetry()
+    for research_field in research_fields:
+        trace_writer = get_trace_writer(research_field)
+        logging.info(f"Trace ({research_field}): {trace_writer.path}")
+        logging.info(f"LLM calls by stage ({research_field}):\n{telemetry.render(research_field)}")
+        summary_path = trace_writer.path[:-len('.jsonl')] + '_summary.json'
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(telemetry.summary(research_field), f, indent=2)
+
+async def writing(research_field: str, instance_id: str, max_concurrency: int = 3,
+                  fold_modes: Optional[Dict[str, str]] = None, **composer_options):
+    """Compose all sections of a paper, see compose_paper"""
+    try:
+        await compose_paper(research_field, instance_id, max_concurrency, fold_modes, **composer_options)
+    finally:
+        log_run_stats([research_field])
+
+def add_composer_arguments(parser: argparse.ArgumentParser):
+    """Command line options shared by writing.py and batch_writing.py"""
+    parser.add_argument("--subsection_concurrency", type=int, default=4,
+                        help="Maximum number of subsections detailized concurrently within a section")
+    parser.add_argument("--fold_mode", type=str, nargs='*', default=[],
+                        help="How content is folded into subsections: 'sequential' or 'tree', "
+                             "for all sections or per section as e.g. methodology=tree")
+    parser.add_argument("--bypass_llm_cache", action="store_true",
+                        help="Send every LLM request again instead of reusing cached responses")
+    parser.add_argument("--context_budget", type=int, default=None,
+                        help="Prompt token budget (defaults to the model's context window)")
+    parser.add_argument("--llm_backend", type=str, default="openai", choices=BACKEND_NAMES,
+                        help="Model client; 'local' is an offline stand-in for benchmarking the pipeline, "
+                             "'batch' sends calls as batch jobs")
+    parser.add_argument("--llm_replay_dir", type=str, default=None,
+                        help="Local backend: response cache directory to replay recorded responses from")
+    parser.add_argument("--llm_latency", type=float, default=0.0,
+                        help="Local backend: seconds every call takes (the mean with --llm_latency_distribution)")
+    parser.add_argument("--llm_latency_distribution", type=str, default="fixed", choices=LATENCY_DISTRIBUTIONS,
+                        help="Local backend: distribution call latencies are drawn from")
+    parser.add_argument("--requests_per_minute", type=int, default=None,
+                        help="Request quota per minute of the model (shared by all sections)")
+    parser.add_argument("--tokens_per_minute", type=int, default=None,
+                        help="Token quota per minute of the model (shared by all sections)")
+    parser.add_argument("--batch_server", type=str, default="openai", choices=["openai", "local"],
+                        help="Batch backend: batch API to submit jobs to ('local' is an offline stand-in)")
+    parser.add_argument("--batch_detach", action="store_true",
+                        help="Batch backend: exit after submitting a job instead of waiting for it; "
+                             "rerun to ingest its results and submit the next one")
+    parser.add_argument("--batch_poll_interval", type=float, default=30.0,
+                        help="Batch backend: seconds between polls of a submitted job")
+    parser.add_argument("--paper_relevance", type=float, default=0.3,
+                        help="Related work: score relative to a subsection's best paper a paper needs to be folded into it")
+    parser.add_argument("--max_papers_per_subsection", type=int, default=8,
+                        help="Related work: maximum number of related papers folded into one subsection")
+    parser.add_argument("--cpu_workers", type=int, default=None,
+                        help="Worker processes for CPU-heavy stages such as token counting of large payloads "
+                             "(0 runs them in threads); applied with configure_executors, not per paper")
+    parser.add_argument("--trace_max_mb", type=float, default=64,
+                        help="Size in MB at which the run's trace file is rotated (0 to never rotate)")
+    parser.add_argument("--trace_compress", action="store_true",
+                        help="Gzip rotated trace files")
+
+def composer_options_from_args(args: argparse.Namespace, research_field: str) -> Dict:
+    """Keyword arguments of compose_paper for the options added by add_composer_arguments"""
+    llm_backend_options = None
+    if args.llm_backend == "local":
+        llm_backend_options = {'replay_dir': args.llm_replay_dir, 'latency': args.llm_latency,
+                               'latency_distribution': args.llm_latency_distribution}
+    elif args.llm_backend == "batch":
+        llm_backend_options = {'server': args.batch_server, 'batch_dir': f"{research_field}/llm_batches",
+                               'cache_dir': llm_cache_dir(research_field), 'wait': not args.batch_detach,
+                               'poll_interval': args.batch_poll_interval}
+    return dict(fold_modes=parse_fold_modes(args.fold_mode),
+                section_options={'related_work': {'paper_relevance': args.paper_relevance,
+                                                  'max_papers_per_subsection': args.max_papers_per_subsection}},
+                subsection_concurrency=args.subsection_concurrency,
+                bypass_llm_cache=args.bypass_llm_cache,
+                context_budget=args.context_budget,
+                llm_backend=args.llm_backend,
+                llm_backend_options=llm_backend_options,
+                requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--research_field", type=str, default="vq")
     parser.add_argument("--instance_id", type=str, default="rotation_vq")
+    parser.add_argument("--max_concurrency", type=int, default=3,
+                        help="Maximum number of sections composed concurrently (1 runs them one after another)")
+    add_composer_arguments(parser)
     args = parser.parse_args()
-    asyncio.run(writing(args.research_field, args.instance_id))
-
-        
\ No newline at end of file
+    configure_executors(cpu_workers=args.cpu_workers)
+    configure_tracing(int(args.trace_max_mb * 1024 * 1024) or None, args.trace_compress)
+    try:
+        asyncio.run(writing(args.research_field, args.instance_id, args.max_concurrency,
+                            **composer_options_from_args(args, args.research_field)))
+    except BatchPending as e:
+        logging.info(str(e))
+    finally:
+        shutdown_executors()